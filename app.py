@@ -2,11 +2,16 @@ import json
 
 import streamlit as st
 
-from src.api import client
 from src.config import MODEL, SYSTEM_MESSAGE
-from src.tools import functions
+from src.tools import tool_runtime
 from src.ui.components import advanced_settings, file_upload, header, system_prompt
-from src.ui.utils import all_images, prepare_content_with_images
+from src.ui.utils import (
+    all_images,
+    create_completion,
+    image_preview,
+    prepare_content_with_images,
+    stream_text,
+)
 
 
 def main():
@@ -43,7 +48,7 @@ def main():
                 content = message["content"]
                 if isinstance(content, list):
                     urls = [
-                        item["image_url"]["url"]
+                        image_preview(item["image_url"]["url"])
                         for item in content
                         if "image_url" in item
                     ]
@@ -74,11 +79,8 @@ def main():
             messages = [SYSTEM_MESSAGE, *st.session_state.messages]
 
             if not tools:
-                stream = client.chat.completions.create(
-                    model=MODEL,
-                    messages=messages,
-                    stream=True,
-                    response_format=response_format,
+                stream = create_completion(
+                    model=MODEL, messages=messages, response_format=response_format
                 )
                 response = st.write_stream(stream)
                 st.session_state.messages.append(
@@ -86,51 +88,46 @@ def main():
                 )
 
             else:
-                with st.spinner("Thinking..."):
-                    response = client.chat.completions.create(
-                        model=MODEL,
-                        messages=messages,
-                        tools=tools,
-                        tool_choice="auto",
-                    )
-                    response_message = response.choices[0].message
-                    tool_calls = response_message.tool_calls
-                    if tool_calls:
-                        with st.status("Thinking...", expanded=True) as status:
-                            for tool_call in tool_calls:
-                                function_name = tool_call.function.name
-                                tool = functions[function_name]
-                                args = json.loads(tool_call.function.arguments)
-                                st.write(
-                                    f"Calling {function_name}... with args: {args}"
-                                )
-                                tool_response = tool(**args)
-                                st.write(f"Tool Response: {tool_response}")
-                                st.session_state.messages.append(
-                                    {
-                                        "tool_call_id": tool_call.id,
-                                        "role": "ipython",
-                                        "content": tool_response,
-                                        "name": function_name,
-                                    }
-                                )
-                                status.update(
-                                    label=f"Running {function_name}... Done!",
-                                    state="complete",
-                                    expanded=False,
-                                )
-                        stream = client.chat.completions.create(
-                            model=MODEL, messages=st.session_state.messages, stream=True
-                        )
-                        response = st.write_stream(stream)
-                        st.session_state.messages.append(
-                            {"role": "assistant", "content": response}
-                        )
-                    else:
-                        st.write(response_message.content)
-                        st.session_state.messages.append(
-                            {"role": "assistant", "content": response_message.content}
+                # Text is shown as it streams, tool calls are assembled from their deltas
+                tool_calls = {}
+                stream = create_completion(
+                    model=MODEL, messages=messages, tools=tools, tool_choice="auto"
+                )
+                response = st.write_stream(stream_text(stream, tool_calls))
+                if tool_calls:
+                    tool_calls = [tool_calls[index] for index in sorted(tool_calls)]
+                    with st.status("Thinking...", expanded=True) as status:
+                        calls = [
+                            (tool_call["name"], json.loads(tool_call["arguments"]))
+                            for tool_call in tool_calls
+                        ]
+                        for function_name, args in calls:
+                            st.write(f"Calling {function_name}... with args: {args}")
+                        # The calls of a turn are independent and run concurrently
+                        results = tool_runtime.run(calls)
+                        for tool_call, result in zip(tool_calls, results):
+                            st.write(f"Tool Response: {result.content}")
+                            st.session_state.messages.append(
+                                {
+                                    "tool_call_id": tool_call["id"],
+                                    "role": "ipython",
+                                    "content": result.content,
+                                    "name": result.name,
+                                }
+                            )
+                        names = ", ".join(name for name, _ in calls)
+                        status.update(
+                            label=f"Running {names}... Done!",
+                            state="complete",
+                            expanded=False,
                         )
+                    stream = create_completion(
+                        model=MODEL, messages=st.session_state.messages
+                    )
+                    response = st.write_stream(stream)
+                st.session_state.messages.append(
+                    {"role": "assistant", "content": response}
+                )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,86 @@
+"""
+Measure LlamaVisionAPI throughput (requests/sec) at different batch sizes.
+
+Runs the decode_request -> batch -> predict path in-process, the same way litserve does
+when `max_batch_size` is set, so no server or network overhead is included.
+
+    python -m bench.batching --batch-sizes 1 4 8 --requests 32 --image receipt.jpg
+    python -m bench.batching --backend stub --requests 32 --image receipt.jpg
+"""
+
+import argparse
+import json
+import time
+
+import torch
+from litserve.specs.openai import ChatCompletionRequest
+
+from src.api.backends import BACKENDS
+from src.api.llama_vision import LlamaVisionAPI
+from src.config import BACKEND, MODEL
+from src.ui.utils import encode_image
+
+
+def build_requests(num_requests, image_path, max_tokens):
+    content = [{"type": "text", "text": "Describe this image in detail."}]
+    if image_path:
+        content.insert(0, encode_image(image_path))
+    return [
+        ChatCompletionRequest(
+            model=MODEL,
+            messages=[{"role": "user", "content": content}],
+            max_tokens=max_tokens,
+            temperature=0.7,
+        )
+        for _ in range(num_requests)
+    ]
+
+
+def run(api, requests, batch_size):
+    api.max_batch_size = batch_size
+    completion_chars = 0
+    t0 = time.perf_counter()
+    for i in range(0, len(requests), batch_size):
+        chunk = requests[i : i + batch_size]
+        contexts = [{} for _ in chunk]
+        inputs = [api.decode_request(r, ctx) for r, ctx in zip(chunk, contexts)]
+        if batch_size > 1:
+            outputs = api.predict(api.batch(inputs, contexts), contexts)
+            completion_chars += sum(len("".join(step)) for step in outputs)
+        else:
+            outputs = api.predict(inputs[0], contexts[0])
+            completion_chars += len("".join(outputs))
+    elapsed = time.perf_counter() - t0
+    return {
+        "batch_size": batch_size,
+        "requests": len(requests),
+        "seconds": round(elapsed, 3),
+        "requests_per_sec": round(len(requests) / elapsed, 3),
+        "completion_chars": completion_chars,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--max-tokens", type=int, default=128)
+    parser.add_argument("--image", default=None, help="Optional image to attach")
+    parser.add_argument(
+        "--backend",
+        choices=sorted(BACKENDS),
+        default=BACKEND,
+        help="'stub' measures the serving pipeline without model compute",
+    )
+    args = parser.parse_args()
+
+    api = LlamaVisionAPI(
+        backend=args.backend, max_decode_batch_size=max(args.batch_sizes)
+    )
+    api.setup("cuda" if torch.cuda.is_available() else "cpu")
+    requests = build_requests(args.requests, args.image, args.max_tokens)
+
+    # Warm up kernels and allocator before timing
+    run(api, requests[: max(args.batch_sizes)], max(args.batch_sizes))
+    for batch_size in args.batch_sizes:
+        print(json.dumps(run(api, requests, batch_size)))
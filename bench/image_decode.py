@@ -0,0 +1,86 @@
+"""
+Compare image preprocessing latency and peak memory: full decode + resize versus
+reduced-scale JPEG decoding (`draft` + `reduce`).
+
+Besides the bundled sample images, a 12MP phone-sized copy of each is generated, since
+reduced-scale decoding pays off most on large photos. Every case runs in a fresh process
+so its peak RSS can be measured.
+
+    python -m bench.image_decode --repeats 10
+"""
+
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+from PIL import Image
+
+from src.image_policy import fit_image, target_size
+
+
+def full_decode(path):
+    # The previous `read_image` + `process_image` path, to the same size
+    image = Image.open(path).convert("RGB")
+    size = target_size(*image.size)
+    if size != image.size:
+        image = image.resize(size)
+    return image
+
+
+def draft_decode(path):
+    return fit_image(Image.open(path))
+
+
+PATHS = {"full_decode": full_decode, "draft_decode": draft_decode}
+
+
+def measure(name, path, repeats, results):
+    fn = PATHS[name]
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        image = fn(path)
+        times.append(time.perf_counter() - t0)
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put(
+        {
+            "path": name,
+            "image": os.path.basename(path),
+            "output_size": image.size,
+            "median_ms": round(sorted(times)[len(times) // 2] * 1000, 2),
+            # ru_maxrss is in KiB on Linux
+            "peak_rss_delta_mb": round((rss_after - rss_before) / 1024, 1),
+        }
+    )
+
+
+def phone_sized_copy(path, directory):
+    out = os.path.join(directory, "12mp-" + os.path.basename(path))
+    Image.open(path).convert("RGB").resize((3024, 4032)).save(out, quality=90)
+    return out
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--images", nargs="+", default=sorted(glob.glob("*.jpg")))
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as directory:
+        images = args.images + [phone_sized_copy(p, directory) for p in args.images]
+        for path in images:
+            for name in PATHS:
+                results = ctx.Queue()
+                process = ctx.Process(
+                    target=measure, args=(name, path, args.repeats, results)
+                )
+                process.start()
+                print(json.dumps(results.get()))
+                process.join()
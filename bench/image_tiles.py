@@ -0,0 +1,83 @@
+"""
+Compare the cost of turning decoded images into the model's pixel values: the Mllama
+processor (`processor(images, text)`, as the server called it before) versus `ImageTiler`
+tiling each image in one pass, without and with its tile cache (an image resent in a
+later turn of a chat) and with a reused pixel values buffer.
+
+Images are decoded as the server reads them (`fit_image`) and processed with the model's
+tile size and tile count; the processor's tokenizer is the stub's, so text costs little.
+Also reports the largest difference between the two outputs' pixel values.
+
+    python -m bench.image_tiles --repeats 20 --batch-size 4
+"""
+
+import argparse
+import glob
+import json
+import os
+import time
+
+import numpy as np
+from PIL import Image
+from transformers import MllamaImageProcessor
+
+from src.api.image_tiles import ImageTiler
+from src.api.stub import stub_processor
+from src.config import IMAGE_MAX_TILES, IMAGE_TILE_SIZE
+from src.image_policy import fit_image
+
+
+def median_ms(fn, repeats):
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return round(sorted(times)[len(times) // 2] * 1000, 2)
+
+
+def measure(path, args, processor):
+    image = fit_image(Image.open(path))
+    image.info["cache_key"] = path
+    images = [[image] for _ in range(args.batch_size)]
+    text = ["<|image|>What is in this image?"] * args.batch_size
+
+    cold = ImageTiler(processor.image_processor, max_bytes=0)
+    warm = ImageTiler(processor.image_processor)
+    reused = ImageTiler(processor.image_processor, reuse_buffer=True)
+    reference = processor(images=images, text=text, return_tensors="np")
+
+    return {
+        "image": os.path.basename(path),
+        "size": image.size,
+        "batch_size": args.batch_size,
+        "processor_ms": median_ms(
+            lambda: processor(images=images, text=text, return_tensors="np"),
+            args.repeats,
+        ),
+        "tiler_cold_ms": median_ms(lambda: cold(images), args.repeats),
+        "tiler_cached_ms": median_ms(lambda: warm(images), args.repeats),
+        "tiler_cached_reused_buffer_ms": median_ms(
+            lambda: reused(images), args.repeats
+        ),
+        "max_abs_diff": float(
+            np.abs(warm(images)["pixel_values"] - reference["pixel_values"]).max()
+        ),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--images", nargs="+", default=sorted(glob.glob("*.jpg")))
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=4)
+    args = parser.parse_args()
+
+    processor = stub_processor()
+    # The stub's image processor has the library defaults, use the model's settings
+    processor.image_processor = MllamaImageProcessor(
+        size={"height": IMAGE_TILE_SIZE, "width": IMAGE_TILE_SIZE},
+        max_image_tiles=IMAGE_MAX_TILES,
+    )
+    for path in args.images:
+        print(json.dumps(measure(path, args, processor)))
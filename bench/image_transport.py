@@ -0,0 +1,114 @@
+"""
+Compare the request size and server decode time of sending images as base64 data URLs,
+as raw file parts of a multipart request, and as ids of images uploaded once.
+
+For each sample image, prepared as the app sends it, reports the size of a chat request
+carrying it each way and, over several turns of a chat resending it, the bytes sent in
+total. Decode time covers parsing the JSON request and reading the image with
+`read_image` from the data URL, the raw bytes and the image store.
+
+    python -m bench.image_transport --repeats 20 --turns 10
+"""
+
+import argparse
+import glob
+import json
+import os
+import tempfile
+import time
+
+import requests
+from litserve.specs.openai import ChatCompletionRequest
+
+
+def chat_request(url):
+    return {
+        "model": "bench",
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "image_url", "image_url": {"url": url}},
+                    {"type": "text", "text": "What is in this image?"},
+                ],
+            }
+        ],
+    }
+
+
+def multipart_body(data):
+    request = chat_request("attachment://image")
+    return (
+        requests.Request(
+            "POST",
+            "http://localhost/v1/chat/completions/multipart",
+            data={"request": json.dumps(request)},
+            files={"image": ("image.jpg", data, "image/jpeg")},
+        )
+        .prepare()
+        .body
+    )
+
+
+def median_ms(fn, repeats):
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return round(sorted(times)[len(times) // 2] * 1000, 3)
+
+
+def measure(path, args):
+    from src.api.image_store import image_store
+    from src.api.utils import read_image
+    from src.ui.utils import data_url_object, prepare_image
+
+    with open(path, "rb") as f:
+        data = prepare_image(f)
+    data_url = data_url_object(data)["image_url"]["url"]
+    image_id = image_store.put(data)
+
+    base64_body = json.dumps(chat_request(data_url))
+    id_body = json.dumps(chat_request(image_id))
+    multipart = multipart_body(data)
+
+    def decode_base64():
+        request = ChatCompletionRequest.model_validate_json(base64_body)
+        read_image(request.messages[0].content[0].image_url.url)
+
+    def decode_bytes():
+        ChatCompletionRequest.model_validate_json(id_body)
+        read_image(data)
+
+    def decode_store():
+        request = ChatCompletionRequest.model_validate_json(id_body)
+        read_image(request.messages[0].content[0].image_url.url)
+
+    return {
+        "image": os.path.basename(path),
+        "image_bytes": len(data),
+        "base64_request_bytes": len(base64_body),
+        "multipart_request_bytes": len(multipart),
+        "id_request_bytes": len(id_body),
+        f"base64_{args.turns}_turns_bytes": len(base64_body) * args.turns,
+        f"upload_then_id_{args.turns}_turns_bytes": len(data)
+        + len(id_body) * args.turns,
+        "base64_decode_ms": median_ms(decode_base64, args.repeats),
+        "raw_bytes_decode_ms": median_ms(decode_bytes, args.repeats),
+        "image_store_decode_ms": median_ms(decode_store, args.repeats),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--images", nargs="+", default=sorted(glob.glob("*.jpg")))
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        # Read by src.config, keeps the benchmark's uploads out of the server's store
+        os.environ["IMAGE_STORE_DIR"] = directory
+        for path in args.images:
+            print(json.dumps(measure(path, args)))
@@ -0,0 +1,124 @@
+"""
+Measure the per-token cost of constraining output to a JSON schema.
+
+Replays JSON documents matching a receipt schema token by token through a `JSONGrammar`,
+masking a row of logits and advancing the grammar state at each token. The first pass
+compiles the states it reaches (cold), later passes hit the cache (warm). The cost of
+sampling a token from the same logits is reported for comparison.
+
+    python -m bench.json_grammar --documents 50
+    python -m bench.json_grammar --tokenizer stub
+"""
+
+import argparse
+import json
+import random
+import time
+
+import torch
+from transformers import AutoTokenizer
+
+from bench.prompt_lookup import SCHEMA
+from src.api.json_grammar import JSONGrammar, TokenVocabulary
+from src.api.scheduler import sample_next_tokens
+from src.api.stub import stub_processor
+from src.config import MODEL
+
+
+def build_documents(num_documents, seed):
+    rng = random.Random(seed)
+    words = "chai tea chang beer aniseed syrup cajun seasoning olive oil".split()
+    documents = []
+    for i in range(num_documents):
+        items = [
+            {
+                "description": " ".join(rng.sample(words, 2)).title(),
+                "quantity": rng.randint(1, 9),
+                "price": round(rng.uniform(1, 100), 2),
+            }
+            for _ in range(rng.randint(1, 6))
+        ]
+        documents.append(
+            {
+                "merchant": f"Northwind Traders {i}",
+                "date": f"2024-03-{rng.randint(1, 28):02d}",
+                "items": items,
+                "total": round(sum(item["price"] for item in items), 2),
+                "currency": "USD",
+            }
+        )
+    return documents
+
+
+def replay(grammar, token_ids, logits, eos_token_id):
+    """Mask and advance through each token, returning the seconds per token."""
+    state = grammar.initial_state
+    token_ids = [*token_ids, eos_token_id]
+    synchronize(logits)
+    t0 = time.perf_counter()
+    for token_id in token_ids:
+        grammar.forced_token(state)
+        grammar.constrain(state, logits)
+        state = grammar.advance(state, token_id)
+        if state is None:
+            raise ValueError("Document doesn't match the grammar")
+    synchronize(logits)
+    return (time.perf_counter() - t0) / len(token_ids)
+
+
+def synchronize(tensor):
+    if tensor.is_cuda:
+        torch.cuda.synchronize(tensor.device)
+
+
+def main(args):
+    if args.tokenizer == "stub":
+        tokenizer = stub_processor().tokenizer
+    else:
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    t0 = time.perf_counter()
+    vocabulary = TokenVocabulary(tokenizer)
+    vocabulary_seconds = time.perf_counter() - t0
+    grammar = JSONGrammar(SCHEMA, vocabulary)
+    documents = [
+        tokenizer.encode(json.dumps(document), add_special_tokens=False)
+        for document in build_documents(args.documents, args.seed)
+    ]
+    logits = torch.randn(len(tokenizer), device=device)
+
+    cold = [replay(grammar, ids, logits, tokenizer.eos_token_id) for ids in documents]
+    warm = [replay(grammar, ids, logits, tokenizer.eos_token_id) for ids in documents]
+
+    synchronize(logits)
+    t0 = time.perf_counter()
+    for _ in range(args.samples):
+        sample_next_tokens(logits[None], [0.7], [0.9]).tolist()
+    sampling = (time.perf_counter() - t0) / args.samples
+
+    return {
+        "tokenizer": args.tokenizer,
+        "vocab_size": len(tokenizer),
+        "device": device,
+        "vocabulary_build_s": round(vocabulary_seconds, 3),
+        "documents": len(documents),
+        "tokens_per_document": round(sum(map(len, documents)) / len(documents), 1),
+        "states": len(grammar._entries),
+        "first_document_us_per_token": round(cold[0] * 1e6, 1),
+        "cold_us_per_token": round(sum(cold) / len(cold) * 1e6, 1),
+        "warm_us_per_token": round(sum(warm) / len(warm) * 1e6, 1),
+        "sampling_us_per_token": round(sampling * 1e6, 1),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--tokenizer", default=MODEL, help="Tokenizer to load, 'stub' for the stub's"
+    )
+    parser.add_argument("--documents", type=int, default=50)
+    parser.add_argument("--samples", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    print(json.dumps(main(args), indent=2))
@@ -0,0 +1,233 @@
+"""
+Load test the OpenAI-compatible server with a configurable mix of traffic.
+
+Requests are sent either by a fixed number of concurrent clients that each send the next
+request as soon as the previous one finishes (closed loop, `--concurrency`), or at a
+Poisson arrival rate regardless of how fast the server responds (open loop, `--rate`).
+Time to first token, inter-token latency, end-to-end latency, tokens/sec and error rate
+are reported as JSON, overall and per kind of request.
+
+Without a GPU, run it against the stub backend, which streams scripted tokens:
+
+    python server.py --backend stub --enable-async
+    python -m bench.load_test --requests 200 --concurrency 8
+    python -m bench.load_test --requests 200 --rate 5 --mix text=3,image=1,tools=1
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import defaultdict
+
+from openai import AsyncOpenAI
+
+from src.config import MODEL
+from src.tools import available_tools
+from src.ui.utils import encode_image
+
+KINDS = ("text", "image", "multi_image", "tools", "json", "multi_turn")
+IMAGES = ("receipt.jpg", "mountains.jpg", "cocktail-ingredients.jpg")
+
+JSON_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "answer",
+        "schema": {
+            "type": "object",
+            "properties": {"answer": {"type": "string"}},
+            "required": ["answer"],
+        },
+    },
+}
+
+
+def user_message(text, images=()):
+    return {"role": "user", "content": [*images, {"type": "text", "text": text}]}
+
+
+def build_request(kind, images, max_tokens, turns):
+    """Chat completion arguments for one request of the given kind."""
+    request = {"model": MODEL, "max_tokens": max_tokens, "stream": True}
+    if kind == "text":
+        request["messages"] = [user_message("Write a short poem about llamas.")]
+    elif kind == "image":
+        request["messages"] = [user_message("Describe this image.", images[:1])]
+    elif kind == "multi_image":
+        request["messages"] = [user_message("Compare these images.", images[:2])]
+    elif kind == "tools":
+        request["messages"] = [
+            {"role": "system", "content": "You are a helpful assistant."},
+            user_message("What are the top 5 papers on Hugging Face today?"),
+        ]
+        request["tools"] = available_tools
+    elif kind == "json":
+        request["messages"] = [
+            {"role": "system", "content": "You are a helpful assistant."},
+            user_message("What is the total on this receipt?", images[:1]),
+        ]
+        request["response_format"] = JSON_FORMAT
+    elif kind == "multi_turn":
+        messages = [user_message("Describe this image.", images[:1])]
+        for turn in range(turns):
+            messages.append(
+                {"role": "assistant", "content": f"Here is answer number {turn}. " * 20}
+            )
+            messages.append(user_message(f"Tell me more, part {turn + 1}."))
+        request["messages"] = messages
+    else:
+        raise ValueError(f"Unknown kind of request: {kind}")
+    return request
+
+
+def parse_mix(mix):
+    weights = {}
+    for item in mix.split(","):
+        kind, _, weight = item.partition("=")
+        if kind not in KINDS:
+            raise ValueError(
+                f"Unknown kind of request {kind!r}, expected one of {KINDS}"
+            )
+        weights[kind] = float(weight or 1)
+    return weights
+
+
+async def send(client, kind, request):
+    """Send one streaming request and return its timings, counting a chunk as a token."""
+    result = {"kind": kind, "error": None, "tokens": 0, "ttft": None, "itl": []}
+    start = time.perf_counter()
+    try:
+        last = None
+        stream = await client.chat.completions.create(**request)
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if not (delta.content or delta.tool_calls):
+                continue
+            now = time.perf_counter()
+            if last is None:
+                result["ttft"] = now - start
+            else:
+                result["itl"].append(now - last)
+            last = now
+            result["tokens"] += 1
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["latency"] = time.perf_counter() - start
+    return result
+
+
+async def closed_loop(client, requests, concurrency):
+    queue = list(reversed(requests))
+    results = []
+
+    async def worker():
+        while queue:
+            results.append(await send(client, *queue.pop()))
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return results
+
+
+async def open_loop(client, requests, rate, seed):
+    rng = random.Random(seed)
+    tasks = []
+    for request in requests:
+        tasks.append(asyncio.create_task(send(client, *request)))
+        await asyncio.sleep(rng.expovariate(rate))
+    return await asyncio.gather(*tasks)
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def pick(q):
+        return round(values[min(len(values) - 1, int(q * len(values)))], 4)
+
+    return {"p50": pick(0.5), "p95": pick(0.95), "p99": pick(0.99)}
+
+
+def summarize(results, elapsed):
+    ok = [r for r in results if r["error"] is None]
+    tokens = sum(r["tokens"] for r in ok)
+    return {
+        "requests": len(results),
+        "errors": len(results) - len(ok),
+        "error_rate": round((len(results) - len(ok)) / max(len(results), 1), 4),
+        "requests_per_sec": round(len(ok) / elapsed, 3),
+        "tokens_per_sec": round(tokens / elapsed, 3),
+        "ttft_s": percentiles([r["ttft"] for r in ok if r["ttft"] is not None]),
+        "inter_token_latency_s": percentiles([t for r in ok for t in r["itl"]]),
+        "latency_s": percentiles([r["latency"] for r in ok]),
+    }
+
+
+async def main(args):
+    images = [encode_image(path) for path in IMAGES]
+    weights = parse_mix(args.mix)
+    rng = random.Random(args.seed)
+    kinds = rng.choices(list(weights), weights=list(weights.values()), k=args.requests)
+    requests = [
+        (kind, build_request(kind, images, args.max_tokens, args.turns))
+        for kind in kinds
+    ]
+
+    client = AsyncOpenAI(
+        base_url=args.base_url, api_key="lit", timeout=args.timeout, max_retries=0
+    )
+    start = time.perf_counter()
+    if args.rate:
+        results = await open_loop(client, requests, args.rate, args.seed)
+    else:
+        results = await closed_loop(client, requests, args.concurrency)
+    elapsed = time.perf_counter() - start
+
+    by_kind = defaultdict(list)
+    for result in results:
+        by_kind[result["kind"]].append(result)
+    errors = sorted({r["error"] for r in results if r["error"]})
+    return {
+        "mode": "open_loop" if args.rate else "closed_loop",
+        "rate": args.rate,
+        "concurrency": None if args.rate else args.concurrency,
+        "seconds": round(elapsed, 3),
+        **summarize(results, elapsed),
+        "by_kind": {kind: summarize(rs, elapsed) for kind, rs in by_kind.items()},
+        "error_samples": errors[:5],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000/v1")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument(
+        "--concurrency", type=int, default=4, help="Concurrent clients (closed loop)"
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=None,
+        help="Requests/sec arriving at random (open loop), overrides --concurrency",
+    )
+    parser.add_argument(
+        "--mix",
+        default="text=3,image=2,multi_image=1,tools=1,json=1,multi_turn=1",
+        help="Comma-separated kind=weight pairs, kinds: " + ", ".join(KINDS),
+    )
+    parser.add_argument("--max-tokens", type=int, default=128)
+    parser.add_argument("--turns", type=int, default=8, help="Turns of multi_turn")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="Also write the report here")
+    args = parser.parse_args()
+
+    report = asyncio.run(main(args))
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
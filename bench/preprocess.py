@@ -0,0 +1,102 @@
+"""
+Measure how long decoding requests holds up the inference worker, decoding in the worker
+versus handing requests to a RequestPreprocessor pool of processes.
+
+Each request carries a distinct image (a shifted crop of a sample image), so no cache
+helps. Reports, per pool size, the time the worker's thread spends in decode_request
+per request (time the GPU loop can't run) and how many requests/sec are decoded. The
+processor is the stub's with the model's tile settings.
+
+    python -m bench.preprocess --requests 32 --workers 0 1 2 4
+"""
+
+import argparse
+import base64
+import json
+import time
+from io import BytesIO
+
+from litserve.specs.openai import ChatCompletionRequest
+from PIL import Image
+from transformers import MllamaImageProcessor
+
+from src.api.backends import StubBackend
+from src.api.image_tiles import ImageTiler
+from src.api.preprocess import RequestPreprocessor, prepare_prompt
+from src.config import IMAGE_MAX_TILES, IMAGE_TILE_SIZE
+
+
+class BenchBackend(StubBackend):
+    def load_processor(self):
+        processor = super().load_processor()
+        processor.image_processor = MllamaImageProcessor(
+            size={"height": IMAGE_TILE_SIZE, "width": IMAGE_TILE_SIZE},
+            max_image_tiles=IMAGE_MAX_TILES,
+        )
+        return processor
+
+
+def build_requests(num_requests, image_path):
+    image = Image.open(image_path).convert("RGB")
+    requests = []
+    for i in range(num_requests):
+        buffered = BytesIO()
+        image.crop((i, i, image.width, image.height)).save(buffered, format="JPEG")
+        url = "data:image/jpeg;base64," + base64.b64encode(buffered.getvalue()).decode()
+        requests.append(
+            ChatCompletionRequest(
+                model="bench",
+                messages=[
+                    {
+                        "role": "user",
+                        "content": [
+                            {"type": "image_url", "image_url": {"url": url}},
+                            {"type": "text", "text": "Describe this image in detail."},
+                        ],
+                    }
+                ],
+            )
+        )
+    return requests
+
+
+def run(requests, num_workers, backend):
+    blocked = 0.0
+    t0 = time.perf_counter()
+    if num_workers:
+        preprocessor = RequestPreprocessor(backend, num_workers, len(requests))
+        t0 = time.perf_counter()
+        pending = []
+        for request in requests:
+            t1 = time.perf_counter()
+            pending.append(preprocessor.submit(request))
+            blocked += time.perf_counter() - t1
+        for future in pending:
+            future.result()
+        elapsed = time.perf_counter() - t0
+        preprocessor.shutdown()
+    else:
+        processor = backend.load_processor()
+        image_tiler = ImageTiler(processor.image_processor)
+        t0 = time.perf_counter()
+        for request in requests:
+            prepare_prompt(processor, image_tiler, request)
+        elapsed = blocked = time.perf_counter() - t0
+    return {
+        "workers": num_workers,
+        "requests": len(requests),
+        "worker_blocked_ms_per_request": round(blocked / len(requests) * 1000, 2),
+        "requests_per_sec": round(len(requests) / elapsed, 2),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 1, 2, 4])
+    parser.add_argument("--image", default="receipt.jpg")
+    args = parser.parse_args()
+
+    requests = build_requests(args.requests, args.image)
+    for num_workers in args.workers:
+        print(json.dumps(run(requests, num_workers, BenchBackend())))
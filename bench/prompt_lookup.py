@@ -0,0 +1,152 @@
+"""
+Measure decode tokens/sec of JSON extraction requests with and without prompt lookup.
+
+Runs the decode_request -> predict path in-process on extraction prompts (a receipt
+image and a text invoice, each with a JSON schema) once per speculative decoding mode,
+and reports tokens/sec, the fraction of proposed tokens accepted and the tokens generated
+per forward pass.
+
+    python -m bench.prompt_lookup --requests 8 --max-tokens 256
+    python -m bench.prompt_lookup --modes false prompt_lookup draft --speculative draft
+"""
+
+import argparse
+import json
+import time
+from collections import defaultdict
+
+import torch
+from litserve.specs.openai import ChatCompletionRequest
+
+from src.api.backends import BACKENDS
+from src.api.llama_vision import SPECULATIVE_KEY, LlamaVisionAPI
+from src.config import BACKEND, MODEL
+from src.ui.utils import encode_image
+
+INVOICE = """\
+INVOICE #2024-0117
+Northwind Traders, 42 Harbour Road, Seattle, WA 98101
+Bill to: Contoso Ltd, 1 Microsoft Way, Redmond, WA 98052
+Date: 2024-03-14    Due: 2024-04-13
+
+Description                     Qty   Unit price   Amount
+Chai tea, 24 bags               3     18.00        54.00
+Chang beer, 12 bottles          2     19.00        38.00
+Aniseed syrup, 500 ml           5     10.00        50.00
+Chef Anton's Cajun seasoning    1     22.00        22.00
+
+Subtotal 164.00   Tax (10%) 16.40   Total 180.40 USD
+"""
+
+SCHEMA = {
+    "type": "object",
+    "properties": {
+        "merchant": {"type": "string"},
+        "date": {"type": "string"},
+        "items": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "description": {"type": "string"},
+                    "quantity": {"type": "number"},
+                    "price": {"type": "number"},
+                },
+            },
+        },
+        "total": {"type": "number"},
+        "currency": {"type": "string"},
+    },
+    "required": ["merchant", "date", "items", "total"],
+}
+
+
+def build_requests(num_requests, image_path, max_tokens):
+    response_format = {
+        "type": "json_schema",
+        "json_schema": {"name": "receipt", "schema": SCHEMA},
+    }
+    prompts = [
+        [
+            {"type": "text", "text": "Extract the details of this invoice.\n\n"},
+            {"type": "text", "text": INVOICE},
+        ],
+        [
+            encode_image(image_path),
+            {"type": "text", "text": "Extract the details of this receipt."},
+        ],
+    ]
+    return [
+        ChatCompletionRequest(
+            model=MODEL,
+            messages=[
+                {"role": "system", "content": "You are a helpful assistant."},
+                {"role": "user", "content": prompts[i % len(prompts)]},
+            ],
+            max_tokens=max_tokens,
+            response_format=response_format,
+        )
+        for i in range(num_requests)
+    ]
+
+
+def run(api, requests, mode):
+    logged = defaultdict(list)
+    api.log = lambda key, value: logged[key].append(value)
+    t0 = time.perf_counter()
+    for request in requests:
+        request.metadata = {SPECULATIVE_KEY: mode}
+        context = {}
+        for _ in api.predict(api.decode_request(request, context), context):
+            pass
+    elapsed = time.perf_counter() - t0
+
+    def mean(key):
+        values = logged[key]
+        return round(sum(values) / len(values), 3) if values else None
+
+    tokens = sum(logged["completion_tokens"])
+    return {
+        "mode": mode,
+        "requests": len(requests),
+        "seconds": round(elapsed, 3),
+        "completion_tokens": tokens,
+        "tokens_per_sec": round(tokens / elapsed, 3),
+        "decode_tokens_per_sec": mean("tokens_per_second"),
+        "acceptance_rate": mean("speculative_acceptance_rate"),
+        "tokens_per_step": mean("speculative_tokens_per_step"),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=8)
+    parser.add_argument("--max-tokens", type=int, default=256)
+    parser.add_argument("--image", default="receipt.jpg")
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        default=["false", "prompt_lookup"],
+        help="Speculative decoding modes to compare, 'false' decodes without drafts",
+    )
+    parser.add_argument(
+        "--speculative",
+        default=None,
+        help="Server mode, set to 'draft' to load the draft model for the 'draft' mode",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=sorted(BACKENDS),
+        default=BACKEND,
+        help="'stub' measures the serving pipeline without model compute",
+    )
+    args = parser.parse_args()
+
+    api = LlamaVisionAPI(backend=args.backend, speculative=args.speculative)
+    api.setup("cuda" if torch.cuda.is_available() else "cpu")
+    requests = build_requests(args.requests, args.image, args.max_tokens)
+
+    # Warm up kernels and allocator before timing
+    run(api, requests[:2], args.modes[0])
+    for mode in args.modes:
+        print(json.dumps(run(api, requests, mode)))
@@ -0,0 +1,77 @@
+"""
+Measure the per-token cost of detecting tool calls in streamed output.
+
+Compares re-parsing the whole output on every token (the previous behaviour of
+`encode_response`) with the incremental `ToolCallParser`, for outputs of growing length.
+
+    python -m bench.tool_parser --calls 1 8 32 128
+"""
+
+import argparse
+import json
+import time
+
+from src.tools.tool_utils import ToolCallParser, ToolUtils
+
+CHARS_PER_TOKEN = 4
+
+
+def build_output(fmt, num_calls):
+    if fmt == "python":
+        calls = ", ".join(
+            f"get_weather(city='City {i}', days={i % 7}, units='metric')"
+            for i in range(num_calls)
+        )
+        return f"[{calls}]"
+    args = {"query": "llama " * num_calls, "limit": num_calls}
+    if fmt == "function":
+        return f"<function=search>{json.dumps(args)}</function>"
+    return json.dumps({"type": "function", "name": "search", "parameters": args})
+
+
+def tokenize(text):
+    return [text[i : i + CHARS_PER_TOKEN] for i in range(0, len(text), CHARS_PER_TOKEN)]
+
+
+def reparse(tokens):
+    buffer = []
+    for token in tokens:
+        buffer.append(token)
+        ToolUtils.maybe_extract_custom_tool_calls("".join(buffer).strip())
+
+
+def incremental(tokens):
+    parser = ToolCallParser()
+    for token in tokens:
+        parser.feed(token)
+
+
+def time_per_token(fn, tokens, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fn(tokens)
+        best = min(best, time.perf_counter() - t0)
+    return best / len(tokens)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--calls", type=int, nargs="+", default=[1, 8, 32, 128])
+    parser.add_argument("--formats", nargs="+", default=["python", "json", "function"])
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    for fmt in args.formats:
+        for num_calls in args.calls:
+            tokens = tokenize(build_output(fmt, num_calls))
+            reparse_us = time_per_token(reparse, tokens, args.repeats) * 1e6
+            incremental_us = time_per_token(incremental, tokens, args.repeats) * 1e6
+            result = {
+                "format": fmt,
+                "calls": num_calls,
+                "tokens": len(tokens),
+                "reparse_us_per_token": round(reparse_us, 2),
+                "incremental_us_per_token": round(incremental_us, 2),
+            }
+            print(json.dumps(result))
@@ -0,0 +1,113 @@
+"""
+Measure the time of an assistant turn's tool calls, run one after another versus by the
+tool runtime (concurrently, then again from its cache).
+
+Serves a local stub of the Hugging Face daily papers API that answers after a delay, and
+points `get_top_hf_papers` at it, so no network access is needed. A turn calls it for
+several dates; one date is slower than the tool's timeout to show a call being abandoned.
+
+    python -m bench.tool_runtime --calls 4 --delay 0.5
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+STUB_HOST = "127.0.0.1"
+
+
+def stub_papers(date, count=30):
+    return [
+        {
+            "paper": {
+                "id": f"{date}.{i:05d}",
+                "title": f"Paper {i} of {date}",
+                "upvotes": (i * 37) % 101,
+                "authors": [{"name": f"Author {i}"}],
+                "publishedAt": f"{date}T00:00:00.000Z",
+                "summary": "A stub summary.",
+            },
+            "thumbnail": "",
+        }
+        for i in range(count)
+    ]
+
+
+def serve_stub(delay, slow_date, slow_delay):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            date = parse_qs(urlparse(self.path).query).get("date", [""])[0]
+            time.sleep(slow_delay if date == slow_date else delay)
+            body = json.dumps(stub_papers(date)).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((STUB_HOST, 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def timed(fn):
+    t0 = time.perf_counter()
+    results = fn()
+    return round(time.perf_counter() - t0, 3), results
+
+
+def main(args):
+    server = serve_stub(args.delay, "2024-01-01", args.slow_delay)
+    # Read by src.config when the tools are imported
+    os.environ["HF_PAPERS_API_URL"] = f"http://{STUB_HOST}:{server.server_port}/papers"
+    from src.tools import functions
+    from src.tools.runtime import ToolRuntime
+
+    calls = [
+        ("get_top_hf_papers", {"n": 3, "date": f"2024-02-{i + 1:02d}"})
+        for i in range(args.calls)
+    ]
+    slow_call = ("get_top_hf_papers", {"n": 3, "date": "2024-01-01"})
+    runtime = ToolRuntime(
+        functions, max_workers=args.calls + 1, timeout=args.timeout, timeouts={}
+    )
+
+    sequential, _ = timed(lambda: [functions[name](**a) for name, a in calls])
+    cold, results = timed(lambda: runtime.run(calls))
+    warm, cached = timed(lambda: runtime.run(calls))
+    with_slow, slow = timed(lambda: runtime.run([*calls[:1], slow_call]))
+    server.shutdown()
+
+    return {
+        "calls": len(calls),
+        "stub_delay_s": args.delay,
+        "sequential_s": sequential,
+        "concurrent_s": cold,
+        "cached_s": warm,
+        "cached_results": sum(r.cached for r in cached),
+        "errors": sum(r.error for r in results),
+        "with_slow_call_s": with_slow,
+        "slow_call_result": slow[-1].content,
+        **runtime.stats(),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--calls", type=int, default=4, help="Tool calls per turn")
+    parser.add_argument(
+        "--delay", type=float, default=0.5, help="Seconds the stub takes to answer"
+    )
+    parser.add_argument("--slow-delay", type=float, default=3.0)
+    parser.add_argument(
+        "--timeout", type=float, default=1.5, help="Seconds allowed per tool call"
+    )
+    args = parser.parse_args()
+    print(json.dumps(main(args), indent=2))
@@ -1,11 +1,14 @@
 import argparse
+import json
+
 from src.api import client
-from src.ui.utils import encode_image
+from src.tools import available_tools
+from src.ui.utils import image_object, stream_text
 from src.config import MODEL
 
 
-def send_generate_request(image_path, prompt):
-    encoded_image_object = encode_image(image_path)
+def send_generate_request(image_path, prompt, tools=False):
+    encoded_image_object = image_object(image_path)
     stream = client.chat.completions.create(
         model=MODEL,
         messages=[
@@ -19,11 +22,14 @@ def send_generate_request(image_path, prompt):
         ],
         max_tokens=512,
         stream=True,
+        **({"tools": available_tools, "tool_choice": "auto"} if tools else {}),
     )
-    for chunk in stream:
-        print(
-            f"\033[92m{chunk.choices[0].delta.content or ''}\033[0m", end="", flush=True
-        )
+    tool_calls = {}
+    for text in stream_text(stream, tool_calls):
+        print(f"\033[92m{text}\033[0m", end="", flush=True)
+    for index in sorted(tool_calls):
+        call = tool_calls[index]
+        print(f"\nTool call: {call['name']}({json.loads(call['arguments'])})")
 
 
 if __name__ == "__main__":
@@ -32,6 +38,9 @@ if __name__ == "__main__":
     )
     parser.add_argument("--image", required=True, help="Path for the image file")
     parser.add_argument("--prompt", required=True, help="Prompt about the image")
+    parser.add_argument(
+        "--tools", action="store_true", help="Let the model call the app's tools"
+    )
     args = parser.parse_args()
 
-    send_generate_request(args.image, args.prompt)
+    send_generate_request(args.image, args.prompt, args.tools)
@@ -1,43 +1,147 @@
-import time
-import litserve as ls
-from src.api.llama_vision import LlamaVisionAPI
-
-
-class ResponseLogger(ls.Logger):
-    def __init__(self):
-        super().__init__()
-        # TODO: setup prometheus client
+import argparse
+import glob
+import os
 
-    def process(self, key, value):
-        if key == "input_text":
-            print(f"Input text: {value}")
+import litserve as ls
+from src.api.backends import BACKENDS
+from src.api.cancellation import CancellableOpenAISpec, CancellationRegistry
+from src.api.image_store import add_image_endpoints
+from src.api.llama_vision import AsyncLlamaVisionAPI, LlamaVisionAPI
+from src.api.utils import generate_metrics_dir
+from src.config import (
+    AGENT,
+    BACKEND,
+    DRAFT_MODEL,
+    NUM_DRAFT_TOKENS,
+    PREPROCESS_MAX_PENDING,
+    PREPROCESS_WORKERS,
+    SPECULATIVE,
+    STUB_TOKENS_PER_SECOND,
+)
 
-        if key == "output_text":
-            print(value, end="", flush=True)
+# Must be set before prometheus_client is imported by src.api.metrics
+metrics_dir = generate_metrics_dir()
 
-        if key == "inference_time":
-            print(f"Inference time: {value:.3f} seconds")
+from src.api.metrics import MetricsLogger, metrics_app  # noqa: E402
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve Llama 3.2 Vision with LitServe."
+    )
+    parser.add_argument(
+        "--max-batch-size",
+        type=int,
+        default=1,
+        help="Maximum number of requests processed together in one batch",
+    )
+    parser.add_argument(
+        "--batch-timeout",
+        type=float,
+        default=0.05,
+        help="Seconds to wait for a batch to fill up before processing it",
+    )
+    parser.add_argument(
+        "--workers-per-device",
+        type=int,
+        default=1,
+        help="Number of worker processes per device",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=sorted(BACKENDS),
+        default=BACKEND,
+        help="Model backend, 'stub' streams scripted tokens on the CPU for load testing",
+    )
+    parser.add_argument(
+        "--stub-tokens-per-second",
+        type=float,
+        default=STUB_TOKENS_PER_SECOND,
+        help="Rate at which the stub backend streams tokens",
+    )
+    parser.add_argument(
+        "--enable-async",
+        action="store_true",
+        help="Serve many requests per worker at once, joining one continuous batch",
+    )
+    parser.add_argument(
+        "--speculative",
+        choices=["draft", "prompt_lookup"],
+        default=SPECULATIVE,
+        help="Speculative decoding, 'draft' verifies tokens proposed by --draft-model, "
+        "'prompt_lookup' tokens copied from the prompt (default for JSON mode)",
+    )
+    parser.add_argument(
+        "--draft-model",
+        default=DRAFT_MODEL,
+        help="Small text-only model sharing the model's tokenizer",
+    )
+    parser.add_argument(
+        "--num-draft-tokens",
+        type=int,
+        default=NUM_DRAFT_TOKENS,
+        help="Draft tokens proposed per decode step",
+    )
+    parser.add_argument(
+        "--agent",
+        action="store_true",
+        default=AGENT,
+        help="Run calls of the server's own tools and continue generating after them",
+    )
+    parser.add_argument(
+        "--preprocess-workers",
+        type=int,
+        default=PREPROCESS_WORKERS,
+        help="Processes decoding requests beside each inference worker, 0 decodes "
+        "them in the inference worker",
+    )
+    parser.add_argument(
+        "--preprocess-max-pending",
+        type=int,
+        default=PREPROCESS_MAX_PENDING,
+        help="Most requests queued or being decoded per inference worker, more wait",
+    )
+    args = parser.parse_args()
 
-class PredictionTimeMonitor(ls.Callback):
-    def on_before_predict(self, lit_api):
-        t0 = time.perf_counter()
-        self._start_time = t0
+    # Drop samples left over from a previous run
+    for path in glob.glob(os.path.join(metrics_dir, "*.db")):
+        os.remove(path)
 
-    def on_after_predict(self, lit_api):
-        t1 = time.perf_counter()
-        elapsed = t1 - self._start_time
-        lit_api.log("inference_time", elapsed)
+    logger = MetricsLogger()
+    logger.mount(path="/metrics", app=metrics_app())
 
+    if args.backend == "stub":
+        backend = BACKENDS["stub"](tokens_per_second=args.stub_tokens_per_second)
+    else:
+        backend = BACKENDS[args.backend](draft_model_id=args.draft_model)
+    # Lets workers stop generating for clients that disconnected
+    cancellation = CancellationRegistry()
+    api_class = AsyncLlamaVisionAPI if args.enable_async else LlamaVisionAPI
+    api = api_class(
+        backend=backend,
+        max_decode_batch_size=max(args.max_batch_size, 8),
+        cancellation=cancellation,
+        speculative=args.speculative,
+        num_draft_tokens=args.num_draft_tokens,
+        agent=args.agent,
+        preprocess_workers=args.preprocess_workers,
+        preprocess_max_pending=args.preprocess_max_pending,
+    )
+    if args.enable_async:
+        # Requests are batched by the generation scheduler instead of litserve
+        args.max_batch_size = 1
 
-if __name__ == "__main__":
-    api = LlamaVisionAPI()
+    spec = CancellableOpenAISpec(cancellation)
+    # Images are uploaded once and referenced by id in later turns
+    add_image_endpoints(spec)
 
     server = ls.LitServer(
         api,
-        spec=ls.OpenAISpec(),
-        callbacks=[PredictionTimeMonitor()],
-        loggers=ResponseLogger(),
+        accelerator=backend.accelerator,
+        workers_per_device=args.workers_per_device,
+        spec=spec,
+        loggers=logger,
         timeout=60,
+        max_batch_size=args.max_batch_size,
+        batch_timeout=args.batch_timeout,
     )
     server.run(port=8000, generate_client_file=False)
@@ -0,0 +1,87 @@
+import torch
+from transformers import (
+    AutoModelForCausalLM,
+    AutoProcessor,
+    BitsAndBytesConfig,
+    MllamaForConditionalGeneration,
+)
+
+from src.api.engine import MllamaEngine
+from src.api.stub import ScriptedEngine, stub_processor
+from src.config import (
+    DRAFT_MODEL,
+    MODEL,
+    STUB_TIME_TO_FIRST_TOKEN,
+    STUB_TOKENS_PER_SECOND,
+)
+
+
+class HFBackend:
+    """Llama 3.2 Vision from the Hugging Face Hub, quantized to 4 bits."""
+
+    accelerator = "auto"
+
+    def __init__(self, model_id: str = MODEL, draft_model_id: str = DRAFT_MODEL):
+        self.model_id = model_id
+        self.draft_model_id = draft_model_id
+
+    def load_processor(self):
+        return AutoProcessor.from_pretrained(self.model_id)
+
+    def load_engine(self, processor, device, prefix_cache=None, vision_cache=None):
+        quantization_config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=torch.bfloat16,
+        )
+        model = MllamaForConditionalGeneration.from_pretrained(
+            self.model_id,
+            torch_dtype=torch.bfloat16,
+            device_map=device,
+            quantization_config=quantization_config,
+        ).to(device)
+        return MllamaEngine(
+            model, device, prefix_cache=prefix_cache, vision_cache=vision_cache
+        )
+
+    def load_draft_model(self, device):
+        return AutoModelForCausalLM.from_pretrained(
+            self.draft_model_id, torch_dtype=torch.bfloat16, device_map=device
+        ).eval()
+
+
+class StubBackend:
+    """
+    Scripted tokens at a fixed rate on the CPU, with a processor built locally, so the
+    serving pipeline runs without a GPU or model download.
+    """
+
+    accelerator = "cpu"
+
+    def __init__(
+        self,
+        tokens_per_second: float = STUB_TOKENS_PER_SECOND,
+        time_to_first_token: float = STUB_TIME_TO_FIRST_TOKEN,
+    ):
+        self.model_id = "stub"
+        self.tokens_per_second = tokens_per_second
+        self.time_to_first_token = time_to_first_token
+
+    def load_processor(self):
+        return stub_processor()
+
+    def load_engine(self, processor, device, prefix_cache=None, vision_cache=None):
+        return ScriptedEngine(
+            processor.tokenizer,
+            tokens_per_second=self.tokens_per_second,
+            time_to_first_token=self.time_to_first_token,
+        )
+
+    def load_draft_model(self, device):
+        raise ValueError("The stub backend has no draft model")
+
+
+BACKENDS = {
+    "hf": HFBackend,
+    "stub": StubBackend,
+}
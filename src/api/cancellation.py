@@ -0,0 +1,98 @@
+import json
+import multiprocessing
+import time
+import uuid
+
+import litserve as ls
+from fastapi import BackgroundTasks, HTTPException
+from litserve.specs.openai import ChatCompletionRequest
+from litserve.utils import LitAPIStatus
+
+REQUEST_ID_KEY = "request_id"
+# Key of the output a LitAPI sends for one request of a batch that failed on its own,
+# {REQUEST_ERROR_KEY: {"status_code": ..., "detail": ...}}
+REQUEST_ERROR_KEY = "request_error"
+# Cancellations nobody picked up, e.g. for requests that had already finished, are
+# forgotten after this many seconds
+CANCELLATION_TTL = 600
+
+
+class CancellationRegistry:
+    """
+    Ids of requests whose client went away, shared between the API server processes,
+    which notice disconnects, and the inference workers, which generate the responses.
+
+    Must be created in the main process, before the server starts its processes.
+    """
+
+    def __init__(self):
+        self._manager = multiprocessing.Manager()
+        self._cancelled = self._manager.dict()
+
+    def __getstate__(self):
+        # The manager itself stays in the main process, the dict proxy is shared
+        return {"_cancelled": self._cancelled}
+
+    def cancel(self, request_id: str):
+        now = time.time()
+        self._cancelled[request_id] = now
+        for key, cancelled_at in list(self._cancelled.items()):
+            if now - cancelled_at > CANCELLATION_TTL:
+                self._cancelled.pop(key, None)
+
+    def is_cancelled(self, request_id: str) -> bool:
+        return request_id in self._cancelled
+
+    def discard(self, request_id: str):
+        self._cancelled.pop(request_id, None)
+
+
+class CancellableOpenAISpec(ls.OpenAISpec):
+    """
+    OpenAISpec that tags each request with an id, passed to the LitAPI in its metadata,
+    and records the id in `registry` when a streaming client disconnects before the end.
+
+    Errors the LitAPI sends as a request's output (see `REQUEST_ERROR_KEY`) are raised
+    for that request alone, where litserve fails a whole batch on an exception.
+    """
+
+    def __init__(self, registry: CancellationRegistry):
+        super().__init__()
+        self.registry = registry
+
+    async def chat_completion(
+        self, request: ChatCompletionRequest, background_tasks: BackgroundTasks
+    ):
+        request.metadata = {
+            **(request.metadata or {}),
+            REQUEST_ID_KEY: uuid.uuid4().hex,
+        }
+        return await super().chat_completion(request, background_tasks)
+
+    async def get_from_queues(self, uids) -> list:
+        return [
+            _raise_request_error(pipe) for pipe in await super().get_from_queues(uids)
+        ]
+
+    async def streaming_completion(
+        self, request: ChatCompletionRequest, pipe_responses: list
+    ):
+        finished = False
+        try:
+            async for chunk in super().streaming_completion(request, pipe_responses):
+                yield chunk
+            finished = True
+        finally:
+            if not finished:
+                self.registry.cancel(request.metadata[REQUEST_ID_KEY])
+
+
+async def _raise_request_error(pipe):
+    """Pass a request's (response, status) pairs on, turning its error output into one."""
+    async for response, status in pipe:
+        if status == LitAPIStatus.OK and REQUEST_ERROR_KEY in response:
+            error = json.loads(response).get(REQUEST_ERROR_KEY)
+            if error is not None:
+                yield HTTPException(**error), LitAPIStatus.ERROR
+                return
+        yield response, status
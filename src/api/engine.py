@@ -0,0 +1,502 @@
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import torch
+import torch.nn.functional as F
+from transformers import DynamicCache
+
+from src.api.prefix_cache import PrefixCache, PrefixEntry
+from src.api.vision_cache import VisionCache
+
+
+@dataclass
+class SequenceState:
+    """
+    KV cache and masks of a single sequence, batch dimension of size 1.
+
+    `attention_mask` and `cross_attention_mask` cover every token in the cache, so they
+    grow by one position per decode step.
+    """
+
+    cache: DynamicCache
+    attention_mask: torch.Tensor
+    cross_attention_mask: Optional[torch.Tensor]
+    cross_len: int = 0
+    cohort: Optional["_Cohort"] = None
+    # Prompt token ids without padding, kept on CPU for the prefix cache
+    token_ids: Optional[torch.Tensor] = None
+
+
+@dataclass
+class _Cohort:
+    """Sequences decoded together in one batched forward pass, left-padded to a common length."""
+
+    requests: List = field(default_factory=list)
+    cache: Optional[DynamicCache] = None
+    attention_mask: Optional[torch.Tensor] = None
+    cross_attention_mask: Optional[torch.Tensor] = None
+
+
+def _new_cache(keys: List, values: List, seen_tokens: int) -> DynamicCache:
+    cache = DynamicCache()
+    cache.key_cache = keys
+    cache.value_cache = values
+    cache._seen_tokens = seen_tokens
+    return cache
+
+
+class MllamaEngine:
+    """
+    Step-wise execution of `MllamaForConditionalGeneration` for the `GenerationScheduler`.
+
+    Each sequence owns its KV cache between steps. Sequences with the same number of
+    cross-attention (image) tokens are merged into a cohort and decoded as one batch; the
+    cohort is only rebuilt when its membership changes.
+
+    With a `PrefixCache`, finished sequences leave their KV states behind so that the next
+    turn of the same conversation only prefills the tokens it adds. With a `VisionCache`,
+    the vision tower only runs for images it hasn't seen before.
+    """
+
+    def __init__(
+        self,
+        model,
+        device,
+        prefix_cache: Optional[PrefixCache] = None,
+        vision_cache: Optional[VisionCache] = None,
+    ):
+        self.model = model
+        self.device = device
+        self.prefix_cache = prefix_cache
+        self.vision_cache = vision_cache
+        self.cross_attention_layers = set(
+            model.config.text_config.cross_attention_layers
+        )
+        self._cohorts: Dict[int, _Cohort] = {}
+
+    @torch.inference_mode()
+    def prefill(self, requests) -> List[torch.Tensor]:
+        logits = {}
+        # Requests coming from one processor call share their (padded) inputs
+        groups: Dict[int, List] = {}
+        for request in requests:
+            if self.prefix_cache is not None and request.cache_key is not None:
+                inputs = self._row_inputs(request)
+                entry, prefix_len = self.prefix_cache.lookup(
+                    request.cache_key, inputs["input_ids"][0].cpu()
+                )
+                if entry is not None:
+                    logits[id(request)] = self._prefill_suffix(
+                        request, inputs, entry, prefix_len
+                    )
+                    continue
+            groups.setdefault(id(request.inputs), []).append(request)
+
+        for members in groups.values():
+            inputs = members[0].inputs
+            rows = [request.row for request in members]
+            if rows != list(range(len(inputs["input_ids"]))):
+                inputs = {key: value[rows] for key, value in inputs.items()}
+            logits.update(zip(map(id, members), self._prefill(members, inputs)))
+        return [logits[id(request)] for request in requests]
+
+    def _prefill(self, requests, inputs) -> torch.Tensor:
+        inputs = dict(inputs)
+        if "pixel_values" in inputs:
+            inputs["cross_attention_states"] = self._encode_images(
+                requests,
+                inputs.pop("pixel_values"),
+                inputs.pop("aspect_ratio_ids"),
+                inputs.pop("aspect_ratio_mask"),
+            )
+        attention_mask = inputs["attention_mask"]
+        seq_len = attention_mask.shape[-1]
+        position_ids = (attention_mask.long().cumsum(-1) - 1).clamp(min=0)
+
+        outputs = self.model(
+            **inputs,
+            position_ids=position_ids,
+            cache_position=torch.arange(seq_len, device=self.device),
+            past_key_values=DynamicCache(),
+            use_cache=True,
+            num_logits_to_keep=1,
+        )
+        cache = outputs.past_key_values
+        cohort = _Cohort(
+            requests=list(requests),
+            cache=cache,
+            attention_mask=attention_mask,
+            cross_attention_mask=inputs.get("cross_attention_mask"),
+        )
+        cross_len = self._cross_len(cache)
+        for row, request in enumerate(requests):
+            request.inputs = None
+            request.state = SequenceState(
+                cache=None,
+                attention_mask=None,
+                cross_attention_mask=None,
+                cross_len=cross_len,
+                token_ids=inputs["input_ids"][row][attention_mask[row].bool()].cpu(),
+            )
+            request.prompt_tokens = len(request.state.token_ids)
+            request.prompt_ids = request.state.token_ids.tolist()
+        # Give every sequence its own cache without the batch's left padding
+        self._split(cohort)
+        return outputs.logits[:, -1]
+
+    def _encode_images(
+        self, requests, pixel_values, aspect_ratio_ids, aspect_ratio_mask
+    ) -> torch.Tensor:
+        """
+        Compute the cross-attention states for a batch of images, taking the states of
+        already seen images from the vision cache and encoding the rest in one call.
+        """
+        batch_size, max_images = pixel_values.shape[:2]
+        states = [[None] * max_images for _ in range(batch_size)]
+        missing = []
+        for row, request in enumerate(requests):
+            keys = request.image_keys
+            for index in range(max_images):
+                if keys is not None and index >= len(keys):
+                    continue  # padding image, masked out by the cross-attention mask
+                key = keys[index] if keys is not None else None
+                if key and self.vision_cache is not None:
+                    states[row][index] = self.vision_cache.get(key)
+                if states[row][index] is None:
+                    missing.append((row, index, key))
+
+        if missing:
+            rows, indices, keys = zip(*missing)
+            rows, indices = list(rows), list(indices)
+            t0 = time.perf_counter()
+            encoded = self._vision_tower(
+                pixel_values[rows, indices][:, None],
+                aspect_ratio_ids[rows, indices][:, None],
+                aspect_ratio_mask[rows, indices][:, None],
+            )
+            if self.vision_cache is not None:
+                if encoded.is_cuda:
+                    torch.cuda.synchronize(encoded.device)
+                self.vision_cache.record_encode(len(missing), time.perf_counter() - t0)
+            for row, index, key, image_states in zip(rows, indices, keys, encoded):
+                states[row][index] = image_states
+                if key and self.vision_cache is not None:
+                    self.vision_cache.put(key, image_states)
+
+        template = next(s for row_states in states for s in row_states if s is not None)
+        return torch.cat(
+            [
+                s if s is not None else torch.zeros_like(template)
+                for row_states in states
+                for s in row_states
+            ]
+        )
+
+    def _vision_tower(self, pixel_values, aspect_ratio_ids, aspect_ratio_mask):
+        """Run the vision model and projector, returning (images, tiles, patches, hidden)."""
+        vision_outputs = self.model.vision_model(
+            pixel_values=pixel_values,
+            aspect_ratio_ids=aspect_ratio_ids,
+            aspect_ratio_mask=aspect_ratio_mask,
+        )
+        states = self.model.multi_modal_projector(vision_outputs[0])
+        return states.reshape(-1, *states.shape[2:])
+
+    def _prefill_suffix(self, request, inputs, entry: PrefixEntry, prefix_len: int):
+        """Prefill only the tokens after `prefix_len`, on top of a cached prefix."""
+        keys, values = [], []
+        for layer_idx, (k, v) in enumerate(zip(entry.keys, entry.values)):
+            if not len(k) or layer_idx in self.cross_attention_layers:
+                keys.append(k)
+                values.append(v)
+            else:
+                keys.append(k[..., :prefix_len, :])
+                values.append(v[..., :prefix_len, :])
+
+        seq_len = inputs["input_ids"].shape[-1]
+        positions = torch.arange(prefix_len, seq_len, device=self.device)
+        outputs = self.model(
+            input_ids=inputs["input_ids"][:, prefix_len:],
+            attention_mask=inputs["attention_mask"],
+            cross_attention_mask=inputs.get("cross_attention_mask"),
+            position_ids=positions[None],
+            cache_position=positions,
+            past_key_values=_new_cache(keys, values, prefix_len),
+            use_cache=True,
+            num_logits_to_keep=1,
+        )
+        cache = outputs.past_key_values
+        request.inputs = None
+        request.state = SequenceState(
+            cache=cache,
+            attention_mask=inputs["attention_mask"],
+            cross_attention_mask=inputs.get("cross_attention_mask"),
+            cross_len=self._cross_len(cache),
+            token_ids=inputs["input_ids"][0].cpu(),
+        )
+        request.prompt_tokens = len(request.state.token_ids)
+        request.prompt_ids = request.state.token_ids.tolist()
+        return outputs.logits[0, -1]
+
+    def _row_inputs(self, request) -> Dict[str, torch.Tensor]:
+        """A request's row of its (batched) inputs, without padding tokens or padded images."""
+        row, inputs = request.row, request.inputs
+        keep = inputs["attention_mask"][row].bool()
+        row_inputs = {
+            "input_ids": inputs["input_ids"][row : row + 1, keep],
+            "attention_mask": inputs["attention_mask"][row : row + 1, keep],
+        }
+        cross_attention_mask = inputs.get("cross_attention_mask")
+        if cross_attention_mask is not None:
+            cross_attention_mask = cross_attention_mask[row : row + 1, keep]
+            num_images = int(cross_attention_mask.flatten(0, 1).any(-1).any(0).sum())
+            row_inputs["cross_attention_mask"] = cross_attention_mask[:, :, :num_images]
+        return row_inputs
+
+    @torch.inference_mode()
+    def decode(self, requests, tokens: List[int]) -> List[torch.Tensor]:
+        groups: Dict[int, List] = {}
+        for request, token in zip(requests, tokens):
+            groups.setdefault(request.state.cross_len, []).append((request, token))
+
+        logits = {}
+        for cross_len, members in groups.items():
+            cohort = self._cohort(cross_len, [request for request, _ in members])
+            input_ids = torch.tensor(
+                [[token] for _, token in members], device=self.device
+            )
+            logits.update(zip(map(id, cohort.requests), self._step(cohort, input_ids)))
+
+        for cross_len in list(self._cohorts):
+            if cross_len not in groups:
+                self._split(self._cohorts.pop(cross_len))
+        return [logits[id(request)] for request in requests]
+
+    @torch.inference_mode()
+    def verify(self, request, tokens: List[int]) -> torch.Tensor:
+        """Feed several tokens to one sequence in one forward pass, return the logits after each."""
+        state = request.state
+        if state.cohort is not None:
+            self._leave_cohort(state.cohort)
+        seq_len = state.attention_mask.shape[-1]
+        attention_mask = F.pad(state.attention_mask, (0, len(tokens)), value=1)
+        cross_attention_mask = state.cross_attention_mask
+        if cross_attention_mask is not None:
+            cross_attention_mask = torch.cat(
+                [
+                    cross_attention_mask,
+                    cross_attention_mask[:, -1:].expand(-1, len(tokens), -1, -1),
+                ],
+                dim=1,
+            )
+
+        positions = torch.arange(seq_len, seq_len + len(tokens), device=self.device)
+        outputs = self.model(
+            input_ids=torch.tensor([tokens], device=self.device),
+            attention_mask=attention_mask,
+            cross_attention_mask=cross_attention_mask,
+            position_ids=positions[None],
+            cache_position=positions,
+            past_key_values=state.cache,
+            use_cache=True,
+        )
+        state.cache = outputs.past_key_values
+        state.attention_mask = attention_mask
+        state.cross_attention_mask = cross_attention_mask
+        return outputs.logits[0]
+
+    def rewind(self, request, num_tokens: int):
+        """Drop the last `num_tokens` fed to a sequence by `verify`, e.g. rejected drafts."""
+        if not num_tokens:
+            return
+        state = request.state
+        seq_len = state.attention_mask.shape[-1] - num_tokens
+        cache = state.cache
+        for layer_idx, (k, v) in enumerate(zip(cache.key_cache, cache.value_cache)):
+            if len(k) and layer_idx not in self.cross_attention_layers:
+                cache.key_cache[layer_idx] = k[..., :seq_len, :]
+                cache.value_cache[layer_idx] = v[..., :seq_len, :]
+        cache._seen_tokens = seq_len
+        state.attention_mask = state.attention_mask[:, :seq_len]
+        if state.cross_attention_mask is not None:
+            state.cross_attention_mask = state.cross_attention_mask[:, :seq_len]
+
+    def _leave_cohort(self, cohort: _Cohort):
+        """Split a cohort so that its members can be stepped on their own."""
+        self._split(cohort)
+        for cross_len, other in list(self._cohorts.items()):
+            if other is cohort:
+                del self._cohorts[cross_len]
+
+    def release(self, request, reusable: bool = True):
+        # The cohort notices the missing member on the next step and is rebuilt without it
+        state, request.state = request.state, None
+        if (
+            not reusable
+            or self.prefix_cache is None
+            or request.cache_key is None
+            or state is None
+            or state.token_ids is None
+        ):
+            return
+
+        if state.cohort is not None:
+            row = state.cohort.requests.index(request)
+            cache, _, cross_attention_mask = self._row(state.cohort, row)
+        else:
+            cache, cross_attention_mask = state.cache, state.cross_attention_mask
+        # The last sampled token was never fed to the model
+        token_ids = torch.cat(
+            [state.token_ids, torch.tensor(request.output_ids[:-1], dtype=torch.long)]
+        )
+        if cache.get_seq_length() != len(token_ids):
+            return
+        self.prefix_cache.insert(
+            request.cache_key,
+            self._prefix_entry(token_ids, cache, cross_attention_mask),
+        )
+
+    def _prefix_entry(self, token_ids, cache, cross_attention_mask) -> PrefixEntry:
+        """Copy a sequence's cache for the prefix cache, dropping padded image slots."""
+        cross_keep = None
+        if cross_attention_mask is not None:
+            used_images = cross_attention_mask.flatten(0, 1).any(-1).any(0)
+            cross_keep = (
+                self._cross_len(cache) // len(used_images) * int(used_images.sum())
+            )
+
+        keys, values = [], []
+        for layer_idx, (k, v) in enumerate(zip(cache.key_cache, cache.value_cache)):
+            if not len(k):
+                keys.append([])
+                values.append([])
+            elif layer_idx in self.cross_attention_layers:
+                keys.append(k[:, :, :cross_keep].clone())
+                values.append(v[:, :, :cross_keep].clone())
+            else:
+                keys.append(k.clone())
+                values.append(v.clone())
+        return PrefixEntry(token_ids=token_ids, keys=keys, values=values)
+
+    def _step(self, cohort: _Cohort, input_ids: torch.Tensor) -> torch.Tensor:
+        seq_len = cohort.attention_mask.shape[-1]
+        attention_mask = F.pad(cohort.attention_mask, (0, 1), value=1)
+        cross_attention_mask = cohort.cross_attention_mask
+        if cross_attention_mask is not None:
+            cross_attention_mask = torch.cat(
+                [cross_attention_mask, cross_attention_mask[:, -1:]], dim=1
+            )
+
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            cross_attention_mask=cross_attention_mask,
+            position_ids=cohort.attention_mask.sum(-1, keepdim=True),
+            cache_position=torch.tensor([seq_len], device=self.device),
+            past_key_values=cohort.cache,
+            use_cache=True,
+        )
+        cohort.cache = outputs.past_key_values
+        cohort.attention_mask = attention_mask
+        cohort.cross_attention_mask = cross_attention_mask
+        return outputs.logits[:, -1]
+
+    def _cohort(self, cross_len: int, requests: List) -> _Cohort:
+        cohort = self._cohorts.get(cross_len)
+        if cohort is not None and [id(r) for r in cohort.requests] == [
+            id(r) for r in requests
+        ]:
+            return cohort
+
+        if cohort is not None:
+            self._split(cohort)
+        cohort = self._merge(requests)
+        self._cohorts[cross_len] = cohort
+        return cohort
+
+    def _cross_len(self, cache: DynamicCache) -> int:
+        for layer_idx in self.cross_attention_layers:
+            if layer_idx < len(cache.key_cache) and len(cache.key_cache[layer_idx]):
+                return cache.key_cache[layer_idx].shape[-2]
+        return 0
+
+    def _row(self, cohort: _Cohort, row: int):
+        """Views of one member's cache and masks, with the cohort's left padding removed."""
+        seq_len = cohort.attention_mask.shape[-1]
+        pad = seq_len - int(cohort.attention_mask[row].sum())
+        keys, values = [], []
+        for layer_idx, (k, v) in enumerate(
+            zip(cohort.cache.key_cache, cohort.cache.value_cache)
+        ):
+            if not len(k):
+                keys.append([])
+                values.append([])
+            elif layer_idx in self.cross_attention_layers:
+                keys.append(k[row : row + 1])
+                values.append(v[row : row + 1])
+            else:
+                keys.append(k[row : row + 1, :, pad:])
+                values.append(v[row : row + 1, :, pad:])
+
+        cross_attention_mask = cohort.cross_attention_mask
+        if cross_attention_mask is not None:
+            cross_attention_mask = cross_attention_mask[row : row + 1, pad:]
+        return (
+            _new_cache(keys, values, seq_len - pad),
+            cohort.attention_mask[row : row + 1, pad:],
+            cross_attention_mask,
+        )
+
+    def _split(self, cohort: _Cohort):
+        """Hand each remaining member its own cache, with the cohort's left padding removed."""
+        for row, request in enumerate(cohort.requests):
+            state = request.state
+            if state is None:
+                continue
+            state.cache, state.attention_mask, state.cross_attention_mask = self._row(
+                cohort, row
+            )
+            state.cohort = None
+
+    def _merge(self, requests: List) -> _Cohort:
+        """Left-pad the members' caches and masks to a common length and stack them."""
+        states = [request.state for request in requests]
+        for state in states:
+            if state.cohort is not None:
+                self._split(state.cohort)
+        seq_len = max(state.attention_mask.shape[-1] for state in states)
+
+        def stack(tensors: List[torch.Tensor], dim: int) -> torch.Tensor:
+            padded = []
+            for t in tensors:
+                pad = [0, 0] * (t.dim() - dim - 1) + [seq_len - t.shape[dim], 0]
+                padded.append(F.pad(t, pad))
+            return torch.cat(padded, dim=0)
+
+        keys, values = [], []
+        for layer_idx in range(len(states[0].cache.key_cache)):
+            layer_keys = [state.cache.key_cache[layer_idx] for state in states]
+            layer_values = [state.cache.value_cache[layer_idx] for state in states]
+            if not len(layer_keys[0]):
+                keys.append([])
+                values.append([])
+            elif layer_idx in self.cross_attention_layers:
+                keys.append(torch.cat(layer_keys, dim=0))
+                values.append(torch.cat(layer_values, dim=0))
+            else:
+                keys.append(stack(layer_keys, dim=2))
+                values.append(stack(layer_values, dim=2))
+
+        cohort = _Cohort(
+            requests=list(requests),
+            cache=_new_cache(keys, values, seq_len),
+            attention_mask=stack([state.attention_mask for state in states], dim=1),
+        )
+        if states[0].cross_attention_mask is not None:
+            cohort.cross_attention_mask = stack(
+                [state.cross_attention_mask for state in states], dim=1
+            )
+        for state in states:
+            state.cohort = cohort
+        return cohort
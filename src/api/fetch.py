@@ -0,0 +1,89 @@
+import asyncio
+import concurrent.futures
+import time
+from typing import Callable, Iterable, List
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from src.config import IMAGE_FETCH_MAX_BYTES, IMAGE_FETCH_TIMEOUT, IMAGE_FETCH_WORKERS
+
+CHUNK_SIZE = 64 * 1024
+
+
+class ImageFetcher:
+    """
+    Process-wide layer for downloading images.
+
+    Downloads share one session, so connections to the same host are kept alive and
+    reused, and run on a bounded pool of workers instead of a new pool per request.
+    Every download is limited in time and size, so a slow or huge image fails fast
+    instead of stalling the worker.
+
+    Parameters:
+    max_workers (int): Number of concurrent downloads, also the connection pool size per host.
+    timeout (float): Seconds allowed to connect and to download the whole body.
+    max_bytes (int): Largest accepted body.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = IMAGE_FETCH_WORKERS,
+        timeout: float = IMAGE_FETCH_TIMEOUT,
+        max_bytes: int = IMAGE_FETCH_MAX_BYTES,
+    ):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="image-fetch"
+        )
+
+    def fetch(self, url: str) -> bytes:
+        """Download `url`, raising if it is too large or takes longer than the timeout."""
+        deadline = time.monotonic() + self.timeout
+        with self.session.get(url, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            length = response.headers.get("Content-Length")
+            if length and int(length) > self.max_bytes:
+                raise ValueError(f"Image is {length} bytes, limit is {self.max_bytes}")
+
+            data = bytearray()
+            # read1 returns whatever has arrived, so the deadline is checked while
+            # a slow server trickles data instead of once per full chunk
+            while chunk := response.raw.read1(CHUNK_SIZE, decode_content=True):
+                data += chunk
+                if len(data) > self.max_bytes:
+                    raise ValueError(
+                        f"Image exceeds the limit of {self.max_bytes} bytes"
+                    )
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Downloading {url} took over {self.timeout}s")
+            return bytes(data)
+
+    def map(self, fn: Callable, items: Iterable) -> List:
+        """Apply `fn` to `items` concurrently on the shared workers, keeping their order."""
+        items = list(items)
+        if len(items) <= 1:
+            # Not worth a hand-off to another thread
+            return [fn(item) for item in items]
+        return list(self._executor.map(fn, items))
+
+    async def fetch_async(self, url: str) -> bytes:
+        """`fetch` for asyncio code, run on the shared workers."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.fetch, url)
+
+    async def map_async(self, fn: Callable, items: Iterable) -> List:
+        """`map` for asyncio code."""
+        loop = asyncio.get_running_loop()
+        return await asyncio.gather(
+            *(loop.run_in_executor(self._executor, fn, item) for item in items)
+        )
+
+
+# Shared by all requests handled by this process
+image_fetcher = ImageFetcher()
@@ -0,0 +1,222 @@
+import asyncio
+import functools
+import json
+import os
+import re
+import tempfile
+import threading
+from io import BytesIO
+
+from fastapi import BackgroundTasks, HTTPException, Request
+from litserve.specs.openai import ChatCompletionRequest
+from PIL import Image
+from pydantic import ValidationError
+from starlette.datastructures import UploadFile
+
+from src.api.cache import content_hash
+from src.config import IMAGE_FETCH_MAX_BYTES, IMAGE_STORE_DIR, IMAGE_STORE_MAX_BYTES
+
+# Images in the store are referenced in `image_url` parts as IMAGE_ID_PREFIX + SHA-256
+IMAGE_ID_PREFIX = "image://"
+IMAGE_ID_PATTERN = re.compile(r"^image://([0-9a-f]{64})$")
+# Multipart chat completions reference their file parts as ATTACHMENT_PREFIX + field name
+ATTACHMENT_PREFIX = "attachment://"
+
+
+def image_id(data) -> str:
+    """The id of an image in the store, from the bytes of its file."""
+    return IMAGE_ID_PREFIX + content_hash(data)
+
+
+class ImageStore:
+    """
+    Content-addressed store of uploaded image files, so a client sends an image once and
+    references it by id in every later turn instead of resending it as base64.
+
+    Files are kept on disk, shared by the HTTP server process, which stores uploads, and
+    the inference workers, which read them. Reading or re-uploading a file marks it as
+    recently used; the least recently used files are removed to stay within the budget.
+
+    Parameters:
+    directory (str): Directory holding the files, created if missing.
+    max_bytes (int): Size budget of the files.
+    """
+
+    def __init__(
+        self, directory: str = IMAGE_STORE_DIR, max_bytes: int = IMAGE_STORE_MAX_BYTES
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def put(self, data: bytes) -> str:
+        """Store an image file, returning its id. Raises ValueError if it isn't an image."""
+        try:
+            Image.open(BytesIO(data)).verify()
+        except Exception as e:
+            raise ValueError(f"Not an image: {e}") from e
+
+        key = image_id(data)
+        path = self._path(key)
+        with self._lock:
+            if os.path.exists(path):
+                os.utime(path)
+                return key
+            # Written aside and renamed, so readers never see a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            self._evict()
+        return key
+
+    def path(self, key: str) -> str:
+        """Path of a stored image file, raising KeyError if it isn't stored."""
+        path = self._path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            raise KeyError(f"Image {key} isn't stored, upload it again") from None
+        return path
+
+    def __contains__(self, key: str) -> bool:
+        try:
+            return os.path.exists(self._path(key))
+        except KeyError:
+            return False
+
+    def _path(self, key: str) -> str:
+        match = IMAGE_ID_PATTERN.match(key)
+        if match is None:
+            raise KeyError(f"Invalid image id: {key}")
+        return os.path.join(self.directory, match.group(1))
+
+    def _entries(self):
+        """(modification time, size, path) of the stored files."""
+        entries = []
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if entry.name.endswith(".tmp"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    # Removed by another process meanwhile
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def _evict(self):
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            total -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> dict:
+        entries = self._entries()
+        return {
+            "entries": len(entries),
+            "bytes": sum(size for _, size, _ in entries),
+            "max_bytes": self.max_bytes,
+        }
+
+
+image_store = ImageStore()
+
+
+async def upload_image(request: Request):
+    """Store the image file sent as the request body, returning its id."""
+    length = request.headers.get("Content-Length")
+    if length and int(length) > IMAGE_FETCH_MAX_BYTES:
+        raise HTTPException(
+            413, f"Image is {length} bytes, limit is {IMAGE_FETCH_MAX_BYTES}"
+        )
+    data = await request.body()
+    if len(data) > IMAGE_FETCH_MAX_BYTES:
+        raise HTTPException(413, f"Image is larger than {IMAGE_FETCH_MAX_BYTES} bytes")
+    try:
+        # Verifying and writing the file would block the event loop
+        key = await asyncio.to_thread(image_store.put, data)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    return {"id": key, "bytes": len(data)}
+
+
+async def get_image(sha256: str):
+    """Whether an image is stored, so clients can skip uploading it again."""
+    key = IMAGE_ID_PREFIX + sha256
+    if key not in image_store:
+        raise HTTPException(404, f"Image {key} isn't stored")
+    return {"id": key}
+
+
+async def chat_completion_with_attachments(
+    spec, request: Request, background_tasks: BackgroundTasks
+):
+    """
+    Endpoint for chat completions sent as multipart/form-data, with images as raw file
+    parts instead of base64 data URLs: the `request` field holds the JSON request, whose
+    `image_url`s reference file parts as ATTACHMENT_PREFIX + the part's field name.
+    The files are stored in the image store and the request is handled by `spec` with
+    their ids, like any other request.
+    """
+    form = await request.form()
+    try:
+        body = json.loads(form["request"])
+        messages = body.get("messages")
+    except (KeyError, ValueError, AttributeError):
+        raise HTTPException(400, "Expected the JSON request in a 'request' field")
+
+    ids = {}
+    for name, value in form.multi_items():
+        if not isinstance(value, UploadFile):
+            continue
+        if value.size is not None and value.size > IMAGE_FETCH_MAX_BYTES:
+            raise HTTPException(
+                413,
+                f"{name} is {value.size} bytes, limit is {IMAGE_FETCH_MAX_BYTES}",
+            )
+        try:
+            ids[name] = await asyncio.to_thread(image_store.put, await value.read())
+        except ValueError as e:
+            raise HTTPException(400, f"{name}: {e}")
+
+    # Malformed messages are left for the request's validation to report
+    for message in messages if isinstance(messages, list) else []:
+        content = message.get("content") if isinstance(message, dict) else None
+        for item in content if isinstance(content, list) else []:
+            image_url = item.get("image_url") if isinstance(item, dict) else None
+            url = image_url.get("url") if isinstance(image_url, dict) else None
+            if isinstance(url, str) and url.startswith(ATTACHMENT_PREFIX):
+                name = url[len(ATTACHMENT_PREFIX) :]
+                if name not in ids:
+                    raise HTTPException(400, f"No file part named {name}")
+                image_url["url"] = ids[name]
+
+    try:
+        chat_request = ChatCompletionRequest.model_validate(body)
+    except ValidationError as e:
+        raise HTTPException(422, e.errors(include_url=False, include_input=False))
+    return await spec.chat_completion(chat_request, background_tasks)
+
+
+def add_image_endpoints(spec):
+    """
+    Serve the image store on the spec's server: POST /v1/images, GET /v1/images/{sha256}
+    and multipart chat completions at POST /v1/chat/completions/multipart.
+    """
+    spec.add_endpoint("/v1/images", upload_image, ["POST"])
+    spec.add_endpoint("/v1/images/{sha256}", get_image, ["GET"])
+    spec.add_endpoint(
+        "/v1/chat/completions/multipart",
+        # A partial rather than a closure, the spec is pickled for the workers
+        functools.partial(chat_completion_with_attachments, spec),
+        ["POST"],
+    )
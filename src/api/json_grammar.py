@@ -0,0 +1,455 @@
+import json
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
+
+# Kinds of schema nodes
+_ANY, _OBJECT, _FREE_OBJECT, _ARRAY, _STRING, _NUMBER, _INTEGER, _LITERAL = range(8)
+
+_QUOTE, _BACKSLASH, _SPACE = ord('"'), ord("\\"), ord(" ")
+_ESCAPES = set(b'"\\/bfnrt')
+_HEX = set(b"0123456789abcdefABCDEF")
+_JSON_LITERALS = (b"true", b"false", b"null")
+# Number states in which a number may end
+_NUMBER_ENDS = {"zero", "int", "frac", "exp"}
+# Longest run of forced tokens followed before a state counts as free
+_MAX_FORCED_BYTES = 64
+# Separator between properties, between a name and its value, and the end of an object
+_JSON_OBJECT_SYNTAX = (b", ", b": ", b"}")
+
+
+class TokenVocabulary:
+    """
+    The bytes of every token of a tokenizer, arranged in a trie, to find the tokens allowed
+    in a state of a `JSONGrammar` without trying each token. Shared by all grammars.
+    """
+
+    def __init__(self, tokenizer):
+        self.size = len(tokenizer)
+        self.eos_token_id = tokenizer.eos_token_id
+        byte_decoder = {char: byte for byte, char in bytes_to_unicode().items()}
+        special_ids = set(tokenizer.all_special_ids) | set(
+            tokenizer.added_tokens_decoder
+        )
+
+        self.token_bytes: List[Optional[bytes]] = [None] * self.size
+        # Nodes are [children by byte, ids of the tokens ending here]
+        self.trie = [{}, []]
+        string_safe, self.string_exits = [], []
+        for token, token_id in tokenizer.get_vocab().items():
+            if token_id in special_ids or token_id >= self.size:
+                continue
+            if all(char in byte_decoder for char in token):
+                data = bytes(byte_decoder[char] for char in token)
+            else:
+                data = tokenizer.convert_tokens_to_string([token]).encode()
+            if not data:
+                continue
+            self.token_bytes[token_id] = data
+            node = self.trie
+            for byte in data:
+                node = node[0].setdefault(byte, [{}, []])
+            node[1].append(token_id)
+            if _QUOTE in data or _BACKSLASH in data:
+                self.string_exits.append(token_id)
+            elif min(data) >= 0x20:
+                string_safe.append(token_id)
+
+        # Tokens that can't leave a JSON string, allowed anywhere inside one
+        self.string_safe = torch.zeros(self.size, dtype=torch.bool)
+        self.string_safe[string_safe] = True
+
+
+@dataclass
+class _Entry:
+    # Ids of the allowed tokens, or a boolean mask over the vocabulary when there are many
+    allowed: torch.Tensor
+    is_mask: bool
+    # The token to emit without sampling, if the state allows only one continuation
+    forced: Optional[int]
+
+
+class JSONGrammar:
+    """
+    Token-level automaton accepting the JSON documents that match a JSON schema, or any
+    JSON object without one.
+
+    States are immutable stacks of frames, one per open value. The tokens allowed in a
+    state are computed the first time generation reaches it and cached, so the automaton
+    is only compiled for the states actually visited, once per schema.
+
+    Output is compact JSON with the separators of `json.dumps` and properties in schema
+    order. Schema features other than types, properties, required, items, enum and const
+    are not enforced, such values may be any JSON value.
+    """
+
+    # Spelling of true, false and null in values of any type, and the escapes of strings
+    _any_literals = _JSON_LITERALS
+    _escapes = _ESCAPES
+
+    def __init__(self, schema: Optional[dict], vocabulary: TokenVocabulary):
+        self.vocabulary = vocabulary
+        self._nodes: List[tuple] = []
+        self._any = self._add(_ANY)
+        self._entries: Dict[tuple, _Entry] = {}
+        self._transitions: Dict[Tuple[tuple, int], Optional[tuple]] = {}
+        self._key_options_cache: Dict[tuple, tuple] = {}
+        self.initial_state = self._start(schema)
+
+    def _start(self, schema) -> tuple:
+        root = self._compile(schema) if schema else self._add(_FREE_OBJECT)
+        return (("val", root),)
+
+    def _add(self, kind: int, *args) -> int:
+        self._nodes.append((kind, *args))
+        return len(self._nodes) - 1
+
+    def _compile(self, schema) -> int:
+        if not isinstance(schema, dict):
+            return self._any
+        if "const" in schema:
+            return self._literal([schema["const"]])
+        if "enum" in schema:
+            return self._literal(schema["enum"])
+        kind = schema.get("type")
+        if isinstance(kind, list):
+            kind = kind[0] if len(kind) == 1 else None
+        if kind == "object":
+            properties = schema.get("properties")
+            if not properties:
+                return self._add(_FREE_OBJECT)
+            required = set(schema.get("required", []))
+            return self._object(
+                [
+                    (json.dumps(name).encode(), value, name in required)
+                    for name, value in properties.items()
+                ],
+                _JSON_OBJECT_SYNTAX,
+            )
+        if kind == "array":
+            return self._add(_ARRAY, self._compile(schema.get("items")))
+        if kind == "string":
+            return self._add(_STRING)
+        if kind == "number":
+            return self._add(_NUMBER)
+        if kind == "integer":
+            return self._add(_INTEGER)
+        if kind == "boolean":
+            return self._literal([True, False])
+        if kind == "null":
+            return self._literal([None])
+        return self._any
+
+    def _object(self, properties, syntax: tuple) -> int:
+        """
+        An object node from its properties' (spelling in the output, schema, required)
+        and the separators of its `syntax`, which also ends it.
+        """
+        return self._add(
+            _OBJECT,
+            tuple(
+                (name, self._compile(value), required)
+                for name, value, required in properties
+            ),
+            syntax,
+        )
+
+    def _dumps(self, value) -> bytes:
+        return json.dumps(value).encode()
+
+    def _literal(self, values) -> int:
+        options = tuple(self._dumps(value) for value in values)
+        if any(a != b and b.startswith(a) for a in options for b in options):
+            # e.g. 1 and 10, telling them apart would need to look ahead
+            return self._any
+        return self._add(_LITERAL, options)
+
+    def _key_options(self, node: int, index: int, emitted: bool) -> tuple:
+        """Texts that may follow in an object: the next properties, or its end."""
+        key = (node, index, emitted)
+        options = self._key_options_cache.get(key)
+        if options is None:
+            options = []
+            _, properties, (separator, assign, end) = self._nodes[node]
+            for prop in range(index, len(properties)):
+                name, _, required = properties[prop]
+                options.append(((separator if emitted else b"") + name + assign, prop))
+                if required:
+                    break
+            else:
+                options.append((end, None))
+            options = self._key_options_cache[key] = tuple(options)
+        return options
+
+    def _step(self, state: tuple, byte: int) -> Optional[tuple]:
+        """The state after one more byte of output, None if the byte isn't allowed."""
+        while state:
+            frame, rest = state[-1], state[:-1]
+            kind = frame[0]
+
+            if kind == "str":
+                sub = frame[1]
+                if sub == 0:
+                    if byte == _QUOTE:
+                        return rest
+                    if byte == _BACKSLASH:
+                        return rest + (("str", -1),)
+                    return state if byte >= 0x20 else None
+                if sub == -1:
+                    if byte == ord("u"):
+                        return rest + (("str", 4),)
+                    return rest + (("str", 0),) if byte in self._escapes else None
+                # Hex digits of a \u escape left
+                return rest + (("str", sub - 1),) if byte in _HEX else None
+
+            if kind == "num":
+                _, integer, phase = frame
+                phase_after = _number_step(phase, byte, integer)
+                if phase_after is not None:
+                    return rest + (("num", integer, phase_after),)
+                if phase not in _NUMBER_ENDS:
+                    return None
+                # The number ended, the byte belongs to the enclosing value
+                state = rest
+                continue
+
+            if kind == "lit":
+                _, options, pos = frame
+                options = tuple(option for option in options if option[pos] == byte)
+                if not options:
+                    return None
+                if len(options) == 1 and len(options[0]) == pos + 1:
+                    return rest
+                return rest + (("lit", options, pos + 1),)
+
+            if kind == "key":
+                _, node, index, emitted, pos, alive = frame
+                options = self._key_options(node, index, emitted)
+                alive = tuple(
+                    i
+                    for i in (range(len(options)) if alive is None else alive)
+                    if options[i][0][pos] == byte
+                )
+                if not alive:
+                    return None
+                text, prop = options[alive[0]]
+                if len(alive) > 1 or len(text) > pos + 1:
+                    return rest + (("key", node, index, emitted, pos + 1, alive),)
+                if prop is None:
+                    return rest
+                value = self._nodes[node][1][prop][1]
+                return rest + (("key", node, prop + 1, True, 0, None), ("val", value))
+
+            if kind == "obj":
+                phase = frame[1]
+                if phase in ("open", "after") and byte == ord("}"):
+                    return rest
+                if phase in ("open", "next") and byte == _QUOTE:
+                    return rest + (("obj", "key"), ("str", 0))
+                if phase == "key" and byte == ord(":"):
+                    return rest + (("obj", "colon"),)
+                if phase == "colon" and byte == _SPACE:
+                    return rest + (("obj", "after"), ("val", self._any))
+                if phase == "after" and byte == ord(","):
+                    return rest + (("obj", "comma"),)
+                if phase == "comma" and byte == _SPACE:
+                    return rest + (("obj", "next"),)
+                return None
+
+            if kind == "arr":
+                _, item, phase = frame
+                if phase in ("open", "after") and byte == ord("]"):
+                    return rest
+                if phase == "after":
+                    return (
+                        rest + (("arr", item, "comma"),) if byte == ord(",") else None
+                    )
+                if phase == "comma":
+                    return rest + (("arr", item, "next"),) if byte == _SPACE else None
+                # The byte starts an item
+                state = rest + (("arr", item, "after"), ("val", item))
+                continue
+
+            if kind != "val":
+                state, consumed = self._step_frame(frame, rest, byte)
+                if consumed:
+                    return state
+                continue
+
+            # "val": a value of a node starts with this byte
+            node = self._nodes[frame[1]]
+            node_kind = node[0]
+            if node_kind == _ANY:
+                if byte == ord("{"):
+                    return rest + (("obj", "open"),)
+                if byte == ord("["):
+                    return rest + (("arr", self._any, "open"),)
+                if byte == _QUOTE:
+                    return rest + (("str", 0),)
+                if any(byte == option[0] for option in self._any_literals):
+                    state = rest + (("lit", self._any_literals, 0),)
+                else:
+                    state = rest + (("num", False, "start"),)
+            elif node_kind == _OBJECT:
+                if byte != ord("{"):
+                    return None
+                return rest + (("key", frame[1], 0, False, 0, None),)
+            elif node_kind == _FREE_OBJECT:
+                return rest + (("obj", "open"),) if byte == ord("{") else None
+            elif node_kind == _ARRAY:
+                return rest + (("arr", node[1], "open"),) if byte == ord("[") else None
+            elif node_kind == _STRING:
+                return rest + (("str", 0),) if byte == _QUOTE else None
+            elif node_kind == _LITERAL:
+                state = rest + (("lit", node[1], 0),)
+            else:
+                state = rest + (("num", node_kind == _INTEGER, "start"),)
+        # The document is complete
+        return None
+
+    def _step_frame(self, frame: tuple, rest: tuple, byte: int):
+        """
+        Step a frame of a subclass, returning the next state and whether the byte was
+        consumed. If it wasn't, the byte is stepped again from the returned state.
+        """
+        raise ValueError(f"Unknown grammar frame: {frame[0]}")
+
+    def _can_end(self, state: tuple) -> bool:
+        return not state or (
+            len(state) == 1 and state[0][0] == "num" and state[0][2] in _NUMBER_ENDS
+        )
+
+    def _feed(self, state: Optional[tuple], data: bytes) -> Optional[tuple]:
+        for byte in data:
+            state = self._step(state, byte)
+            if state is None:
+                return None
+        return state
+
+    def advance(self, state: tuple, token_id: int) -> Optional[tuple]:
+        """The state after a token, None if the token isn't allowed."""
+        key = (state, token_id)
+        if key not in self._transitions:
+            if token_id == self.vocabulary.eos_token_id:
+                next_state = state if self._can_end(state) else None
+            else:
+                data = self.vocabulary.token_bytes[token_id]
+                next_state = self._feed(state, data) if data else None
+            self._transitions[key] = next_state
+        return self._transitions[key]
+
+    def forced_token(self, state: tuple) -> Optional[int]:
+        """The token to emit next without sampling, if the grammar leaves no choice."""
+        return self._entry(state).forced
+
+    def constrain(self, state: tuple, logits: torch.Tensor) -> torch.Tensor:
+        """Logits of a single row with the tokens not allowed in `state` set to -inf."""
+        entry = self._entry(state)
+        if entry.allowed.device != logits.device:
+            entry.allowed = entry.allowed.to(logits.device)
+        if entry.is_mask:
+            size = min(len(entry.allowed), logits.shape[-1])
+            constrained = torch.full_like(logits, float("-inf"))
+            constrained[:size] = logits[:size].masked_fill(
+                ~entry.allowed[:size], float("-inf")
+            )
+            return constrained
+        constrained = torch.full_like(logits, float("-inf"))
+        constrained[entry.allowed] = logits[entry.allowed]
+        return constrained
+
+    def _entry(self, state: tuple) -> _Entry:
+        entry = self._entries.get(state)
+        if entry is None:
+            entry = self._entries[state] = self._compute(state)
+        return entry
+
+    def _compute(self, state: tuple) -> _Entry:
+        vocabulary = self.vocabulary
+        ids = [vocabulary.eos_token_id] if self._can_end(state) else []
+        mask = None
+        if state and state[-1] == ("str", 0):
+            # Inside a string only the tokens leaving it depend on the rest of the state
+            mask = vocabulary.string_safe.clone()
+            ids.extend(
+                token_id
+                for token_id in vocabulary.string_exits
+                if self._feed(state, vocabulary.token_bytes[token_id]) is not None
+            )
+        else:
+            ids.extend(self._allowed_ids(vocabulary.trie, state))
+
+        if mask is not None:
+            mask[ids] = True
+            return _Entry(allowed=mask, is_mask=True, forced=None)
+        return _Entry(
+            allowed=torch.tensor(sorted(ids), dtype=torch.long),
+            is_mask=False,
+            forced=self._forced(state),
+        )
+
+    def _allowed_ids(self, trie: list, state: tuple) -> List[int]:
+        """Ids of the tokens under a node of the vocabulary's trie allowed in `state`."""
+        ids = []
+        nodes = [(trie, state)]
+        while nodes:
+            node, node_state = nodes.pop()
+            for byte, child in node[0].items():
+                child_state = self._step(node_state, byte)
+                if child_state is None:
+                    continue
+                ids.extend(child[1])
+                if child[0]:
+                    nodes.append((child, child_state))
+        return ids
+
+    def _forced(self, state: tuple) -> Optional[int]:
+        """The longest token spelling the start of the only text that can follow."""
+        if not state:
+            return self.vocabulary.eos_token_id
+        forced = b""
+        while len(forced) < _MAX_FORCED_BYTES and not self._can_end(state):
+            allowed = [b for b in range(256) if self._step(state, b) is not None]
+            if len(allowed) != 1:
+                break
+            forced += bytes(allowed)
+            state = self._step(state, allowed[0])
+        if not forced:
+            return None
+
+        token_id, node = None, self.vocabulary.trie
+        for byte in forced:
+            node = node[0].get(byte)
+            if node is None:
+                break
+            if node[1]:
+                token_id = node[1][0]
+        return token_id
+
+
+def _number_step(phase: str, byte: int, integer: bool) -> Optional[str]:
+    """The next state of a JSON number, None if the byte doesn't continue it."""
+    digit = 0x30 <= byte <= 0x39
+    if phase in ("start", "minus"):
+        if phase == "start" and byte == ord("-"):
+            return "minus"
+        if byte == ord("0"):
+            return "zero"
+        return "int" if digit else None
+    if phase in ("zero", "int"):
+        if phase == "int" and digit:
+            return "int"
+        if integer:
+            return None
+        if byte == ord("."):
+            return "frac0"
+        return "exp0" if byte in b"eE" else None
+    if phase in ("frac0", "frac"):
+        if digit:
+            return "frac"
+        return "exp0" if phase == "frac" and byte in b"eE" else None
+    if phase == "exp0" and byte in b"+-":
+        return "exp_sign"
+    return "exp" if digit else None
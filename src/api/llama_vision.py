@@ -1,90 +1,635 @@
-from threading import Thread
+import asyncio
+import concurrent.futures
+import json
+import os
+import time
 
 import litserve as ls
-import torch
-from litserve.specs.openai import ChatCompletionRequest, ChatMessage
-from transformers import (
-    AutoProcessor,
-    BitsAndBytesConfig,
-    MllamaForConditionalGeneration,
-    TextIteratorStreamer,
+from fastapi import HTTPException
+from litserve.specs.openai import ChatCompletionRequest, ChatMessage, ToolChoice
+from transformers import BatchFeature
+from transformers.models.mllama.processing_mllama import (
+    convert_sparse_cross_attention_mask_to_dense,
+    get_cross_attention_token_mask,
 )
 
-from src.api.utils import parse_messages
-from src.config import MODEL
-from src.tools.tool_utils import ToolUtils
+from src.api.backends import BACKENDS
+from src.api.cache import LRUCache
+from src.api.cancellation import REQUEST_ERROR_KEY, REQUEST_ID_KEY
+from src.api.image_tiles import ImageTiler
+from src.api.json_grammar import JSONGrammar, TokenVocabulary
+from src.api.prefix_cache import PrefixCache
+from src.api.preprocess import (
+    RequestPreprocessor,
+    decoding_cache_stats,
+    prepare_prompt,
+)
+from src.api.prompt_cache import canonical_hash
+from src.api.scheduler import GenerationScheduler, IncrementalDetokenizer
+from src.api.speculative import DraftModelProposer, PromptLookupProposer
+from src.api.tool_grammar import ToolCallGrammar
+from src.api.vision_cache import VisionCache
+from src.config import (
+    AGENT,
+    AGENT_MAX_STEPS,
+    BACKEND,
+    CANCEL_CHECK_INTERVAL,
+    CONSTRAINED_JSON,
+    CONSTRAINED_TOOL_CALLS,
+    GENERATION_TIMEOUT,
+    JSON_GRAMMAR_CACHE_SIZE,
+    NUM_DRAFT_TOKENS,
+    NUM_LOOKUP_TOKENS,
+    PREFIX_CACHE_MAX_BYTES,
+    PREPROCESS_MAX_PENDING,
+    PREPROCESS_WORKERS,
+    PROMPT_LOOKUP_MAX_NGRAM,
+    SPECULATIVE,
+    VISION_CACHE_MAX_BYTES,
+)
+from src.tools import functions, tool_runtime
+from src.tools.tool_utils import ToolCallParser
+
+# Request metadata key to choose the speculative decoding mode of one request, "false"
+# turns it off
+SPECULATIVE_KEY = "speculative"
+# Request metadata key to turn agent mode on ("true") or off ("false") for one request
+AGENT_KEY = "agent"
 
 
 class LlamaVisionAPI(ls.LitAPI):
+    def __init__(
+        self,
+        backend=BACKEND,
+        max_decode_batch_size: int = 8,
+        prefix_cache_bytes: int = PREFIX_CACHE_MAX_BYTES,
+        vision_cache_bytes: int = VISION_CACHE_MAX_BYTES,
+        cancellation=None,
+        generation_timeout: float = GENERATION_TIMEOUT,
+        speculative=SPECULATIVE,
+        num_draft_tokens: int = NUM_DRAFT_TOKENS,
+        constrained_json: bool = CONSTRAINED_JSON,
+        constrained_tool_calls: bool = CONSTRAINED_TOOL_CALLS,
+        agent: bool = AGENT,
+        preprocess_workers: int = PREPROCESS_WORKERS,
+        preprocess_max_pending: int = PREPROCESS_MAX_PENDING,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        # A name from `BACKENDS` or a backend instance
+        self.backend = BACKENDS[backend]() if isinstance(backend, str) else backend
+        self.max_decode_batch_size = max_decode_batch_size
+        self.prefix_cache_bytes = prefix_cache_bytes
+        self.vision_cache_bytes = vision_cache_bytes
+        # CancellationRegistry shared with a CancellableOpenAISpec, if any
+        self.cancellation = cancellation
+        self.generation_timeout = generation_timeout
+        # None, or how draft tokens are proposed for speculative decoding: "draft" or
+        # "prompt_lookup". Requests with a response format use "prompt_lookup" if None.
+        self.speculative = speculative
+        self.num_draft_tokens = num_draft_tokens
+        self.constrained_json = constrained_json
+        self.constrained_tool_calls = constrained_tool_calls
+        # Run calls of the tools in `src.tools.functions` in the server, see `_call_tools`
+        self.agent = agent
+        # Processes decoding requests beside generation, see `RequestPreprocessor`
+        self.preprocess_workers = preprocess_workers
+        self.preprocess_max_pending = preprocess_max_pending
+
     def setup(self, device):
-        model_id = MODEL
-        quantization_config = BitsAndBytesConfig(
-            load_in_4bit=True,
-            bnb_4bit_quant_type="nf4",
-            bnb_4bit_compute_dtype=torch.bfloat16,
+        self.processor = self.backend.load_processor()
+        # Batched prompts are left-padded so generation continues from the last column
+        self.processor.tokenizer.padding_side = "left"
+        # Pixel values are copied to the GPU before the next batch is processed, so their
+        # buffer can be reused; async requests are decoded concurrently, in threads
+        self.image_tiler = ImageTiler(
+            self.processor.image_processor,
+            reuse_buffer=device != "cpu" and not self.enable_async,
+        )
+        self.preprocessor = (
+            RequestPreprocessor(
+                self.backend, self.preprocess_workers, self.preprocess_max_pending
+            )
+            if self.preprocess_workers
+            else None
+        )
+        self.prefix_cache = (
+            PrefixCache(self.prefix_cache_bytes) if self.prefix_cache_bytes else None
+        )
+        self.vision_cache = (
+            VisionCache(self.vision_cache_bytes) if self.vision_cache_bytes else None
         )
-        self.model = MllamaForConditionalGeneration.from_pretrained(
-            model_id,
-            torch_dtype=torch.bfloat16,
-            device_map=device,
-            quantization_config=quantization_config,
-        ).to(device)
-
-        self.processor = AutoProcessor.from_pretrained(model_id)
-        self.streamer = TextIteratorStreamer(
-            self.processor.tokenizer,
-            skip_prompt=True,
-            skip_special_tokens=True,
-            clean_up_tokenization_spaces=False,
+        if self.constrained_json or self.constrained_tool_calls:
+            self.vocabulary = TokenVocabulary(self.processor.tokenizer)
+            self.grammars = LRUCache(JSON_GRAMMAR_CACHE_SIZE, sizeof=lambda _: 1)
+        self.scheduler = GenerationScheduler(
+            self.backend.load_engine(
+                self.processor,
+                device,
+                prefix_cache=self.prefix_cache,
+                vision_cache=self.vision_cache,
+            ),
+            max_batch_size=self.max_decode_batch_size,
+            proposers=self._load_proposers(device),
         )
         self.device = device
-        self.model_id = model_id
+        self.model_id = self.backend.model_id
+
+    def _load_proposers(self, device):
+        proposers = {
+            "prompt_lookup": PromptLookupProposer(
+                num_tokens=NUM_LOOKUP_TOKENS, max_ngram=PROMPT_LOOKUP_MAX_NGRAM
+            )
+        }
+        if self.speculative == "draft":
+            proposers["draft"] = DraftModelProposer(
+                self.backend.load_draft_model(device),
+                device,
+                num_tokens=self.num_draft_tokens,
+                ignore_token_ids=[self.processor.image_token_id],
+            )
+        elif self.speculative not in (None, *proposers):
+            raise ValueError(f"Unknown speculative decoding mode: {self.speculative}")
+        return proposers
+
+    def _speculative_mode(self, request: ChatCompletionRequest):
+        mode = (request.metadata or {}).get(SPECULATIVE_KEY)
+        if mode is not None:
+            return None if mode.lower() == "false" else mode
+        if self.speculative is None and request.response_format is not None:
+            # Extraction outputs copy the schema's keys and the document's text
+            return "prompt_lookup"
+        return self.speculative
+
+    def _agent_mode(self, request: ChatCompletionRequest) -> bool:
+        if not request.tools or request.tool_choice == ToolChoice.none:
+            return False
+        agent = (request.metadata or {}).get(AGENT_KEY)
+        return self.agent if agent is None else agent.lower() == "true"
+
+    def _grammar(self, request: ChatCompletionRequest):
+        """
+        The compiled grammar of the request's tool calls or JSON response format, shared by
+        requests with the same tools or schema.
+        """
+        if request.tools and request.tool_choice != ToolChoice.none:
+            return self._tool_call_grammar(
+                request, allow_text=request.tool_choice == ToolChoice.auto
+            )
+
+        response_format = request.response_format
+        if not self.constrained_json or response_format is None:
+            return None
+        if response_format.type == "json_object":
+            schema = None
+        elif response_format.type == "json_schema":
+            schema = response_format.json_schema.schema_
+        else:
+            return None
+        return self._cached_grammar(
+            canonical_hash(schema), lambda: JSONGrammar(schema, self.vocabulary)
+        )
+
+    def _tool_call_grammar(self, request: ChatCompletionRequest, allow_text: bool):
+        if not self.constrained_tool_calls:
+            return None
+        functions = [
+            tool.function.model_dump(exclude_none=True) for tool in request.tools
+        ]
+        return self._cached_grammar(
+            canonical_hash("tools", functions, allow_text),
+            lambda: ToolCallGrammar(functions, self.vocabulary, allow_text),
+        )
+
+    def _cached_grammar(self, key: str, compile_grammar):
+        grammar = self.grammars.get(key)
+        if grammar is None:
+            grammar = compile_grammar()
+            self.grammars.put(key, grammar)
+        return grammar
 
     def decode_request(self, request: ChatCompletionRequest, context: dict):
+        metadata = request.metadata or {}
         context["generation_args"] = {
             "temperature": request.temperature or 0.7,
             "top_p": request.top_p or 0.9,
             "max_new_tokens": request.max_tokens or 2048,
+            "speculative": self._speculative_mode(request),
+            "grammar": self._grammar(request),
+            "pause_at_eos": self._agent_mode(request),
         }
         context["tool"] = request.tools is not None
+        context["stream"] = request.stream
+        context["received_at"] = time.perf_counter()
+        context["request_id"] = metadata.get(REQUEST_ID_KEY)
 
-        messages, images = parse_messages(request)
-        input_text = self.processor.apply_chat_template(
-            messages, add_generation_prompt=True
+        if context["generation_args"]["pause_at_eos"]:
+            # The conversation so far (see `_resolve`), extended with each round of calls
+            context["agent"] = {
+                "steps": 0,
+                "parser": ToolCallParser(),
+                "held": "",
+                # After tool results the model may answer, even if it had to call a tool
+                "grammar": self._tool_call_grammar(request, allow_text=True),
+            }
+        pending = self._preprocess(request)
+        if getattr(self, "max_batch_size", 1) > 1:
+            # Resolved and tensorized together with the rest of the batch in `batch`, so
+            # the batch's requests are decoded in parallel
+            return pending
+        return self._tensorize([self._resolve(pending, context)])[0]
+
+    def batch(self, inputs, context):
+        # A request that can't be decoded, e.g. for an unreadable image, fails on its own
+        # (see `_encode_output`) instead of failing the rest of its batch
+        prompts = {}
+        for index, (pending, ctx) in enumerate(zip(inputs, context)):
+            try:
+                prompts[index] = self._resolve(pending, ctx)
+            except HTTPException as error:
+                ctx["error"] = error
+        batch = [None] * len(inputs)
+        for index, prepared in zip(prompts, self._tensorize(list(prompts.values()))):
+            batch[index] = prepared
+        return batch
+
+    def _preprocess(self, request: ChatCompletionRequest) -> concurrent.futures.Future:
+        """Start decoding a request, in the preprocessor's pool if there is one."""
+        if self.preprocessor is not None:
+            return self.preprocessor.submit(request)
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(prepare_prompt(self.processor, self.image_tiler, request))
+        except Exception as error:
+            # Raised by `_resolve`, like the pool's errors
+            future.set_exception(error)
+        return future
+
+    def _resolve(self, pending: concurrent.futures.Future, context: dict):
+        """Wait for a request to be decoded, returning its prompt."""
+        messages, prompt = pending.result()
+        if prompt["images"]:
+            self.log(
+                "image_preprocess_time", time.perf_counter() - context["received_at"]
+            )
+        if "agent" in context:
+            context["agent"].update(messages=messages, text=prompt["text"])
+        return prompt
+
+    def _tensorize(self, prompts):
+        """
+        Run the processor once per group of prompts and return, for each prompt, its
+        (batched) inputs and row in them.
+
+        Text-only prompts and prompts with images are processed in separate groups since
+        the Mllama processor can't mix them; within a group the processor left-pads the
+        text and pads the ragged image dimensions.
+        """
+        prepared = [None] * len(prompts)
+        groups = {}
+        for index, prompt in enumerate(prompts):
+            groups.setdefault(prompt["images"] is not None, []).append(index)
+
+        for has_images, indices in groups.items():
+            images = [prompts[i]["images"] for i in indices] if has_images else None
+            inputs = self._process(images, [prompts[i] for i in indices]).to(
+                self.device
+            )
+            for row, index in enumerate(indices):
+                prepared[index] = {
+                    "inputs": inputs,
+                    "row": row,
+                    "cache_key": prompts[index]["cache_key"],
+                    "image_keys": prompts[index]["image_keys"],
+                }
+        return prepared
+
+    def _process(self, images, prompts):
+        """
+        Equivalent of `self.processor(images, texts, padding=True, return_tensors="pt")`
+        for prompts tokenized by `prepare_prompt`, processing images with `image_tiler`.
+        """
+        input_ids = [prompt["input_ids"] for prompt in prompts]
+        data = dict(
+            self.processor.tokenizer.pad({"input_ids": input_ids}, padding=True)
         )
-        self.log("input_text", input_text)
-        inputs = self.processor(images, input_text, return_tensors="pt").to(self.device)
-        return inputs
-
-    def predict(self, inputs, context: dict):
-        generation_kwargs = dict(
-            **inputs,
-            streamer=self.streamer,
-            eos_token_id=self.processor.tokenizer.eos_token_id,
-            **context["generation_args"],
+        if images is not None:
+            image_features = self.image_tiler(images)
+            num_tiles = image_features.pop("num_tiles")
+            data.update(image_features)
+            data["cross_attention_mask"] = convert_sparse_cross_attention_mask_to_dense(
+                [
+                    get_cross_attention_token_mask(ids, self.processor.image_token_id)
+                    for ids in data["input_ids"]
+                ],
+                num_tiles=num_tiles,
+                max_num_tiles=self.processor.image_processor.max_image_tiles,
+                length=len(data["input_ids"][0]),
+            )
+        return BatchFeature(data=data, tensor_type="pt")
+
+    def _submit(self, prepared, context: dict, loop=None):
+        return self.scheduler.submit(
+            prepared["inputs"],
+            context["generation_args"],
+            eos_token_ids=[self.processor.tokenizer.eos_token_id],
+            detokenizer=IncrementalDetokenizer(self.processor.tokenizer),
+            row=prepared["row"],
+            cache_key=prepared["cache_key"],
+            image_keys=prepared["image_keys"],
+            loop=loop,
         )
-        thread = Thread(target=self.model.generate, kwargs=generation_kwargs)
-        thread.start()
-        for text in self.streamer:
+
+    def _generate(self, prepared, context: dict):
+        yield from self._outputs(self._submit(prepared, context), context)
+
+    def _outputs(self, request, context: dict):
+        """
+        Text of a submitted request as it is generated, running tools in agent mode. Yields
+        at least one, possibly empty, chunk: litserve builds non-streaming responses from
+        the chunks, e.g. an empty final turn after the server ran the tools.
+        """
+        emitted = False
+        while True:
+            for text in request:
+                text = self._hold_tool_calls(text, context)
+                if text:
+                    emitted = True
+                    yield text
+                if not request.finished and self._should_cancel(context):
+                    self.scheduler.cancel(request)
+            if not request.paused:
+                break
+            text, token_ids = self._call_tools(request, context)
+            if text:
+                emitted = True
+                yield text
+            self._resume(request, token_ids, context)
+        text = self._release_held(context)
+        if text or not emitted:
             yield text
+        self._finish(request, context)
+
+    def _hold_tool_calls(self, text: str, context: dict) -> str:
+        """In agent mode, hold back output that may be tool calls the server will run."""
+        agent = context.get("agent")
+        if agent is None:
+            return text
+        parser = agent["parser"]
+        parser.feed(text)
+        agent["held"] += text
+        if parser.format is None or parser.is_tool_call:
+            return ""
+        return self._release_held(context)
+
+    def _release_held(self, context: dict) -> str:
+        agent = context.get("agent")
+        if agent is None:
+            return ""
+        text, agent["held"] = agent["held"], ""
+        return text
+
+    def _call_tools(self, request, context: dict):
+        """
+        Run the tool calls of the turn a request paused at, returning the text to send the
+        client and the tokens to continue with: the end of the turn, the results in
+        `ipython` messages and the header of the next assistant turn. Calls of tools the
+        server doesn't have go back to the client, the tokens are then None.
+        """
+        agent = context["agent"]
+        text = self._release_held(context)
+        parser, agent["parser"] = agent["parser"], ToolCallParser()
+        calls = [
+            (call["function"]["name"], json.loads(call["function"]["arguments"]))
+            for call in parser.calls
+        ]
+        if (
+            not parser.is_tool_call
+            or not calls
+            or any(name not in functions for name, _ in calls)
+            or agent["steps"] >= AGENT_MAX_STEPS
+        ):
+            return text, None
+
+        results = tool_runtime.run(calls)
+        messages = [
+            *agent["messages"],
+            {"role": "assistant", "content": text},
+            *({"role": "ipython", "content": result.content} for result in results),
+        ]
+        # The new messages are rendered by the chat template, then tokenized after the
+        # text the sequence already holds
+        rendered = self.processor.apply_chat_template(
+            messages, add_generation_prompt=True
+        )
+        if not rendered.startswith(agent["text"] + text):
+            return text, None
+        token_ids = self.processor.tokenizer.encode(
+            rendered[len(agent["text"] + text) :], add_special_tokens=False
+        )
+        if token_ids[:1] != [request.last_token]:
+            # The turn must end with the token the request paused at
+            return text, None
+        agent.update(messages=messages, text=rendered, steps=agent["steps"] + 1)
+        return "", token_ids[1:]
+
+    def _resume(self, request, token_ids, context: dict):
+        self.scheduler.resume(request, token_ids, grammar=context["agent"]["grammar"])
+
+    def _should_cancel(self, context: dict) -> bool:
+        """Whether the request timed out or, checked at most every interval, its client left."""
+        now = time.perf_counter()
+        if now - context["received_at"] > self.generation_timeout:
+            return True
+        if self.cancellation is None or not context.get("request_id"):
+            return False
+        if now - context.get("cancel_checked_at", 0) < CANCEL_CHECK_INTERVAL:
+            return False
+        context["cancel_checked_at"] = now
+        return self.cancellation.is_cancelled(context["request_id"])
+
+    def _finish(self, request, context: dict):
+        if request.cancelled:
+            if self.cancellation is not None and context.get("request_id"):
+                self.cancellation.discard(context["request_id"])
+            return
+        self._log_metrics(request, context)
+
+    def _log_metrics(self, request, context: dict):
+        times = request.token_times
+        if not times:
+            return
+        self.log("queue_wait_time", request.admitted_at - request.submitted_at)
+        self.log("time_to_first_token", times[0] - context["received_at"])
+        if len(times) > 1:
+            # Logged once per request rather than once per token
+            self.log("inter_token_latency", [b - a for a, b in zip(times, times[1:])])
+            self.log("tokens_per_second", (len(times) - 1) / (times[-1] - times[0]))
+        self.log("generation_time", times[-1] - request.submitted_at)
+        # predict returns a generator at once, so the whole stream is timed here
+        self.log("inference_time", time.perf_counter() - request.submitted_at)
+        self.log("prompt_tokens", request.prompt_tokens)
+        self.log("completion_tokens", len(request.output_ids) - request.inserted_tokens)
+        if request.verify_steps:
+            # Tokens per forward pass of the model, the speedup before the drafts' cost
+            self.log(
+                "speculative_tokens_per_step",
+                request.speculated_tokens / request.verify_steps,
+            )
+        if request.draft_tokens:
+            self.log(
+                "speculative_acceptance_rate",
+                request.accepted_tokens / request.draft_tokens,
+            )
+        self.log("cache_stats", self.cache_stats())
+
+    def cache_stats(self) -> dict:
+        """The `stats()` of the caches this worker uses, by process: {process: {cache: stats}}."""
+        caches = {}
+        if self.prefix_cache is not None:
+            caches["prefix"] = self.prefix_cache.stats()
+        if self.vision_cache is not None:
+            caches["vision"] = self.vision_cache.stats()
+        stats = {os.getpid(): caches}
+        if self.preprocessor is None:
+            # Requests are decoded in this process
+            caches.update(decoding_cache_stats(self.image_tiler))
+        else:
+            stats.update(self.preprocessor.cache_stats())
+        return stats
+
+    def predict(self, inputs, context):
+        # Each request gets its own token stream from the shared decode loop
+        if not isinstance(context, list):
+            yield from self._generate(inputs, context)
+            return
+
+        # Batched: yield one chunk per request at each step, "" once a request is done.
+        # All requests are submitted before any is read, so they are prefilled together
+        requests = [
+            None if x is None else self._submit(x, ctx)
+            for x, ctx in zip(inputs, context)
+        ]
+        streams = [
+            iter(()) if r is None else self._outputs(r, ctx)
+            for r, ctx in zip(requests, context)
+        ]
+        done = [False] * len(streams)
+        emitted = False
+        while not all(done):
+            step = []
+            for i, stream in enumerate(streams):
+                text = None if done[i] else next(stream, None)
+                done[i] = text is None
+                step.append(text or "")
+            if any(step):
+                emitted = True
+                yield step
+        if not emitted:
+            yield [""] * len(streams)
+
+    def unbatch(self, output):
+        yield from output
+
+    def encode_response(self, outputs, context):
+        if not isinstance(context, list):
+            parser = ToolCallParser() if context.get("tool") else None
+            for output in outputs:
+                yield self._encode_output(output, parser, context)
+            return
+
+        parsers = [ToolCallParser() if ctx.get("tool") else None for ctx in context]
+        for outputs_batch in outputs:
+            yield [
+                self._encode_output(output, parser, ctx)
+                for output, parser, ctx in zip(outputs_batch, parsers, context)
+            ]
+
+    def _encode_output(self, output: str, parser, context: dict):
+        if "error" in context:
+            # Failed to decode (see `batch`), the spec raises it for this request alone
+            error = context["error"]
+            return {
+                REQUEST_ERROR_KEY: {
+                    "status_code": error.status_code,
+                    "detail": error.detail,
+                }
+            }
+
+        # Check if the output is a tool call, each call is sent once it is complete
+        if parser is not None:
+            tool_calls = parser.feed(output)
+            if parser.is_tool_call:
+                if tool_calls and not context.get("stream"):
+                    # Non-streaming responses keep only the last chunk's tool calls
+                    tool_calls = parser.calls
+                return ChatMessage(
+                    role="assistant", content="", tool_calls=tool_calls or None
+                )
+
+        # Handle end-of-sequence (EOS) token
+        if self.processor.tokenizer.eos_token in output:
+            output = output.replace(self.processor.tokenizer.eos_token, "")
+
+        return ChatMessage(role="assistant", content=output)
+
+
+class AsyncLlamaVisionAPI(LlamaVisionAPI):
+    """
+    LlamaVisionAPI for litserve's async loop: a worker serves many requests at once
+    instead of one at a time, and they all join the scheduler's running batch.
+
+    Requests are parsed and tokenized in a thread, and tokens are handed from the
+    scheduler thread to the event loop through an asyncio queue. While a request is
+    generating, a watchdog stops it once its client disconnects or it times out.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(enable_async=True, **kwargs)
+
+    async def decode_request(self, request: ChatCompletionRequest, context: dict):
+        return await asyncio.to_thread(super().decode_request, request, context)
+
+    async def predict(self, inputs, context):
+        request = self._submit(inputs, context, loop=asyncio.get_running_loop())
+        watchdog = asyncio.create_task(self._watch(request, context))
+        emitted = False
+        try:
+            while True:
+                async for text in request:
+                    text = self._hold_tool_calls(text, context)
+                    if text:
+                        emitted = True
+                        yield text
+                if not request.paused:
+                    break
+                # Tools block, they run off the event loop
+                text, token_ids = await asyncio.to_thread(
+                    self._call_tools, request, context
+                )
+                if text:
+                    emitted = True
+                    yield text
+                self._resume(request, token_ids, context)
+            text = self._release_held(context)
+            # At least one chunk, as in `_outputs`
+            if text or not emitted:
+                yield text
+        finally:
+            watchdog.cancel()
+            if not request.finished:
+                # The consumer stopped early
+                self.scheduler.cancel(request)
+        self._finish(request, context)
+
+    async def _watch(self, request, context: dict):
+        while not request.finished:
+            await asyncio.sleep(CANCEL_CHECK_INTERVAL)
+            if self._should_cancel(context):
+                self.scheduler.cancel(request)
+                return
 
-    def encode_response(self, outputs, context: dict):
-        buffer = []
-        for output in outputs:
-            buffer.append(output)
-            self.log("output_text", output)
-
-            # Check if the output could be a tool call
-            combined_output = "".join(buffer).strip()
-            if context.get("tool") and combined_output.startswith(
-                ("{", "[", "<function")
-            ):
-                tool_calls = ToolUtils.maybe_extract_custom_tool_calls(combined_output)
-                yield ChatMessage(role="assistant", content="", tool_calls=tool_calls)
-                continue
-
-            # Handle end-of-sequence (EOS) token
-            if self.processor.tokenizer.eos_token in output:
-                output = output.replace(self.processor.tokenizer.eos_token, "")
-
-            yield ChatMessage(role="assistant", content=output)
+    async def encode_response(self, outputs, context):
+        parser = ToolCallParser() if context.get("tool") else None
+        async for output in outputs:
+            yield self._encode_output(output, parser, context)
@@ -0,0 +1,156 @@
+"""
+Prometheus metrics for the API server.
+
+`PROMETHEUS_MULTIPROC_DIR` must be set (see `generate_metrics_dir`) before this module is
+imported, so that samples observed in every litserve process are written to the shared
+directory and aggregated when `/metrics` is scraped.
+"""
+
+import litserve as ls
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    make_asgi_app,
+    multiprocess,
+)
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_LATENCY_BUCKETS = (0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.25, 0.5, 1)
+TOKEN_COUNT_BUCKETS = (16, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+THROUGHPUT_BUCKETS = (1, 5, 10, 20, 30, 50, 75, 100, 150, 200)
+RATE_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1)
+TOKENS_PER_STEP_BUCKETS = (1, 1.25, 1.5, 1.75, 2, 2.5, 3, 4, 6, 8)
+
+HISTOGRAMS = {
+    "time_to_first_token": Histogram(
+        "llama_vision_time_to_first_token_seconds",
+        "Time from receiving a request to sampling its first token",
+        buckets=LATENCY_BUCKETS,
+    ),
+    "inter_token_latency": Histogram(
+        "llama_vision_inter_token_latency_seconds",
+        "Time between consecutive sampled tokens of a request",
+        buckets=TOKEN_LATENCY_BUCKETS,
+    ),
+    "inference_time": Histogram(
+        "llama_vision_inference_seconds",
+        "Time from submitting a request to the end of its output, tool calls included",
+        buckets=LATENCY_BUCKETS,
+    ),
+    "generation_time": Histogram(
+        "llama_vision_generation_seconds",
+        "Time from submitting a request to the scheduler to its last token",
+        buckets=LATENCY_BUCKETS,
+    ),
+    "prompt_tokens": Histogram(
+        "llama_vision_prompt_tokens",
+        "Number of prompt tokens per request",
+        buckets=TOKEN_COUNT_BUCKETS,
+    ),
+    "completion_tokens": Histogram(
+        "llama_vision_completion_tokens",
+        "Number of generated tokens per request",
+        buckets=TOKEN_COUNT_BUCKETS,
+    ),
+    "tokens_per_second": Histogram(
+        "llama_vision_tokens_per_second",
+        "Decode throughput of a request",
+        buckets=THROUGHPUT_BUCKETS,
+    ),
+    "image_preprocess_time": Histogram(
+        "llama_vision_image_preprocess_seconds",
+        "Time spent fetching, decoding and resizing the images of a request",
+        buckets=LATENCY_BUCKETS,
+    ),
+    "queue_wait_time": Histogram(
+        "llama_vision_queue_wait_seconds",
+        "Time a request waits for a free slot in the decode batch",
+        buckets=LATENCY_BUCKETS,
+    ),
+    "speculative_acceptance_rate": Histogram(
+        "llama_vision_speculative_acceptance_rate",
+        "Fraction of the draft tokens of a request accepted by the model",
+        buckets=RATE_BUCKETS,
+    ),
+    "speculative_tokens_per_step": Histogram(
+        "llama_vision_speculative_tokens_per_step",
+        "Tokens generated per forward pass of a speculative request, 1 without drafts",
+        buckets=TOKENS_PER_STEP_BUCKETS,
+    ),
+}
+
+
+# Stats of the caches' `stats()` that are current levels, the others are running totals
+CACHE_LEVEL_STATS = ("entries", "bytes")
+# Configuration rather than measurements, not exported
+CACHE_CONFIG_STATS = ("max_bytes",)
+
+CACHE_TOTALS = Counter(
+    "llama_vision_cache",
+    "Running totals of the server's caches by cache and stat, e.g. hits, misses, "
+    "evictions, reused tokens and vision encoder seconds saved",
+    ["cache", "stat"],
+)
+CACHE_LEVELS = Gauge(
+    "llama_vision_cache_size",
+    "Entries and bytes held by the server's caches, summed over processes",
+    ["cache", "stat"],
+    multiprocess_mode="livesum",
+)
+
+
+class MetricsLogger(ls.Logger):
+    """
+    Record values logged with `LitAPI.log` in the matching histogram.
+
+    A value can also be a list, e.g. all inter-token latencies of a request, which keeps
+    logging to one message per request instead of one per token.
+
+    Values logged as "cache_stats" are snapshots of the caches' `stats()` by process,
+    {process: {cache: stats}}: running totals are counted by their increase since the
+    process's previous snapshot, levels are summed over processes.
+    """
+
+    def __init__(self):
+        super().__init__()
+        # Latest stats of each (process, cache)
+        self._cache_stats = {}
+
+    def process(self, key, value):
+        if key == "cache_stats":
+            self._record_cache_stats(value)
+            return
+        histogram = HISTOGRAMS.get(key)
+        if histogram is None:
+            return
+        for v in value if isinstance(value, (list, tuple)) else (value,):
+            histogram.observe(v)
+
+    def _record_cache_stats(self, snapshots: dict):
+        for source, caches in snapshots.items():
+            for cache, stats in caches.items():
+                last = self._cache_stats.setdefault((source, cache), {})
+                for stat, total in stats.items():
+                    if stat in CACHE_LEVEL_STATS or stat in CACHE_CONFIG_STATS:
+                        continue
+                    increase = total - last.get(stat, 0)
+                    if increase > 0:
+                        CACHE_TOTALS.labels(cache, stat).inc(increase)
+                last.update(stats)
+
+        levels = {}
+        for (_, cache), stats in self._cache_stats.items():
+            for stat in CACHE_LEVEL_STATS:
+                if stat in stats:
+                    levels[cache, stat] = levels.get((cache, stat), 0) + stats[stat]
+        for (cache, stat), level in levels.items():
+            CACHE_LEVELS.labels(cache, stat).set(level)
+
+
+def metrics_app():
+    """ASGI app serving the metrics aggregated across all processes."""
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return make_asgi_app(registry=registry)
@@ -0,0 +1,91 @@
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+import torch
+
+from src.api.cache import LRUCache, content_hash
+
+
+@dataclass
+class PrefixEntry:
+    """Key/value states computed for `token_ids`, one (1, heads, len, dim) tensor per layer."""
+
+    token_ids: torch.Tensor
+    keys: List
+    values: List
+
+    @property
+    def nbytes(self) -> int:
+        return sum(t.nbytes for t in self.keys + self.values if len(t))
+
+
+def common_prefix_length(a: torch.Tensor, b: torch.Tensor) -> int:
+    n = min(len(a), len(b))
+    mismatch = (a[:n] != b[:n]).nonzero()
+    return int(mismatch[0]) if len(mismatch) else n
+
+
+class PrefixCache:
+    """
+    KV states of finished sequences, reused by later requests sharing a token prefix.
+
+    Entries are grouped by a namespace (the conversation's images), since cached states
+    are only valid for the same cross-attention inputs. A lookup returns the entry with
+    the longest common prefix; only the remaining suffix then needs to be prefilled.
+    """
+
+    def __init__(self, max_bytes: int):
+        self._cache = LRUCache(max_bytes, sizeof=lambda entry: entry.nbytes)
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+
+    def lookup(
+        self, namespace: str, token_ids: torch.Tensor
+    ) -> Tuple[Optional[PrefixEntry], int]:
+        best_key, best_len = None, 0
+        for key in self._cache.keys():
+            if key[0] != namespace:
+                continue
+            entry = self._cache.peek(key)
+            if entry is None:
+                continue
+            # Leave at least one token to prefill, its logits start the generation
+            length = min(
+                common_prefix_length(entry.token_ids, token_ids), len(token_ids) - 1
+            )
+            if length > best_len:
+                best_key, best_len = key, length
+
+        if best_key is None:
+            self.misses += 1
+            return None, 0
+        entry = self._cache.get(best_key)
+        if entry is None:
+            self.misses += 1
+            return None, 0
+        self.hits += 1
+        self.reused_tokens += best_len
+        return entry, best_len
+
+    def insert(self, namespace: str, entry: PrefixEntry):
+        # An entry that is a prefix of the new one is superseded by it
+        for key in self._cache.keys():
+            if key[0] != namespace:
+                continue
+            other = self._cache.peek(key)
+            if other is not None and len(other.token_ids) <= len(entry.token_ids):
+                if common_prefix_length(other.token_ids, entry.token_ids) == len(
+                    other.token_ids
+                ):
+                    self._cache.pop(key)
+        key = (namespace, content_hash(entry.token_ids.numpy().tobytes()))
+        self._cache.put(key, entry)
+
+    def stats(self) -> dict:
+        return {
+            **self._cache.stats(),
+            "lookup_hits": self.hits,
+            "lookup_misses": self.misses,
+            "reused_tokens": self.reused_tokens,
+        }
@@ -0,0 +1,188 @@
+import concurrent.futures
+import multiprocessing
+import os
+import threading
+import time
+
+from litserve.specs.openai import ChatCompletionRequest
+from transformers.models.mllama.processing_mllama import build_string_from_input
+
+from src.api.cache import content_hash
+from src.api.image_tiles import ImageTiler
+from src.api.utils import image_cache, parse_messages, prompt_cache
+from src.config import PREPROCESS_MAX_PENDING, PREPROCESS_WORKERS
+
+
+def prepare_prompt(processor, image_tiler: ImageTiler, request: ChatCompletionRequest):
+    """
+    The CPU side of decoding a request: fetch and decode its images, render its messages
+    with the chat template, tile the images for the model and tokenize the text.
+
+    Returns the parsed messages and the prompt, ready to be batched with others.
+    """
+    messages, images = parse_messages(request)
+    input_text = processor.apply_chat_template(messages, add_generation_prompt=True)
+    # Cached KV states can only be shared between prompts with the same images
+    image_keys = [image.info.get("cache_key", "") for image in images or []]
+    if images:
+        images = [image_tiler.tile(image) for image in images]
+    # Tool and schema prompts are tokenized once, see `tokenize_prompt`
+    system_prompt = None
+    if request.messages[0].role == "system" and (
+        request.tools or request.response_format
+    ):
+        system_prompt = messages[0]["content"]
+    prompt = {
+        "text": input_text,
+        "system_prompt": system_prompt,
+        "images": images,
+        "cache_key": content_hash("|".join(image_keys)),
+        "image_keys": image_keys,
+    }
+    prompt["input_ids"] = tokenize_prompt(processor, prompt)
+    return messages, prompt
+
+
+def tokenize_prompt(processor, prompt) -> list:
+    text = build_string_from_input(
+        prompt["text"], processor.bos_token, processor.image_token
+    )
+    prefix = None
+    system_prompt = prompt.get("system_prompt")
+    if system_prompt and system_prompt in text:
+        # Everything up to the end of the system prompt is the same across requests
+        prefix = text[: text.index(system_prompt) + len(system_prompt)]
+    return prompt_cache.encode(processor.tokenizer, text, prefix)
+
+
+# Set in each process of a RequestPreprocessor's pool by `_init_process`
+_processor = None
+_image_tiler = None
+
+
+def _init_process(backend):
+    global _processor, _image_tiler
+    # Inference workers are killed without shutting their pool down, exit with them
+    threading.Thread(target=_exit_with_parent, daemon=True).start()
+    _processor = backend.load_processor()
+    _image_tiler = ImageTiler(_processor.image_processor)
+
+
+def _exit_with_parent():
+    multiprocessing.parent_process().join()
+    os._exit(0)
+
+
+def decoding_cache_stats(image_tiler: ImageTiler) -> dict:
+    """The `stats()` of this process's request decoding caches, by cache."""
+    return {
+        "image": image_cache.stats(),
+        "image_tiles": image_tiler.stats(),
+        "prompt": prompt_cache.stats(),
+    }
+
+
+def _prepare(request: ChatCompletionRequest):
+    result = prepare_prompt(_processor, _image_tiler, request)
+    return result, os.getpid(), decoding_cache_stats(_image_tiler)
+
+
+def _ready():
+    return True
+
+
+class RequestPreprocessor:
+    """
+    Pool of processes decoding requests (`prepare_prompt`) for an inference worker, so
+    image downloads, decoding, tiling, template rendering and tokenization run beside
+    generation instead of holding up the worker's GPU loop, and a batch's requests are
+    decoded in parallel.
+
+    Each process loads the backend's processor and keeps its own caches of decoded and
+    tiled images. At most `max_pending` requests are queued or being decoded; `submit`
+    blocks beyond that, holding further requests back in the server's queue.
+
+    Parameters:
+    backend: Backend whose processor the processes load.
+    num_workers (int): Number of processes.
+    max_pending (int): Most requests submitted and not yet decoded.
+    """
+
+    def __init__(
+        self,
+        backend,
+        num_workers: int = PREPROCESS_WORKERS,
+        max_pending: int = PREPROCESS_MAX_PENDING,
+    ):
+        self.num_workers = num_workers
+        self.max_pending = max_pending
+        self.submitted = 0
+        self.waited_seconds = 0.0
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pending = 0
+        self._lock = threading.Lock()
+        # Each process's latest `decoding_cache_stats()`, returned with its decoded requests
+        self._cache_stats = {}
+        self._executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=num_workers,
+            # Forking a process that may have initialized CUDA isn't safe
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_process,
+            initargs=(backend,),
+        )
+        # Start the processes and load their processors now, not on the first requests
+        for future in [self._executor.submit(_ready) for _ in range(num_workers)]:
+            future.result()
+
+    def submit(self, request: ChatCompletionRequest) -> concurrent.futures.Future:
+        """Decode a request in the pool, resolving to `prepare_prompt`'s result."""
+        t0 = time.perf_counter()
+        self._slots.acquire()
+        with self._lock:
+            self.submitted += 1
+            self._pending += 1
+            self.waited_seconds += time.perf_counter() - t0
+        try:
+            prepared = self._executor.submit(_prepare, request)
+        except BaseException:
+            self._release()
+            raise
+        future = concurrent.futures.Future()
+        prepared.add_done_callback(lambda _: self._finish(prepared, future))
+        return future
+
+    def _finish(
+        self, prepared: concurrent.futures.Future, future: concurrent.futures.Future
+    ):
+        self._release()
+        try:
+            result, pid, caches = prepared.result()
+        except BaseException as error:
+            future.set_exception(error)
+            return
+        with self._lock:
+            self._cache_stats[pid] = caches
+        future.set_result(result)
+
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+        self._slots.release()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.num_workers,
+                "pending": self._pending,
+                "max_pending": self.max_pending,
+                "submitted": self.submitted,
+                "waited_seconds": self.waited_seconds,
+            }
+
+    def cache_stats(self) -> dict:
+        """The processes' latest `decoding_cache_stats()`, by process: {process: {cache: stats}}."""
+        with self._lock:
+            return dict(self._cache_stats)
@@ -0,0 +1,74 @@
+import json
+from typing import Callable, List, Optional
+
+from src.api.cache import LRUCache, content_hash
+
+
+def canonical_hash(*parts) -> str:
+    """Hash JSON-serializable parts independently of dict key order and formatting."""
+    return content_hash(json.dumps(parts, sort_keys=True, separators=(",", ":")))
+
+
+class PromptCache:
+    """
+    Rendered system prompts and the token ids of the text up to and including them.
+
+    Tool and response-format prompts are large and the same for most requests, so they
+    are rendered once per canonical hash of their inputs. When tokenizing, only the text
+    after the cached prefix is tokenized and appended to the cached prefix ids.
+
+    A prefix is only reused if tokenizing it separately gives the same ids as tokenizing
+    the whole text, which is checked once when it is first seen.
+    """
+
+    def __init__(self, max_bytes: int):
+        self._prompts = LRUCache(max_bytes // 2, sizeof=len)
+        self._prefixes = LRUCache(
+            max_bytes // 2, sizeof=lambda ids: 8 * len(ids) if ids else 1
+        )
+        self.reused_tokens = 0
+        self.unspliceable = 0
+
+    def render(self, key: str, build: Callable[[], str]) -> str:
+        prompt = self._prompts.get(key)
+        if prompt is None:
+            prompt = build()
+            self._prompts.put(key, prompt)
+        return prompt
+
+    def encode(self, tokenizer, text: str, prefix: Optional[str] = None) -> List[int]:
+        """Token ids of `text`, reusing the cached ids of `prefix` if it starts `text`."""
+        if not prefix or not text.startswith(prefix):
+            return tokenizer(text)["input_ids"]
+
+        key = content_hash(prefix)
+        rest = text[len(prefix) :]
+        prefix_ids = self._prefixes.get(key)
+        if prefix_ids is None:
+            prefix_ids = tokenizer(prefix)["input_ids"]
+            ids = tokenizer(text)["input_ids"]
+            rest_ids = tokenizer(rest, add_special_tokens=False)["input_ids"]
+            if ids != prefix_ids + rest_ids:
+                # The prefix doesn't end on a token boundary, never splice it
+                self.unspliceable += 1
+                self._prefixes.put(key, [])
+                return ids
+            self._prefixes.put(key, prefix_ids)
+            return ids
+        if not prefix_ids:
+            return tokenizer(text)["input_ids"]
+
+        self.reused_tokens += len(prefix_ids)
+        return prefix_ids + tokenizer(rest, add_special_tokens=False)["input_ids"]
+
+    def stats(self) -> dict:
+        prompts, prefixes = self._prompts.stats(), self._prefixes.stats()
+        return {
+            "prompt_hits": prompts["hits"],
+            "prompt_misses": prompts["misses"],
+            "prefix_hits": prefixes["hits"],
+            "prefix_misses": prefixes["misses"],
+            "reused_tokens": self.reused_tokens,
+            "unspliceable": self.unspliceable,
+            "bytes": prompts["bytes"] + prefixes["bytes"],
+        }
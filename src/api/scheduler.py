@@ -0,0 +1,585 @@
+import asyncio
+import queue
+import threading
+import time
+from typing import Dict, List, Optional
+
+import torch
+
+_END_OF_STREAM = object()
+_PAUSED = object()
+
+
+def sample_next_tokens(
+    logits: torch.Tensor, temperatures: List[float], top_ps: List[float]
+) -> torch.Tensor:
+    """
+    Sample one token per row with per-row temperature and nucleus (top-p) settings.
+
+    A temperature of 0 selects the most likely token.
+    """
+    logits = logits.float()
+    greedy = logits.argmax(dim=-1)
+
+    sorted_probs, sorted_ids = _nucleus_probs(logits, temperatures, top_ps)
+    choice = torch.multinomial(sorted_probs, num_samples=1)
+    sampled = sorted_ids.gather(-1, choice).squeeze(-1)
+
+    is_greedy = torch.tensor([t == 0 for t in temperatures], device=logits.device)
+    return torch.where(is_greedy, greedy, sampled)
+
+
+def _nucleus_probs(
+    logits: torch.Tensor, temperatures: List[float], top_ps: List[float]
+):
+    """Per-row probabilities sorted in descending order, zeroed outside the top-p nucleus."""
+    temperature = torch.tensor(temperatures, device=logits.device).clamp(min=1e-5)
+    top_p = torch.tensor(top_ps, device=logits.device)
+    probs = torch.softmax(logits / temperature[:, None], dim=-1)
+
+    sorted_probs, sorted_ids = probs.sort(dim=-1, descending=True)
+    cumulative = sorted_probs.cumsum(dim=-1)
+    # Keep the smallest set of tokens whose cumulative probability exceeds top_p
+    sorted_probs[(cumulative - sorted_probs) > top_p[:, None]] = 0.0
+    return sorted_probs, sorted_ids
+
+
+def accept_draft_tokens(
+    logits: torch.Tensor, draft_ids: List[int], temperature: float, top_p: float
+) -> List[int]:
+    """
+    Speculative sampling: given the logits after the last token and after each of the
+    `draft_ids` (one row more than drafts), return the accepted drafts followed by one
+    token sampled from the model, so the output has the distribution of plain sampling.
+
+    Drafts are proposed deterministically, so a draft is accepted with the probability the
+    model gives it, and on rejection the next token is sampled without the rejected draft.
+    """
+    logits = logits.float()
+    if temperature == 0:
+        target = logits.argmax(dim=-1).tolist()
+        accepted = 0
+        while accepted < len(draft_ids) and draft_ids[accepted] == target[accepted]:
+            accepted += 1
+        return draft_ids[:accepted] + [target[accepted]]
+
+    sorted_probs, sorted_ids = _nucleus_probs(
+        logits, [temperature] * len(logits), [top_p] * len(logits)
+    )
+    probs = torch.zeros_like(sorted_probs).scatter_(-1, sorted_ids, sorted_probs)
+    probs = probs / probs.sum(dim=-1, keepdim=True)
+    for i, draft_id in enumerate(draft_ids):
+        if torch.rand(()) < probs[i, draft_id]:
+            continue
+        residual = probs[i].clone()
+        residual[draft_id] = 0.0
+        if residual.sum() <= 0:
+            residual = probs[i]
+        return draft_ids[:i] + [int(torch.multinomial(residual, num_samples=1))]
+    return draft_ids + [int(torch.multinomial(probs[-1], num_samples=1))]
+
+
+class IncrementalDetokenizer:
+    """
+    Turn a growing list of token ids into text chunks, mirroring `TextStreamer`:
+    text is only released at word boundaries so multi-token characters are not split.
+    """
+
+    def __init__(self, tokenizer, skip_special_tokens: bool = True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.token_ids: List[int] = []
+        self.print_len = 0
+
+    def _decode(self) -> str:
+        return self.tokenizer.decode(
+            self.token_ids,
+            skip_special_tokens=self.skip_special_tokens,
+            clean_up_tokenization_spaces=False,
+        )
+
+    def put(self, token_id: int) -> str:
+        self.token_ids.append(token_id)
+        text = self._decode()
+        if text.endswith("\n"):
+            chunk = text[self.print_len :]
+            self.token_ids = []
+            self.print_len = 0
+        elif text and _is_cjk(ord(text[-1])):
+            chunk = text[self.print_len :]
+            self.print_len += len(chunk)
+        else:
+            chunk = text[self.print_len : text.rfind(" ") + 1]
+            self.print_len += len(chunk)
+        return chunk
+
+    def flush(self) -> str:
+        chunk = self._decode()[self.print_len :] if self.token_ids else ""
+        self.token_ids = []
+        self.print_len = 0
+        return chunk
+
+
+def _is_cjk(cp: int) -> bool:
+    return (
+        0x4E00 <= cp <= 0x9FFF
+        or 0x3400 <= cp <= 0x4DBF
+        or 0x20000 <= cp <= 0x2A6DF
+        or 0x2A700 <= cp <= 0x2B73F
+        or 0x2B740 <= cp <= 0x2B81F
+        or 0x2B820 <= cp <= 0x2CEAF
+        or 0xF900 <= cp <= 0xFAFF
+        or 0x2F800 <= cp <= 0x2FA1F
+    )
+
+
+class GenerationRequest:
+    """
+    A single sequence tracked by the `GenerationScheduler`.
+
+    Iterating over the request yields decoded text chunks as the scheduler produces them.
+    Requests submitted with an event loop are iterated with `async for` instead, their
+    chunks are handed to the loop without blocking it. Iteration also stops when a request
+    with `pause_at_eos` pauses, and picks up again once it is resumed.
+    """
+
+    def __init__(
+        self,
+        inputs: Dict[str, torch.Tensor],
+        generation_args: Dict,
+        eos_token_ids: List[int],
+        detokenizer: IncrementalDetokenizer,
+        row: int = 0,
+        cache_key: Optional[str] = None,
+        image_keys: Optional[List[str]] = None,
+        loop: Optional[asyncio.AbstractEventLoop] = None,
+    ):
+        self.inputs = inputs
+        self.row = row
+        # Requests with the same key may share cached KV states for a common prefix
+        self.cache_key = cache_key
+        # Content hashes of the request's images, in order
+        self.image_keys = image_keys
+        self.temperature = generation_args.get("temperature", 0.7)
+        self.top_p = generation_args.get("top_p", 0.9)
+        self.max_new_tokens = generation_args.get("max_new_tokens", 2048)
+        # Name of the scheduler's proposer of draft tokens for speculative decoding, if any
+        self.speculative = generation_args.get("speculative")
+        # JSONGrammar or ToolCallGrammar the output must match, if any, and its state
+        self.grammar = generation_args.get("grammar")
+        self.grammar_state = self.grammar.initial_state if self.grammar else None
+        self.eos_token_ids = set(eos_token_ids)
+        # Stop at the end of a turn without finishing, so the sequence can be resumed
+        self.pause_at_eos = generation_args.get("pause_at_eos", False)
+        self.detokenizer = detokenizer
+
+        self.output_ids: List[int] = []
+        self.state = None  # owned by the engine
+        self.finished = False
+        self.cancelled = False
+        self.paused = False
+        # Tokens appended by `extend` rather than generated
+        self.inserted_tokens = 0
+        self.prompt_tokens = 0  # set by the engine on prefill
+        self.prompt_ids: List[int] = []  # set by the engine on prefill
+        self.draft_state = None  # owned by the proposer
+
+        # Speculative decoding: verify steps, draft tokens proposed and accepted, and
+        # tokens generated by verify steps
+        self.verify_steps = 0
+        self.draft_tokens = 0
+        self.accepted_tokens = 0
+        self.speculated_tokens = 0
+
+        # Timings, from `time.perf_counter`
+        self.submitted_at = time.perf_counter()
+        self.admitted_at: Optional[float] = None
+        self.token_times: List[float] = []
+
+        self._loop = loop
+        self._queue = asyncio.Queue() if loop is not None else queue.Queue()
+        self._emitted = False
+
+    @property
+    def last_token(self) -> int:
+        return self.output_ids[-1]
+
+    def append(self, token_id: int):
+        """Record a sampled token, stream its text and mark the request finished if done."""
+        self.output_ids.append(token_id)
+        self.token_times.append(time.perf_counter())
+        if self.grammar is not None:
+            self.grammar_state = self.grammar.advance(self.grammar_state, token_id)
+        if token_id in self.eos_token_ids:
+            if self.pause_at_eos:
+                self.paused = True
+            else:
+                self.finished = True
+        else:
+            self._put_text(self.detokenizer.put(token_id))
+        if len(self.output_ids) >= self.max_new_tokens:
+            self.finished = True
+        if self.finished:
+            self.close()
+        elif self.paused:
+            self._flush()
+            self._put(_PAUSED)
+
+    def extend(self, token_ids: List[int], grammar=None):
+        """
+        Append tokens that weren't generated, e.g. the result of a tool call following the
+        turn the request paused at, to generate after them under a new grammar.
+        """
+        self.output_ids.extend(token_ids)
+        self.inserted_tokens += len(token_ids)
+        self.max_new_tokens += len(token_ids)
+        self.grammar = grammar
+        self.grammar_state = grammar.initial_state if grammar else None
+        self.paused = False
+
+    def close(self, error: Optional[Exception] = None):
+        self.finished = True
+        self.paused = False
+        self._flush()
+        if error is None and not self._emitted:
+            # Consumers such as litserve's non-streaming responses expect at least one
+            # chunk, even when the output is empty (e.g. EOS right away)
+            self._put("")
+        self._put(error if error is not None else _END_OF_STREAM)
+
+    def _flush(self):
+        self._put_text(self.detokenizer.flush())
+
+    def _put_text(self, chunk: str):
+        if chunk:
+            self._emitted = True
+            self._put(chunk)
+
+    def _put(self, item):
+        if self._loop is None:
+            self._queue.put(item)
+        else:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is _END_OF_STREAM or item is _PAUSED:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    async def __aiter__(self):
+        while True:
+            item = await self._queue.get()
+            if item is _END_OF_STREAM or item is _PAUSED:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+
+class GenerationScheduler:
+    """
+    Continuous-batching decode loop shared by all requests of a worker.
+
+    Requests are admitted at step boundaries: each new request is prefilled by the engine and
+    then joins the running batch, which advances one token per step. Requests leave the batch
+    as soon as they finish, without waiting for the others.
+
+    The engine is any object implementing:
+      - `prefill(requests) -> List[Tensor]`: build state for new requests, return next-token logits.
+        Requests sharing the same batched `inputs` should be prefilled in one forward pass.
+      - `decode(requests, tokens) -> List[Tensor]`: feed one token per request, return logits
+      - `release(request, reusable)`: drop the state held for a finished request;
+        `reusable` is False when the request failed mid-step
+
+    Requests with a grammar only sample among the tokens it allows, and tokens it forces
+    are emitted without sampling.
+
+    Requests naming one of the `proposers` are decoded speculatively, one at a time, as
+    long as at most `max_speculative_batch_size` requests are running (beyond that a batched
+    step is cheaper): the proposer guesses the next tokens (`propose(request) -> List[int]`),
+    the engine scores them all in one forward pass and the longest acceptable run is kept,
+    so a step may yield several tokens. Runs of tokens forced by a grammar are fed the same
+    way, in one forward pass. The engine must then also implement:
+      - `verify(request, tokens) -> Tensor`: feed several tokens, return logits after each
+      - `rewind(request, num_tokens)`: drop the last tokens fed, i.e. the rejected drafts
+    and the proposer `release(request)` to drop its own state for the request.
+
+    Requests with `pause_at_eos` keep their state at the end of a turn, e.g. to call
+    tools, until `resume` either finishes them or feeds more tokens and generates after
+    them with `verify`, continuing from the cached KV states instead of a new prefill.
+    """
+
+    def __init__(
+        self,
+        engine,
+        max_batch_size: int = 8,
+        proposers: Optional[Dict] = None,
+        max_speculative_batch_size: int = 4,
+    ):
+        self.engine = engine
+        self.max_batch_size = max_batch_size
+        self.proposers = proposers or {}
+        self.max_speculative_batch_size = max_speculative_batch_size
+        self._pending: List[GenerationRequest] = []
+        self._active: List[GenerationRequest] = []
+        self._paused: List[GenerationRequest] = []
+        # (request, token ids to feed or None to finish it, grammar) of paused requests
+        self._resumes: List[tuple] = []
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(
+        self,
+        inputs: Dict[str, torch.Tensor],
+        generation_args: Dict,
+        eos_token_ids: List[int],
+        detokenizer: IncrementalDetokenizer,
+        row: int = 0,
+        cache_key: Optional[str] = None,
+        image_keys: Optional[List[str]] = None,
+        loop: Optional[asyncio.AbstractEventLoop] = None,
+    ) -> GenerationRequest:
+        """
+        Queue a sequence for generation. `inputs` may hold a padded batch shared by several
+        requests, in which case `row` selects this request's row. Pass the running event
+        loop to consume the request with `async for`.
+        """
+        request = GenerationRequest(
+            inputs,
+            generation_args,
+            eos_token_ids,
+            detokenizer,
+            row=row,
+            cache_key=cache_key,
+            image_keys=image_keys,
+            loop=loop,
+        )
+        with self._cond:
+            self._pending.append(request)
+            self._cond.notify()
+        return request
+
+    def resume(
+        self,
+        request: GenerationRequest,
+        token_ids: Optional[List[int]] = None,
+        grammar=None,
+    ):
+        """
+        Continue a paused request after `token_ids`, generating under `grammar`, or finish
+        it if `token_ids` is None. The token it paused at is fed first.
+        """
+        with self._cond:
+            self._resumes.append((request, token_ids, grammar))
+            self._cond.notify()
+
+    def cancel(self, request: GenerationRequest):
+        """Stop generating for a request, e.g. once its client went away; its stream ends."""
+        with self._cond:
+            request.cancelled = True
+            self._cond.notify()
+
+    def shutdown(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped and not self._has_work():
+                    self._cond.wait()
+                if self._stopped:
+                    break
+                cancelled = [
+                    r
+                    for r in self._pending + self._active + self._paused
+                    if r.cancelled
+                ]
+                if cancelled:
+                    self._pending = [r for r in self._pending if not r.cancelled]
+                    self._active = [r for r in self._active if not r.cancelled]
+                    self._paused = [r for r in self._paused if not r.cancelled]
+                resumes, self._resumes = self._resumes, []
+                # Paused requests keep their slot
+                free_slots = self.max_batch_size - len(self._active) - len(self._paused)
+                admitted = self._pending[: max(free_slots, 0)]
+                del self._pending[: max(free_slots, 0)]
+
+            for request in cancelled:
+                # The KV states computed so far are still valid for the prefix cache
+                if request.state is not None:
+                    self._release(request)
+                request.close()
+
+            for request, token_ids, grammar in resumes:
+                self._resume(request, token_ids, grammar)
+
+            if admitted:
+                admitted_at = time.perf_counter()
+                for request in admitted:
+                    request.admitted_at = admitted_at
+                self._step(admitted, lambda: self.engine.prefill(admitted))
+                self._active.extend(self._running(admitted))
+
+            if self._active:
+                speculative, active = [], self._active
+                if len(active) <= self.max_speculative_batch_size:
+                    speculative = [r for r in active if self._speculates(r)]
+                    active = [r for r in active if not self._speculates(r)]
+                if active:
+                    tokens = [r.last_token for r in active]
+                    self._step(active, lambda: self.engine.decode(active, tokens))
+                for request in speculative:
+                    self._speculate(request)
+                self._active = self._running(self._active)
+
+        for request in self._active + self._pending + self._paused:
+            request.close(RuntimeError("Generation scheduler was shut down"))
+
+    def _has_work(self) -> bool:
+        return bool(
+            self._pending
+            or self._active
+            or self._resumes
+            or any(r.cancelled for r in self._paused)
+        )
+
+    def _running(self, requests: List[GenerationRequest]) -> List[GenerationRequest]:
+        """The requests still generating, setting aside those that paused."""
+        self._paused.extend(r for r in requests if r.paused and not r.finished)
+        return [r for r in requests if not r.finished and not r.paused]
+
+    def _resume(self, request: GenerationRequest, token_ids, grammar):
+        if request not in self._paused:
+            # Cancelled while paused, already closed
+            return
+        self._paused.remove(request)
+        if token_ids is None:
+            self._release(request)
+            request.close()
+            return
+        tokens = [request.last_token, *token_ids]
+        request.extend(token_ids, grammar)
+        self._step([request], lambda: [self.engine.verify(request, tokens)[-1]])
+        self._active.extend(self._running([request]))
+
+    def _step(self, requests: List[GenerationRequest], forward):
+        try:
+            logits = [
+                r.grammar.constrain(r.grammar_state, row) if r.grammar else row
+                for r, row in zip(requests, forward())
+            ]
+            next_tokens = sample_next_tokens(
+                torch.stack(logits),
+                [r.temperature for r in requests],
+                [r.top_p for r in requests],
+            ).tolist()
+        except Exception as e:
+            for request in requests:
+                self._release(request, reusable=False)
+                request.close(e)
+            return
+
+        for request, token_id in zip(requests, next_tokens):
+            if request.grammar is not None:
+                forced = request.grammar.forced_token(request.grammar_state)
+                token_id = token_id if forced is None else forced
+            request.append(token_id)
+            if request.finished:
+                self._release(request)
+
+    def _speculates(self, request: GenerationRequest) -> bool:
+        return request.speculative in self.proposers or (
+            request.grammar is not None
+            and request.grammar.forced_token(request.grammar_state) is not None
+        )
+
+    def _speculate(self, request: GenerationRequest):
+        """
+        Decode a step of one request in one forward pass, feeding the tokens its grammar
+        forces, which are kept as they are, or else draft tokens, which are verified.
+        """
+        try:
+            forced = self._forced_tokens(request)
+            draft_ids = []
+            if not forced and request.speculative in self.proposers:
+                draft_ids = self.proposers[request.speculative].propose(request)
+            states = None
+            if request.grammar is not None:
+                # Grammar states before each token to sample, drafts stop at the first
+                # token the grammar doesn't allow
+                state = request.grammar_state
+                for token_id in forced:
+                    state = request.grammar.advance(state, token_id)
+                states = [state]
+                for i, token_id in enumerate(draft_ids):
+                    state = request.grammar.advance(state, token_id)
+                    if state is None:
+                        draft_ids = draft_ids[:i]
+                        break
+                    states.append(state)
+
+            tokens = [request.last_token, *forced, *draft_ids]
+            logits = self.engine.verify(request, tokens)[len(forced) :]
+            if states is not None:
+                logits = torch.stack(
+                    [
+                        request.grammar.constrain(state, row)
+                        for state, row in zip(states, logits)
+                    ]
+                )
+            accepted = accept_draft_tokens(
+                logits, draft_ids, request.temperature, request.top_p
+            )
+            num_accepted = len(accepted) - 1
+            accepted = forced + accepted
+            # Drop tokens past the end of the request, their KV states are rewound too
+            accepted = accepted[: request.max_new_tokens - len(request.output_ids)]
+            for i, token_id in enumerate(accepted):
+                if token_id in request.eos_token_ids:
+                    accepted = accepted[: i + 1]
+                    break
+            self.engine.rewind(request, len(tokens) - len(accepted))
+        except Exception as e:
+            self._release(request, reusable=False)
+            request.close(e)
+            return
+
+        request.verify_steps += 1
+        request.draft_tokens += len(draft_ids)
+        request.accepted_tokens += num_accepted
+        request.speculated_tokens += len(accepted)
+        for token_id in accepted:
+            request.append(token_id)
+        if request.finished:
+            self._release(request)
+
+    def _forced_tokens(self, request: GenerationRequest) -> List[int]:
+        """The run of tokens the request's grammar forces next, leaving room for one more."""
+        forced = []
+        if request.grammar is None:
+            return forced
+        state = request.grammar_state
+        while len(forced) < request.max_new_tokens - len(request.output_ids) - 1:
+            token_id = request.grammar.forced_token(state)
+            if token_id is None:
+                break
+            forced.append(token_id)
+            if token_id in request.eos_token_ids:
+                break
+            state = request.grammar.advance(state, token_id)
+        return forced
+
+    def _release(self, request: GenerationRequest, reusable: bool = True):
+        self.engine.release(request, reusable)
+        proposer = self.proposers.get(request.speculative)
+        if proposer is not None:
+            proposer.release(request)
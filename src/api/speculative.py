@@ -0,0 +1,147 @@
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Tuple
+
+import torch
+from transformers import DynamicCache
+
+
+@dataclass
+class _DraftState:
+    # Prompt token ids the draft model reads
+    prompt_ids: List[int]
+    cache: DynamicCache = field(default_factory=DynamicCache)
+    # Token ids in the draft cache, and how many of them came from the sequence itself
+    token_ids: List[int] = field(default_factory=list)
+    context_len: int = 0
+
+
+@dataclass
+class _LookupState:
+    # Position following the latest occurrence of each n-gram, one dict per n-gram size
+    index: List[Dict[Tuple[int, ...], int]]
+    # N-grams followed by a token before this position are indexed
+    indexed: int = 0
+
+
+class DraftModelProposer:
+    """
+    Propose the next tokens of a sequence by greedy decoding with a small text-only model
+    that shares the target model's tokenizer, e.g. Llama 3.2 1B for Llama 3.2 Vision.
+
+    Each sequence keeps its own draft KV cache. Before proposing, the cache is cropped to
+    the drafts the target accepted, so only the tokens it hasn't seen yet are fed. Image
+    tokens are left out of the draft's context since the draft model only reads text.
+
+    Parameters:
+    model: Causal language model used as the draft.
+    device: Device of the draft model.
+    num_tokens (int): Draft tokens proposed per step.
+    ignore_token_ids: Prompt token ids the draft model doesn't know, e.g. the image token.
+    """
+
+    def __init__(
+        self, model, device, num_tokens: int = 4, ignore_token_ids: Iterable[int] = ()
+    ):
+        self.model = model
+        self.device = device
+        self.num_tokens = num_tokens
+        self.ignore_token_ids = set(ignore_token_ids)
+
+    @torch.inference_mode()
+    def propose(self, request) -> List[int]:
+        num_tokens = min(
+            self.num_tokens, request.max_new_tokens - len(request.output_ids) - 1
+        )
+        if num_tokens <= 0:
+            return []
+        if request.draft_state is None:
+            request.draft_state = _DraftState(
+                prompt_ids=[
+                    t for t in request.prompt_ids if t not in self.ignore_token_ids
+                ]
+            )
+        state = request.draft_state
+        context = state.prompt_ids + request.output_ids
+
+        # The drafts fed last time are only valid as far as the sequence took them
+        keep = state.context_len
+        for fed_id, token_id in zip(state.token_ids[keep:], context[keep:]):
+            if fed_id != token_id:
+                break
+            keep += 1
+        keep = min(keep, len(context) - 1)
+        if keep < len(state.token_ids):
+            state.cache.crop(keep)
+            del state.token_ids[keep:]
+        state.context_len = len(context)
+
+        draft_ids = []
+        new_ids = context[keep:]
+        for _ in range(num_tokens):
+            start = len(state.token_ids)
+            positions = torch.arange(start, start + len(new_ids), device=self.device)
+            outputs = self.model(
+                input_ids=torch.tensor([new_ids], device=self.device),
+                position_ids=positions[None],
+                cache_position=positions,
+                past_key_values=state.cache,
+                use_cache=True,
+                num_logits_to_keep=1,
+            )
+            state.cache = outputs.past_key_values
+            state.token_ids.extend(new_ids)
+            draft_ids.append(int(outputs.logits[0, -1].argmax()))
+            if draft_ids[-1] in request.eos_token_ids:
+                break
+            new_ids = draft_ids[-1:]
+        return draft_ids
+
+    def release(self, request):
+        request.draft_state = None
+
+
+class PromptLookupProposer:
+    """
+    Propose the tokens that followed the latest earlier occurrence of the sequence's last
+    n tokens (prompt lookup decoding), trying the longest n-gram first.
+
+    Nothing but an index of the prompt and output is needed, so proposing is nearly free.
+    It pays off when the output copies spans of the prompt: keys and structure of a JSON
+    schema, text read from a document, or an earlier turn of the conversation.
+
+    Parameters:
+    num_tokens (int): Maximum number of tokens proposed per step.
+    max_ngram (int): Longest suffix of the sequence looked up.
+    min_ngram (int): Shortest suffix of the sequence looked up.
+    """
+
+    def __init__(self, num_tokens: int = 8, max_ngram: int = 3, min_ngram: int = 1):
+        self.num_tokens = num_tokens
+        self.ngram_sizes = range(max_ngram, min_ngram - 1, -1)
+
+    def propose(self, request) -> List[int]:
+        num_tokens = min(
+            self.num_tokens, request.max_new_tokens - len(request.output_ids) - 1
+        )
+        if num_tokens <= 0:
+            return []
+        if request.draft_state is None:
+            request.draft_state = _LookupState(index=[{} for _ in self.ngram_sizes])
+        state = request.draft_state
+        context = request.prompt_ids + request.output_ids
+
+        # Index the n-grams that are followed by a known token, the latest one wins
+        for end in range(max(state.indexed, 1), len(context)):
+            for index, n in zip(state.index, self.ngram_sizes):
+                if end >= n:
+                    index[tuple(context[end - n : end])] = end
+        state.indexed = len(context)
+
+        for index, n in zip(state.index, self.ngram_sizes):
+            start = index.get(tuple(context[-n:]))
+            if start is not None:
+                return context[start : start + num_tokens]
+        return []
+
+    def release(self, request):
+        request.draft_state = None
@@ -0,0 +1,162 @@
+import json
+import re
+import time
+from typing import Iterable, List
+
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+from transformers import MllamaImageProcessor, MllamaProcessor, PreTrainedTokenizerFast
+
+SPECIAL_TOKENS = [
+    "<|begin_of_text|>",
+    "<|end_of_text|>",
+    "<|start_header_id|>",
+    "<|end_header_id|>",
+    "<|eot_id|>",
+    "<|python_tag|>",
+    "<|image|>",
+    "<|finetune_right_pad_id|>",
+]
+
+# Same layout as the Llama 3.2 Vision template, without the date and tool preambles
+CHAT_TEMPLATE = (
+    "{{- bos_token }}"
+    "{%- for message in messages %}"
+    "<|start_header_id|>{{ message['role'] }}<|end_header_id|>\n\n"
+    "{%- if message['content'] is string %}{{ message['content'] }}"
+    "{%- else %}{%- for content in message['content'] %}"
+    "{%- if content['type'] == 'image' %}{{ '<|image|>' }}"
+    "{%- elif content['type'] == 'text' %}{{ content['text'] }}{%- endif %}"
+    "{%- endfor %}{%- endif %}<|eot_id|>"
+    "{%- endfor %}"
+    "{%- if add_generation_prompt %}<|start_header_id|>assistant<|end_header_id|>\n\n"
+    "{%- endif %}"
+)
+
+WORDS = (
+    "the image shows a receipt with several items listed along with their prices "
+    "and a total at the bottom of the page"
+).split()
+
+
+def stub_processor() -> MllamaProcessor:
+    """
+    Mllama processor with a byte-level tokenizer, built without downloading anything.
+
+    The image processor is the real one with its default settings, so image
+    preprocessing costs the same as with the model's processor.
+    """
+    alphabet = sorted(pre_tokenizers.ByteLevel.alphabet())
+    tokenizer = Tokenizer(
+        models.BPE(vocab={c: i for i, c in enumerate(alphabet)}, merges=[])
+    )
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    tokenizer.add_special_tokens(SPECIAL_TOKENS)
+
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        bos_token="<|begin_of_text|>",
+        eos_token="<|eot_id|>",
+        pad_token="<|finetune_right_pad_id|>",
+        model_input_names=["input_ids", "attention_mask"],
+    )
+    processor = MllamaProcessor(MllamaImageProcessor(), tokenizer)
+    processor.chat_template = CHAT_TEMPLATE
+    return processor
+
+
+class ScriptedEngine:
+    """
+    Engine for `GenerationScheduler` that replies with scripted tokens at a fixed rate
+    instead of running a model, so the rest of the serving pipeline can be profiled and
+    load tested on a CPU.
+
+    Prompts with the tool system prompt get a call to the first tool and prompts with a
+    response format a JSON object; anything else gets words until `max_new_tokens`.
+
+    Parameters:
+    tokenizer: Tokenizer used to encode the scripts.
+    tokens_per_second (float): Decode steps per second, each step yields one token per request.
+    time_to_first_token (float): Seconds each prefill takes.
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        tokens_per_second: float = 50,
+        time_to_first_token: float = 0.05,
+    ):
+        self.tokenizer = tokenizer
+        self.vocab_size = len(tokenizer)
+        self.tokens_per_second = tokens_per_second
+        self.time_to_first_token = time_to_first_token
+
+    def prefill(self, requests) -> List[torch.Tensor]:
+        time.sleep(self.time_to_first_token)
+        for request in requests:
+            mask = request.inputs["attention_mask"][request.row].bool()
+            prompt_ids = request.inputs["input_ids"][request.row][mask]
+            request.prompt_tokens = len(prompt_ids)
+            request.prompt_ids = prompt_ids.tolist()
+            request.state = _Script(
+                self._script(self.tokenizer.decode(prompt_ids)),
+                end=self.tokenizer.eos_token_id,
+            )
+        return [self._next_logits(request) for request in requests]
+
+    def decode(self, requests, tokens) -> List[torch.Tensor]:
+        time.sleep(1 / self.tokens_per_second)
+        return [self._next_logits(request) for request in requests]
+
+    def verify(self, request, tokens) -> torch.Tensor:
+        # Scoring several tokens costs one decode step, as on a GPU at small batch sizes
+        time.sleep(1 / self.tokens_per_second)
+        return torch.stack([self._next_logits(request) for _ in tokens])
+
+    def rewind(self, request, num_tokens: int):
+        request.state.rewind(num_tokens)
+
+    def release(self, request, reusable: bool = True):
+        request.state = None
+
+    def _script(self, prompt: str):
+        match = re.search(r'"name": "(\w+)"', prompt)
+        if "composing functions" in prompt and match:
+            text = f"[{match.group(1)}(n=5)]"
+        elif "<response_format>" in prompt:
+            text = json.dumps({"answer": " ".join(WORDS)})
+        else:
+            return self._words()
+        ids = self.tokenizer.encode(text, add_special_tokens=False)
+        return [*ids, self.tokenizer.eos_token_id]
+
+    def _words(self):
+        while True:
+            for word in WORDS:
+                yield from self.tokenizer.encode(" " + word, add_special_tokens=False)
+
+    def _next_logits(self, request) -> torch.Tensor:
+        # Finite, so that a grammar disallowing the scripted token leaves other choices
+        logits = torch.full((self.vocab_size,), -1e4)
+        logits[next(request.state)] = 0.0
+        return logits
+
+
+class _Script:
+    """Scripted token ids that can be rewound like a KV cache, `end` once exhausted."""
+
+    def __init__(self, tokens: Iterable[int], end: int):
+        self._tokens = iter(tokens)
+        self._end = end
+        self._seen: List[int] = []
+        self._position = 0
+
+    def __next__(self) -> int:
+        if self._position == len(self._seen):
+            self._seen.append(next(self._tokens, self._end))
+        self._position += 1
+        return self._seen[self._position - 1]
+
+    def rewind(self, num_tokens: int):
+        self._position -= num_tokens
@@ -0,0 +1,147 @@
+import json
+from typing import List
+
+import torch
+
+from src.api.json_grammar import JSONGrammar, TokenVocabulary, _Entry
+
+# State of output that isn't a list of calls, left unconstrained
+_TEXT = (("text",),)
+# Separator between parameters, between a parameter and its value, and the end of a call
+_CALL_SYNTAX = (b", ", b"=", b")")
+
+
+class ToolCallGrammar(JSONGrammar):
+    """
+    Token-level automaton accepting a list of calls to the given functions in the format
+    asked for by `prep_tool_prompt`: `[name(param=value, ...), name(...)]`.
+
+    Only declared function and parameter names are allowed, parameters in the order they
+    are declared and required ones present. Values are Python literals typed by the
+    parameter's JSON schema: JSON, but with True, False and None.
+
+    With `allow_text`, output that doesn't start with "[" is a plain answer and isn't
+    constrained, so the model can still reply instead of calling a function.
+
+    Parameters:
+    functions: Function definitions of the request's tools, with name and parameters.
+    vocabulary (TokenVocabulary): Bytes of the tokenizer's tokens.
+    allow_text (bool): Whether the output may be text rather than calls.
+    """
+
+    _any_literals = (b"True", b"False", b"None")
+    # Python doesn't unescape "\/"
+    _escapes = set(b'"\\bfnrt')
+
+    def __init__(
+        self, functions: List[dict], vocabulary: TokenVocabulary, allow_text=True
+    ):
+        self.allow_text = allow_text
+        super().__init__(functions, vocabulary)
+
+    def _start(self, functions) -> tuple:
+        calls = {}
+        for function in functions:
+            parameters = function.get("parameters") or {}
+            required = set(parameters.get("required", []))
+            calls[function["name"].encode() + b"("] = self._object(
+                [
+                    (name.encode(), value, name in required)
+                    for name, value in (parameters.get("properties") or {}).items()
+                ],
+                _CALL_SYNTAX,
+            )
+        # (text up to the arguments, node of the arguments) per function
+        self._calls = tuple(calls.items())
+        return (("start",),)
+
+    def _dumps(self, value) -> bytes:
+        return _python_literal(value).encode()
+
+    def _step_frame(self, frame: tuple, rest: tuple, byte: int):
+        kind = frame[0]
+        if kind == "text":
+            return _TEXT, True
+        if kind == "start":
+            if byte == ord("["):
+                return rest + (("calls", "next"),), True
+            return (_TEXT if self.allow_text else None), True
+
+        if kind == "calls":
+            phase = frame[1]
+            if phase == "next":
+                # The byte starts the name of a call
+                return rest + (("calls", "after"), ("name", 0, None)), False
+            if phase == "after":
+                if byte == ord("]"):
+                    return rest, True
+                return (
+                    rest + (("calls", "comma"),) if byte == ord(",") else None
+                ), True
+            return (rest + (("calls", "next"),) if byte == ord(" ") else None), True
+
+        if kind == "name":
+            _, pos, alive = frame
+            alive = tuple(
+                i
+                for i in (range(len(self._calls)) if alive is None else alive)
+                if self._calls[i][0][pos] == byte
+            )
+            if not alive:
+                return None, True
+            text, arguments = self._calls[alive[0]]
+            if len(alive) > 1 or len(text) > pos + 1:
+                return rest + (("name", pos + 1, alive),), True
+            return rest + (("key", arguments, 0, False, 0, None),), True
+        return super()._step_frame(frame, rest, byte)
+
+    def _can_end(self, state: tuple) -> bool:
+        return state == _TEXT or super()._can_end(state)
+
+    def advance(self, state: tuple, token_id: int):
+        if state == _TEXT:
+            return state
+        return super().advance(state, token_id)
+
+    def forced_token(self, state: tuple):
+        if state == _TEXT:
+            return None
+        return super().forced_token(state)
+
+    def constrain(self, state: tuple, logits: torch.Tensor) -> torch.Tensor:
+        if state == _TEXT:
+            return logits
+        return super().constrain(state, logits)
+
+    def _compute(self, state: tuple) -> _Entry:
+        if state != self.initial_state or not self.allow_text:
+            return super()._compute(state)
+        # Any token but those starting a list of calls the grammar doesn't allow
+        mask = torch.ones(self.vocabulary.size, dtype=torch.bool)
+        bracket = self.vocabulary.trie[0].get(ord("["))
+        if bracket is not None:
+            mask[_subtree_ids(bracket)] = False
+            after = self._step(state, ord("["))
+            mask[bracket[1] + self._allowed_ids(bracket, after)] = True
+        return _Entry(allowed=mask, is_mask=True, forced=None)
+
+
+def _subtree_ids(trie: list) -> List[int]:
+    ids, nodes = [], [trie]
+    while nodes:
+        node = nodes.pop()
+        ids.extend(node[1])
+        nodes.extend(node[0].values())
+    return ids
+
+
+def _python_literal(value) -> str:
+    """Spell a JSON value as a Python literal, in the compact style of the calls."""
+    if value is None or isinstance(value, bool):
+        return repr(value)
+    if isinstance(value, dict):
+        items = (f"{json.dumps(k)}: {_python_literal(v)}" for k, v in value.items())
+        return "{" + ", ".join(items) + "}"
+    if isinstance(value, list):
+        return "[" + ", ".join(map(_python_literal, value)) + "]"
+    return json.dumps(value)
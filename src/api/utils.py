@@ -1,12 +1,11 @@
-import base64
-import concurrent.futures
+import binascii
 import json
 import os
 import re
 from io import BytesIO
 from typing import Dict, List, Union
 
-import requests
+from fastapi import HTTPException
 from litserve.specs.openai import (
     ChatCompletionRequest,
     ChatMessage,
@@ -15,28 +14,54 @@ from litserve.specs.openai import (
 )
 from PIL import Image
 
+from src.api.cache import LRUCache, content_hash
+from src.api.fetch import image_fetcher
+from src.api.image_store import IMAGE_ID_PREFIX, image_store
+from src.api.prompt_cache import PromptCache, canonical_hash
+from src.config import IMAGE_CACHE_MAX_BYTES, PROMPT_CACHE_MAX_BYTES
+from src.image_policy import fit_image
+
+# Decoded and resized images, keyed by a hash of their source
+image_cache = LRUCache(
+    IMAGE_CACHE_MAX_BYTES,
+    sizeof=lambda image: image.width * image.height * len(image.getbands()),
+)
+
+# Rendered system prompts and the token ids they start with
+prompt_cache = PromptCache(PROMPT_CACHE_MAX_BYTES)
+
 
 def read_image(source):
     """
-    Read an image from a real image URL or a base64-encoded URL.
+    Read an image from a real image URL, a base64-encoded URL, the id of an uploaded image
+    or the bytes of an image file.
 
     Parameters:
-    source (str): The image source. Can be a real image URL or a base64 URL string.
+    source (str or bytes): The image source. Can be a real image URL, a base64 URL string,
+        an image store id (`image://<sha256>`) or the file's bytes, which aren't copied.
 
     Returns:
-    Image or None: The Image object if the source is valid, otherwise None.
+    Image or None: The Image object, downscaled to the model's tile canvas (see
+    `src.image_policy`), if the source is valid, otherwise None.
     """
     try:
-        if re.match(r"^https?://", source):
+        if isinstance(source, bytes):
+            # Raw image bytes, BytesIO shares the buffer instead of copying it
+            fp = BytesIO(source)
+        elif re.match(r"^https?://", source):
             # It's a real image URL
-            return Image.open(requests.get(source, stream=True).raw).convert("RGB")
+            fp = BytesIO(image_fetcher.fetch(source))
         elif re.match(r"^data:image/.+;base64,", source):
-            # It's a base64 image URL
-            base64_image = source.split(",")[1]
-            image_data = base64.b64decode(base64_image)
-            return Image.open(BytesIO(image_data)).convert("RGB")
+            # It's a base64 image URL, decoded from a view past the header instead of a
+            # copy of the payload
+            payload = memoryview(source.encode("ascii"))[source.index(",") + 1 :]
+            fp = BytesIO(binascii.a2b_base64(payload))
+        elif source.startswith(IMAGE_ID_PREFIX):
+            # It's an image uploaded to the image store
+            fp = image_store.path(source)
         else:
-            return Image.open(source).convert("RGB")
+            fp = source
+        return fit_image(Image.open(fp))
     except Exception as e:
         print(f"An error occurred: {e}")
         return None
@@ -77,7 +102,7 @@ def prep_schema_prompt(
     """
     response_format_str = ""
     response_format = response_format.model_dump(exclude_none=True, by_alias=True)
-    schema = response_format.get("json_schema", None).get("schema", None)
+    schema = (response_format.get("json_schema") or {}).get("schema")
 
     if schema:
         response_format_str = (
@@ -87,7 +112,6 @@ def prep_schema_prompt(
             "```\n"
             f"{json.dumps(schema, indent=4)}\n"
             "```\n"
-            "- Always enclose the JSON output in triple backticks (```).\n"
             "- Ensure that only valid JSON output is included, without any additional text or formatting.\n"
             "- Use double quotes for the keys and string values.\n"
             '- DO NOT mistake the "properties" and "type" in the schema as the actual fields in the JSON output.\n'
@@ -98,14 +122,13 @@ def prep_schema_prompt(
             "- Ensure that the JSON output strictly conforms to the schema provided without deviation.\n"
             "- Do validate your JSON output for syntax correctness and adherence to the schema before submission.\n"
             "- Strictly adhere to the schema provided above.\n"
-            "- Return the markdown JSON object as the output without any additional text or comments.\n"
+            "- Return the JSON object alone as the output, without code fences or any other text.\n"
             "</response_format>"
         )
     else:
         response_format_str = (
             "<response_format>\n"
             "Your output should be formatted as a standard JSON instance.\n"
-            "- Always enclose the JSON output in triple backticks (```).\n"
             "- Ensure that only valid JSON output is included, without any additional text or formatting.\n"
             "- Use double quotes for the keys and string values.\n"
             '- DO NOT mistake the "properties" and "type" in the schema as the actual fields in the JSON output.\n'
@@ -115,13 +138,66 @@ def prep_schema_prompt(
     return f"{system_prompt}\n\n{response_format_str}"
 
 
+def build_system_prompt(
+    content: str, tools: List[Tool] | None, response_format: ResponseFormat | None
+) -> str:
+    """
+    Prepare the system prompt with tools and response format, memoized by a canonical
+    hash of all three since the same tools and schemas are sent with most requests.
+    """
+    if not isinstance(content, str):
+        # Not hashable as JSON, build it directly
+        return prep_system_prompt(content, tools, response_format)
+
+    key = canonical_hash(
+        content,
+        [tool.model_dump(exclude_none=True) for tool in tools or []],
+        (
+            response_format.model_dump(exclude_none=True, by_alias=True)
+            if response_format
+            else None
+        ),
+    )
+    return prompt_cache.render(
+        key, lambda: prep_system_prompt(content, tools, response_format)
+    )
+
+
+def prep_system_prompt(content, tools, response_format):
+    if tools:
+        content = prep_tool_prompt(tools)
+    if response_format:
+        content = prep_schema_prompt(content, response_format)
+    return content
+
+
+def image_key(source: str) -> str:
+    """
+    Content-address an image source: URLs and base64 data URLs are hashed as-is,
+    local files by path, size and modification time.
+    """
+    if not re.match(r"^(https?://|data:)", source) and os.path.isfile(source):
+        stat = os.stat(source)
+        source = f"{os.path.abspath(source)}:{stat.st_size}:{stat.st_mtime_ns}"
+    return content_hash(source)
+
+
 def process_image(image_url: str) -> Image:  # type: ignore
     """
-    Process an image: read and resize if its height is greater than 720.
+    Process an image: read and resize it if it is larger than its tile canvas.
+
+    Results are cached, so images resent with every turn of a chat are only decoded once.
     """
+    key = image_key(image_url)
+    image = image_cache.get(key)
+    if image is not None:
+        return image
+
     image = read_image(image_url)
-    if image and image.height > 720:
-        image = image.resize((int(image.width * 720 / image.height), 720))
+    if image:
+        # Lets later stages (prefix and vision caches) identify the image by content
+        image.info["cache_key"] = key
+        image_cache.put(key, image)
     return image  # type: ignore
 
 
@@ -136,11 +212,8 @@ def process_content(
     """
     Process the content of a message based on its type and other conditions.
     """
-    if message.role == "system":
-        if tools:
-            content = prep_tool_prompt(tools)
-        if response_format:
-            content = prep_schema_prompt(content, response_format)
+    if message.role == "system" and (tools or response_format):
+        content = build_system_prompt(content, tools, response_format)
 
     if isinstance(content, list):
         content = process_content_list(content, images)
@@ -166,9 +239,21 @@ def process_content_list(
     return content
 
 
+def describe_image_source(source: str) -> str:
+    """A short description of an image source for error messages."""
+    if source.startswith("data:"):
+        return "a base64 data URL"
+    if source.startswith(IMAGE_ID_PREFIX):
+        if source not in image_store:
+            return f"{source}, which isn't stored, upload it again"
+        return source
+    return source if len(source) <= 200 else source[:200] + "..."
+
+
 def parse_messages(request: ChatCompletionRequest):
     """
-    Parse messages from a ChatCompletionRequest object.
+    Parse messages from a ChatCompletionRequest object, raising HTTPException(400) if an
+    image can't be read.
     """
     messages = []
     images = []
@@ -182,8 +267,13 @@ def parse_messages(request: ChatCompletionRequest):
         )
         messages.append({"role": message.role, "content": content})
 
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        images = list(executor.map(process_image, images))
+    sources, images = images, image_fetcher.map(process_image, images)
+    for index, (source, image) in enumerate(zip(sources, images)):
+        if image is None:
+            raise HTTPException(
+                400,
+                f"Image {index + 1} ({describe_image_source(source)}) can't be read",
+            )
 
     # Prompting with images is incompatible with system messages.
     if images and messages[0]["role"] == "system":
@@ -0,0 +1,42 @@
+from typing import Optional
+
+import torch
+
+from src.api.cache import LRUCache
+
+
+class VisionCache:
+    """
+    Projected vision-encoder outputs (cross-attention states) per image, keyed by the
+    image's content hash, so the vision tower runs once per distinct image.
+
+    Also estimates the encoder time saved: each hit is credited with the running
+    average time it took to encode one image.
+    """
+
+    def __init__(self, max_bytes: int):
+        self._cache = LRUCache(max_bytes, sizeof=lambda states: states.nbytes)
+        self.images_encoded = 0
+        self.encode_seconds = 0.0
+        self.saved_seconds = 0.0
+
+    def get(self, key: str) -> Optional[torch.Tensor]:
+        states = self._cache.get(key)
+        if states is not None and self.images_encoded:
+            self.saved_seconds += self.encode_seconds / self.images_encoded
+        return states
+
+    def put(self, key: str, states: torch.Tensor):
+        self._cache.put(key, states)
+
+    def record_encode(self, num_images: int, seconds: float):
+        self.images_encoded += num_images
+        self.encode_seconds += seconds
+
+    def stats(self) -> dict:
+        return {
+            **self._cache.stats(),
+            "images_encoded": self.images_encoded,
+            "encode_seconds": self.encode_seconds,
+            "saved_seconds": self.saved_seconds,
+        }
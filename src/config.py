@@ -1,6 +1,109 @@
+import os
+import tempfile
+
 IMAGE_EXTENSIONS = [".jpg", ".jpeg", ".png", ".bmp", ".tiff", ".webp"]
 SYSTEM_MESSAGE = {
     "role": "system",
     "content": "You are a helpful assistant.",
 }
 MODEL = "meta-llama/Llama-3.2-11B-Vision-Instruct"
+
+# Model backend of the API server: "hf" runs MODEL, "stub" streams scripted tokens on
+# the CPU to test and profile the serving pipeline without a GPU
+BACKEND = "hf"
+STUB_TOKENS_PER_SECOND = 50
+STUB_TIME_TO_FIRST_TOKEN = 0.05
+
+# Speculative decoding: None to decode one token per step, "draft" to verify tokens
+# proposed by DRAFT_MODEL, a small text-only model sharing MODEL's tokenizer, or
+# "prompt_lookup" to verify tokens copied from the prompt. Requests with a response format
+# use "prompt_lookup" unless another mode is set.
+SPECULATIVE = None
+DRAFT_MODEL = "meta-llama/Llama-3.2-1B-Instruct"
+# Draft tokens proposed per decode step
+NUM_DRAFT_TOKENS = 4
+# Prompt lookup proposes up to this many tokens following a match of the last 1 to
+# PROMPT_LOOKUP_MAX_NGRAM tokens
+NUM_LOOKUP_TOKENS = 8
+PROMPT_LOOKUP_MAX_NGRAM = 3
+
+# The model's processor fits each image onto a canvas of up to IMAGE_MAX_TILES tiles of
+# IMAGE_TILE_SIZE pixels, larger images are shrunk to that size once, by the app or server
+IMAGE_TILE_SIZE = 560
+IMAGE_MAX_TILES = 4
+# The app sends images within IMAGE_UPLOAD_MAX_BYTES as they are, others are re-encoded as
+# JPEG at IMAGE_QUALITY, lowered down to IMAGE_MIN_QUALITY to fit the budget
+IMAGE_UPLOAD_MAX_BYTES = 512 * 1024
+IMAGE_QUALITY = 90
+IMAGE_MIN_QUALITY = 60
+
+# Budget for decoded images kept in memory by the API server
+IMAGE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+# Budget for images tiled for the model (uint8 tiles) kept by each inference worker
+IMAGE_TILE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# Requests are decoded (images fetched, decoded and tiled, prompts rendered, tokenized)
+# by a pool of PREPROCESS_WORKERS processes per inference worker, 0 decodes them in the
+# inference worker. Beyond PREPROCESS_MAX_PENDING requests being decoded, more wait
+PREPROCESS_WORKERS = 2
+PREPROCESS_MAX_PENDING = 32
+
+# Budget for KV states kept on the GPU to reuse the shared prefix of chat turns
+PREFIX_CACHE_MAX_BYTES = 4 * 1024 * 1024 * 1024
+
+# Budget for per-image vision encoder outputs kept on the GPU
+VISION_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+# Agent mode: the server runs the calls of registered tools (src.tools.functions) itself
+# and continues generating after their results, up to AGENT_MAX_STEPS rounds of calls
+AGENT = False
+AGENT_MAX_STEPS = 4
+
+# Generation is stopped for requests running longer than this many seconds
+GENERATION_TIMEOUT = 300
+# Seconds between checks whether a streaming client has disconnected
+CANCEL_CHECK_INTERVAL = 0.25
+
+# Constrain the output of requests with a JSON response format to valid JSON, matching
+# the schema if one is given
+CONSTRAINED_JSON = True
+# Constrain the output of requests with tools to calls of the declared functions, with
+# typed arguments, unless the model answers in text instead
+CONSTRAINED_TOOL_CALLS = True
+# Compiled grammars kept, one per schema or set of tools, with the token masks of the
+# states reached
+JSON_GRAMMAR_CACHE_SIZE = 64
+
+# Budget for rendered tool/schema system prompts and their token ids
+PROMPT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Remote images are downloaded by a shared pool of workers over pooled connections
+IMAGE_FETCH_WORKERS = 8
+# Seconds allowed to connect and to download a whole image
+IMAGE_FETCH_TIMEOUT = 10
+# Larger images are rejected while downloading
+IMAGE_FETCH_MAX_BYTES = 20 * 1024 * 1024
+# Uploaded images (POST /v1/images), referenced by id in later turns instead of being
+# resent. Kept on disk, shared by the server's processes, up to a budget after which the
+# least recently used are removed
+IMAGE_STORE_DIR = os.getenv(
+    "IMAGE_STORE_DIR", os.path.join(tempfile.gettempdir(), "llama-vision-images")
+)
+IMAGE_STORE_MAX_BYTES = 1024 * 1024 * 1024
+# Seconds allowed for the app to upload an image
+IMAGE_UPLOAD_TIMEOUT = 30
+
+# Tool calls of one assistant turn run concurrently on a pool of workers, each call is
+# abandoned after its tool's timeout (TOOL_TIMEOUTS, else TOOL_TIMEOUT) in seconds
+TOOL_WORKERS = 4
+TOOL_TIMEOUT = 15
+TOOL_TIMEOUTS = {"get_top_hf_papers": 10}
+# Seconds a tool result is reused for calls with the same arguments
+TOOL_CACHE_TTL = 10 * 60
+TOOL_CACHE_MAX_ENTRIES = 256
+# Tools stop reading responses larger than this (bytes), e.g. from the papers API
+TOOL_MAX_RESPONSE_BYTES = 10 * 1024 * 1024
+# Hugging Face daily papers API, can point at a local stub to test tools offline
+HF_PAPERS_API_URL = os.getenv(
+    "HF_PAPERS_API_URL", "https://huggingface.co/api/daily_papers"
+)
@@ -0,0 +1,122 @@
+from io import BytesIO
+from typing import Tuple
+
+from PIL import Image
+
+from src.config import (
+    IMAGE_MAX_TILES,
+    IMAGE_MIN_QUALITY,
+    IMAGE_QUALITY,
+    IMAGE_TILE_SIZE,
+    IMAGE_UPLOAD_MAX_BYTES,
+)
+
+# Uploads in these formats are sent as they are if they fit the budget
+PASSTHROUGH_FORMATS = ("JPEG", "PNG", "WEBP")
+
+
+def tile_canvas(
+    width: int,
+    height: int,
+    tile_size: int = IMAGE_TILE_SIZE,
+    max_tiles: int = IMAGE_MAX_TILES,
+) -> Tuple[int, int]:
+    """
+    The canvas of tiles the model's processor fits an image into: the arrangement of up to
+    `max_tiles` tiles needing the least upscaling, or else the least downscaling, with
+    the smallest area on ties. Same as `get_optimal_tiled_canvas` of the Mllama processor,
+    without importing transformers into the app.
+    """
+    canvases = [
+        (columns * tile_size, rows * tile_size)
+        for columns in range(1, max_tiles + 1)
+        for rows in range(1, max_tiles // columns + 1)
+    ]
+    scales = [min(w / width, h / height) for w, h in canvases]
+    upscales = [scale for scale in scales if scale >= 1]
+    scale = min(upscales) if upscales else max(scales)
+    return min(
+        (canvas for canvas, s in zip(canvases, scales) if s == scale),
+        key=lambda canvas: canvas[0] * canvas[1],
+    )
+
+
+def fit_to_canvas(
+    width: int,
+    height: int,
+    tile_size: int = IMAGE_TILE_SIZE,
+    max_tiles: int = IMAGE_MAX_TILES,
+) -> Tuple[Tuple[int, int], Tuple[int, int]]:
+    """
+    The size the model's processor resizes an image to, up or down, and its tile canvas.
+    Same as `get_image_size_fit_to_canvas` of the Mllama processor.
+    """
+    canvas_width, canvas_height = tile_canvas(width, height, tile_size, max_tiles)
+    fit_width = min(max(width, tile_size), canvas_width)
+    fit_height = min(max(height, tile_size), canvas_height)
+    scale_w, scale_h = fit_width / width, fit_height / height
+    if scale_w < scale_h:
+        size = (fit_width, min(int(height * scale_w), fit_height))
+    else:
+        size = (min(int(width * scale_h), fit_width), fit_height)
+    return size, (canvas_width, canvas_height)
+
+
+def target_size(width: int, height: int) -> Tuple[int, int]:
+    """
+    Size to shrink an image to before it is sent to the model: the size the processor would
+    resize it to on its tile canvas, if that is smaller. Larger images lose those pixels
+    anyway, smaller ones are left for the processor to upscale.
+    """
+    size, _ = fit_to_canvas(width, height)
+    if size[0] >= width and size[1] >= height:
+        return width, height
+    return size
+
+
+def fit_image(image: Image) -> Image:  # type: ignore
+    """
+    Decode an opened image as RGB, downscaled to its `target_size`.
+
+    JPEGs are decoded at a reduced scale (`draft`) and then shrunk by an integer factor
+    (`reduce`) before the final resample, instead of being decoded at full resolution.
+    """
+    size = target_size(*image.size)
+    if size != image.size:
+        # Only affects JPEGs, picks the smallest DCT scale still larger than `size`
+        image.draft("RGB", size)
+    else:
+        size = None
+
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    if size:
+        return image.resize(size, resample=Image.BICUBIC, reducing_gap=3.0)
+    image.load()
+    return image
+
+
+def prepare_upload(data: bytes) -> bytes:
+    """
+    Prepare an image file to send to the model. Files in a common format within
+    IMAGE_UPLOAD_MAX_BYTES are sent as they are, without a lossy re-encoding, and the server
+    fits them to their tile canvas. Others are fitted here and saved as JPEG at
+    IMAGE_QUALITY, lowered down to IMAGE_MIN_QUALITY if needed to fit the budget.
+    """
+    image = Image.open(BytesIO(data))
+    if image.format in PASSTHROUGH_FORMATS and len(data) <= IMAGE_UPLOAD_MAX_BYTES:
+        return data
+
+    image = fit_image(image)
+    quality = IMAGE_QUALITY
+    while True:
+        buffered = BytesIO()
+        image.save(buffered, format="JPEG", quality=quality)
+        if buffered.tell() <= IMAGE_UPLOAD_MAX_BYTES or quality <= IMAGE_MIN_QUALITY:
+            return buffered.getvalue()
+        quality = max(quality - 10, IMAGE_MIN_QUALITY)
+
+
+def mime_type(data: bytes) -> str:
+    """MIME type of an image file, from its header."""
+    return Image.MIME[Image.open(BytesIO(data)).format]
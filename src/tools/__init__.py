@@ -1,4 +1,15 @@
 from .get_top_hf_papers import get_top_hf_papers, get_top_hf_papers_json
+from .runtime import ToolResult, ToolRuntime
+
+__all__ = [
+    "ToolResult",
+    "ToolRuntime",
+    "available_tools",
+    "functions",
+    "get_top_hf_papers",
+    "get_top_hf_papers_json",
+    "tool_runtime",
+]
 
 available_tools = [
     get_top_hf_papers_json,
@@ -7,3 +18,6 @@ available_tools = [
 functions = {
     "get_top_hf_papers": get_top_hf_papers,
 }
+
+# Shared by all chat sessions of this process, so cached results outlive a rerun
+tool_runtime = ToolRuntime(functions)
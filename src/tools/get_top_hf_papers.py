@@ -1,61 +1,75 @@
 import json
+import time
 import requests
 from datetime import datetime
 
-API_URL = "https://huggingface.co/api/daily_papers"
+from src.config import HF_PAPERS_API_URL, TOOL_MAX_RESPONSE_BYTES, TOOL_TIMEOUTS
+
+API_URL = HF_PAPERS_API_URL
+# Seconds allowed to fetch the papers
+REQUEST_TIMEOUT = TOOL_TIMEOUTS["get_top_hf_papers"]
+CHUNK_SIZE = 64 * 1024
+MAX_RESPONSE_BYTES = TOOL_MAX_RESPONSE_BYTES
 CURRENT_DATE = datetime.now().strftime("%Y-%m-%d")
 
 
-def get_top_hf_papers(n: int, date: str = CURRENT_DATE) -> str:
+def get_top_hf_papers(
+    n: int, date: str = CURRENT_DATE, timeout: float = REQUEST_TIMEOUT
+) -> str:
     f"""
     Fetches the top N papers from the Hugging Face papers page based on the number of votes.
 
     Args:
     n (int): Number of top papers to fetch.
     date (str): The date of the papers to fetch, in the format "YYYY-MM-DD". Defaults to {date}.
+    timeout (float): Seconds allowed to fetch the papers, set by the ToolRuntime.
+
+    Raises requests.RequestException if the papers can't be fetched, TimeoutError if the
+    response takes longer than `timeout` or ValueError if it is over MAX_RESPONSE_BYTES,
+    so that failures aren't cached as an empty list.
     """
-    top_papers = []
-    try:
-        response = requests.get(f"{API_URL}?date={date}&limit=50")
+    deadline = time.monotonic() + timeout
+    with requests.get(
+        API_URL, params={"date": date, "limit": 50}, stream=True, timeout=timeout
+    ) as response:
         response.raise_for_status()
-        data = response.json()
-        if not data:
-            raise Exception("No papers found")
-
-        paper_info = []
-        for paper in data:
-            title = paper.get("paper", {}).get("title", "Unknown")
-            link = (
-                f"https://huggingface.co/papers/{paper.get('paper', {}).get('id', '')}"
-            )
-            upvotes = paper.get("paper", {}).get("upvotes", 0)
-            thumbnail = paper.get("thumbnail", "")
+        body = bytearray()
+        # requests' timeout only bounds each read, a trickling server is cut off here
+        while chunk := response.raw.read1(CHUNK_SIZE, decode_content=True):
+            body += chunk
+            if len(body) > MAX_RESPONSE_BYTES:
+                raise ValueError(f"The papers are over {MAX_RESPONSE_BYTES} bytes")
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Fetching the papers took over {timeout}s")
+    data = json.loads(body)
 
-            authors = [
-                author.get("name", "")
-                for author in paper.get("paper", {}).get("authors", [])
-            ]
-            published_date = paper.get("paper", {}).get("publishedAt", "")
-            summary = paper.get("paper", {}).get("summary", "")
-            paper_info.append(
-                {
-                    "title": title,
-                    "link": link,
-                    "upvotes": upvotes,
-                    "thumbnail": thumbnail,
-                    "authors": authors,
-                    "published_date": published_date,
-                    "summary": summary,
-                }
-            )
+    paper_info = []
+    for paper in data:
+        title = paper.get("paper", {}).get("title", "Unknown")
+        link = f"https://huggingface.co/papers/{paper.get('paper', {}).get('id', '')}"
+        upvotes = paper.get("paper", {}).get("upvotes", 0)
+        thumbnail = paper.get("thumbnail", "")
 
-        paper_info.sort(key=lambda x: x["upvotes"], reverse=True)
-        top_papers = paper_info[:n]
+        authors = [
+            author.get("name", "")
+            for author in paper.get("paper", {}).get("authors", [])
+        ]
+        published_date = paper.get("paper", {}).get("publishedAt", "")
+        summary = paper.get("paper", {}).get("summary", "")
+        paper_info.append(
+            {
+                "title": title,
+                "link": link,
+                "upvotes": upvotes,
+                "thumbnail": thumbnail,
+                "authors": authors,
+                "published_date": published_date,
+                "summary": summary,
+            }
+        )
 
-    except requests.RequestException as e:
-        print(f"Error fetching papers: {e}")
-    except Exception as e:
-        print(f"Unexpected error: {e}")
+    paper_info.sort(key=lambda x: x["upvotes"], reverse=True)
+    top_papers = paper_info[:n]
 
     return json.dumps(top_papers, indent=2)
 
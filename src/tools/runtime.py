@@ -0,0 +1,186 @@
+import concurrent.futures
+import inspect
+import json
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+from src.config import (
+    TOOL_CACHE_MAX_ENTRIES,
+    TOOL_CACHE_TTL,
+    TOOL_TIMEOUT,
+    TOOL_TIMEOUTS,
+    TOOL_WORKERS,
+)
+
+
+@dataclass
+class ToolResult:
+    name: str
+    args: dict
+    # Returned by the tool, or a description of why it failed, sent back to the model
+    content: str
+    error: bool = False
+    cached: bool = False
+    seconds: float = 0.0
+
+
+class ToolRuntime:
+    """
+    Process-wide layer for running the tool calls of the model.
+
+    The calls of one assistant turn are independent, so they run concurrently on a
+    bounded pool of workers and the turn takes as long as its slowest call. A call that
+    takes longer than its tool's timeout is abandoned and reported to the model as an
+    error. Results are reused for a while by calls with the same function name and
+    arguments, e.g. the daily papers of a date, and identical calls of one turn run once.
+    Failed calls aren't cached.
+
+    A running thread can't be stopped, so an abandoned call keeps its worker until it
+    returns. Tools accepting a `timeout` keyword are passed the seconds left for the call
+    when it starts running, after any wait for a worker, and should give up by then; a tool ignoring it can starve the pool if it hangs.
+
+    Parameters:
+    functions (dict): Tool functions by name.
+    max_workers (int): Number of tool calls run at once.
+    timeout (float): Seconds allowed per call, unless set for its tool in `timeouts`.
+    timeouts (dict): Seconds allowed per call of a tool, by name.
+    ttl (float): Seconds a result is reused.
+    max_entries (int): Results kept, the oldest are dropped first.
+    """
+
+    def __init__(
+        self,
+        functions: Dict[str, Callable],
+        max_workers: int = TOOL_WORKERS,
+        timeout: float = TOOL_TIMEOUT,
+        timeouts: Optional[Dict[str, float]] = None,
+        ttl: float = TOOL_CACHE_TTL,
+        max_entries: int = TOOL_CACHE_MAX_ENTRIES,
+    ):
+        self.functions = functions
+        self.timeout = timeout
+        self.timeouts = TOOL_TIMEOUTS if timeouts is None else timeouts
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # Calls past their timeout that are still running
+        self.abandoned = 0
+        self._takes_timeout = {
+            name
+            for name, function in functions.items()
+            if "timeout" in inspect.signature(function).parameters
+        }
+        # Cache key -> (expiry time, content)
+        self._results: Dict[str, Tuple[float, str]] = {}
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="tool"
+        )
+
+    def run(self, calls: List[Tuple[str, dict]]) -> List[ToolResult]:
+        """Run (function name, arguments) calls concurrently, returning results in order."""
+        start = time.monotonic()
+        pending = {}
+        abandoned = set()
+        results = []
+        for name, args in calls:
+            key = self._key(name, args)
+            content = self._cached(key)
+            if content is not None:
+                results.append(ToolResult(name, args, content, cached=True))
+                continue
+            if name not in self.functions:
+                results.append(
+                    ToolResult(name, args, f"Unknown function: {name}", error=True)
+                )
+                continue
+            if key not in pending:
+                function = self.functions[name]
+                if name in self._takes_timeout:
+                    deadline = start + self.timeouts.get(name, self.timeout)
+                    pending[key] = self._executor.submit(
+                        _call_by, function, args, deadline
+                    )
+                else:
+                    pending[key] = self._executor.submit(function, **args)
+            results.append(pending[key])
+
+        for i, (name, args) in enumerate(calls):
+            if isinstance(results[i], ToolResult):
+                continue
+            key = self._key(name, args)
+            timeout = self.timeouts.get(name, self.timeout)
+            try:
+                remaining = max(start + timeout - time.monotonic(), 0)
+                content = results[i].result(timeout=remaining)
+                error = False
+            except concurrent.futures.TimeoutError:
+                future = results[i]
+                if not future.cancel() and future not in abandoned:
+                    abandoned.add(future)
+                    self._abandon(future)
+                content, error = f"{name} timed out after {timeout}s", True
+            except Exception as e:
+                content, error = f"{name} failed: {type(e).__name__}: {e}", True
+            if not error:
+                content = content if isinstance(content, str) else json.dumps(content)
+                self._store(key, content)
+            results[i] = ToolResult(
+                name, args, content, error=error, seconds=time.monotonic() - start
+            )
+        return results
+
+    def _abandon(self, future: concurrent.futures.Future):
+        with self._lock:
+            self.abandoned += 1
+        future.add_done_callback(self._release_abandoned)
+
+    def _release_abandoned(self, future: concurrent.futures.Future):
+        with self._lock:
+            self.abandoned -= 1
+
+    def _key(self, name: str, args: dict) -> str:
+        return json.dumps([name, args], sort_keys=True, separators=(",", ":"))
+
+    def _cached(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1]
+
+    def _store(self, key: str, content: str):
+        with self._lock:
+            now = time.monotonic()
+            self._results.pop(key, None)
+            self._results[key] = (now + self.ttl, content)
+            # Expired results first, then the oldest
+            for stale in [
+                k for k, (expiry, _) in self._results.items() if expiry < now
+            ]:
+                del self._results[stale]
+            while len(self._results) > self.max_entries:
+                del self._results[next(iter(self._results))]
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._results),
+                "hits": self.hits,
+                "misses": self.misses,
+                "abandoned": self.abandoned,
+            }
+
+
+def _call_by(function: Callable, args: dict, deadline: float):
+    """Call a tool with the seconds left until `deadline` once it runs, not when queued."""
+    return function(**{**args, "timeout": max(deadline - time.monotonic(), 0)})
@@ -105,15 +105,17 @@ def parse_python_list_for_function_calls(input_string):
     return result
 
 
-def prepare_tool(tool_name: str, args: dict):
+def prepare_tool(tool_name: str, args: dict, index: int = 0):
     """
     Prepare a tool call in the format expected by the API.
 
     Args:
         tool_name (str): The name of the tool.
         args (dict): The arguments to pass to the tool
+        index (int): Position of the call in the response, used to merge streamed deltas
     """
     return {
+        "index": index,
         "id": generate_call_id(),
         "type": "function",
         "function": {
@@ -123,6 +125,165 @@ def prepare_tool(tool_name: str, args: dict):
     }
 
 
+def parse_python_function_call(input_string):
+    """Parse a single `func_name(param=value, ...)` call, returning (name, args) or None"""
+    try:
+        node = ast.parse(input_string.strip(), mode="eval").body
+    except SyntaxError:
+        return None
+    if (
+        not isinstance(node, ast.Call)
+        or not isinstance(node.func, ast.Name)
+        or node.args
+    ):
+        return None
+    try:
+        return node.func.id, {
+            kw.arg: ast.literal_eval(kw.value) for kw in node.keywords
+        }
+    except ValueError:
+        return None
+
+
+FUNCTION_TAG_PATTERN = re.compile(r"<function=(?P<function_name>[^}>]+)>\s*$")
+OPENING_BRACKETS = "{[("
+CLOSING_BRACKETS = "}])"
+
+
+class ToolCallParser:
+    """
+    Incrementally extract tool calls from streamed model output.
+
+    The output format is detected from its first characters (`<function=`, `{` or `[`).
+    Each chunk is then scanned once, keeping the bracket depth and string state across
+    chunks, and a call is only parsed when its closing bracket arrives. The work per
+    token therefore stays constant however long the output gets, and every completed
+    call is returned exactly once.
+    """
+
+    def __init__(self):
+        self.format = None  # "function", "json", "python" or "text" once detected
+        self.calls = []
+        self._text = ""
+        self._pos = 0  # next character to scan
+        self._depth = 0
+        self._quote = None
+        self._escape = False
+        self._call_start = None
+        self._segment_start = 0  # end of the previous call
+
+    @property
+    def is_tool_call(self) -> bool:
+        return self.format not in (None, "text")
+
+    def feed(self, text: str) -> List[dict]:
+        """Consume the next chunk of output and return the tool calls it completed."""
+        if self.format == "text":
+            return []
+        self._text += text
+        if self.format is None and not self._detect_format():
+            return []
+
+        completed = []
+        text = self._text
+        for pos in range(self._pos, len(text)):
+            segment = self._scan(text[pos], pos)
+            if segment is not None:
+                tool = self._parse(*segment)
+                if tool is not None:
+                    # Recorded at once, the next call's index counts it
+                    self.calls.append(tool)
+                    completed.append(tool)
+        self._pos = len(text)
+        return completed
+
+    def _detect_format(self) -> bool:
+        text = self._text.lstrip()
+        if not text or (len(text) < 10 and "<function=".startswith(text)):
+            # Not enough output yet to tell
+            return False
+        if text.startswith("<function="):
+            self.format = "function"
+        elif text.startswith("{"):
+            self.format = "json"
+        elif text.startswith("["):
+            self.format = "python"
+        else:
+            self.format = "text"
+            return False
+        self._text = text
+        return True
+
+    def _scan(self, char: str, pos: int):
+        """Advance the scanner by one character, returning a call's (start, end) once it closes."""
+        if self._quote:
+            if self._escape:
+                self._escape = False
+            elif char == "\\":
+                self._escape = True
+            elif char == self._quote:
+                self._quote = None
+            return None
+
+        # Python calls sit inside the outer list, the other formats at the top level
+        call_depth = 1 if self.format == "python" else 0
+        if char in "\"'":
+            self._quote = char
+        elif char in OPENING_BRACKETS:
+            if self._depth == call_depth and self._call_start is None:
+                self._call_start = pos
+            self._depth += 1
+        elif char in CLOSING_BRACKETS:
+            self._depth -= 1
+            if self._depth == call_depth and self._call_start is not None:
+                start, self._call_start = self._call_start, None
+                return start, pos + 1
+        elif self.format == "python" and self._depth == call_depth:
+            if char == ",":
+                # Skip list elements that aren't calls
+                self._call_start = None
+            elif self._call_start is None and not char.isspace():
+                # The name of the next call
+                self._call_start = pos
+        return None
+
+    def _parse(self, start: int, end: int):
+        header = self._text[self._segment_start : start]
+        segment = self._text[start:end]
+        self._segment_start = end
+        index = len(self.calls)
+
+        if self.format == "function":
+            match = FUNCTION_TAG_PATTERN.search(header)
+            if not match:
+                return None
+            try:
+                args = json.loads(segment.replace("'", '"'))
+            except Exception as e:
+                print(
+                    "Exception while parsing json query for custom tool call",
+                    segment,
+                    e,
+                )
+                return None
+            return prepare_tool(match.group("function_name"), args, index)
+
+        if self.format == "json":
+            if not is_json(segment):
+                return None
+            response = json.loads(segment)
+            if response.get("type") == "function" or "name" in response:
+                return prepare_tool(
+                    response["name"], response.get("parameters", {}), index
+                )
+            return None
+
+        call = parse_python_function_call(segment)
+        if call is None:
+            return None
+        return prepare_tool(*call, index)
+
+
 class ToolUtils:
     @staticmethod
     def maybe_extract_custom_tool_calls(
@@ -188,3 +349,9 @@ if __name__ == "__main__":
     input_string = "[func1(arg1='value1', arg2=10)]"
     result = ToolUtils.maybe_extract_custom_tool_calls(input_string)
     print(result)
+
+    # example 5: streamed output, each call is returned once it is complete
+    parser = ToolCallParser()
+    for i in range(0, len(message_body), 4):
+        for tool in parser.feed(message_body[i : i + 4]):
+            print(tool)
@@ -3,7 +3,7 @@ import json
 import streamlit as st
 
 from src.config import IMAGE_EXTENSIONS, SYSTEM_MESSAGE
-from src.ui.utils import all_images, encode_image
+from src.ui.utils import all_images, image_object
 from src.tools import available_tools
 
 
@@ -23,7 +23,7 @@ def file_upload():
         # check if all of the uploaded files are images or videos
         if all_images(uploaded_files) and len(uploaded_files) <= 3:
             with st.sidebar.status("Processing image..."):
-                file_objects = [encode_image(image) for image in uploaded_files]
+                file_objects = [image_object(image) for image in uploaded_files]
                 st.sidebar.image(uploaded_files, use_column_width=True)
         else:
             st.error(
@@ -1,10 +1,21 @@
 import base64
+import itertools
 import os
-from io import BytesIO
 from typing import List
 
-from src.config import IMAGE_EXTENSIONS
-from PIL import Image
+import requests
+from src.api import client
+from src.api.cache import LRUCache, content_hash
+from src.config import IMAGE_EXTENSIONS, IMAGE_UPLOAD_TIMEOUT
+from src.image_policy import mime_type, prepare_upload
+
+# `image_url` parts of image files by hash of the file, so each is prepared and uploaded
+# once instead of on every rerun
+_image_objects = LRUCache(
+    64 * 1024 * 1024, sizeof=lambda part: len(part["image_url"]["url"])
+)
+# Prepared image files by image store id, to show the images of earlier turns
+_image_previews = LRUCache(256 * 1024 * 1024, sizeof=len)
 
 
 def get_file_extension(filename):
@@ -31,46 +42,185 @@ def prepare_content_with_images(content: str, images: List[object]):
     return content
 
 
+def stream_text(stream, tool_calls: dict):
+    """
+    Yield the text of a streamed chat completion as it arrives, assembling the deltas of
+    its tool calls into `tool_calls`, by index: {"id": ..., "name": ..., "arguments": ...}.
+    """
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        for call in delta.tool_calls or []:
+            assembled = tool_calls.setdefault(
+                call.index, {"id": None, "name": "", "arguments": ""}
+            )
+            if call.id:
+                assembled["id"] = call.id
+            if call.function:
+                assembled["name"] += call.function.name or ""
+                assembled["arguments"] += call.function.arguments or ""
+        if delta.content:
+            yield delta.content
+
+
 def encode_image(image_source):
     """
     Encode an image to a base64 data URL based object.
 
     Parameters:
-    image_source (str or Image): The image source. Can be a real image URL, an Image instance, or a base64 URL string.
+    image_source (str or file): Path or file object of the image.
 
     Returns:
     str or None: The base64-encoded data URL of the image if successful, otherwise None.
     """
+    data = prepare_image(image_source)
+    return data_url_object(data) if data is not None else None
+
+
+def image_object(image_source):
+    """
+    Get the `image_url` part for an image file, referencing it by id in the server's
+    image store so it isn't resent with every turn.
+
+    Files are prepared and uploaded once per content, then the part is reused on every
+    rerun; `create_completion` uploads them again if the server evicted them by the time
+    they are sent. Falls back to a base64 data URL if the server doesn't store images.
+
+    Parameters:
+    image_source (str or file): Path or file object (e.g. an uploaded file) of the image.
+
+    Returns:
+    dict or None: The `image_url` part if the image could be read, otherwise None.
+    """
+    file_data = read_file(image_source)
+    file_key = content_hash(file_data)
+    part = _image_objects.get(file_key)
+    if part is not None:
+        return part
+
+    data = prepare_image(file_data)
+    if data is None:
+        return None
+    image_id = upload_image(data)
+    if image_id is None:
+        part = data_url_object(data)
+    else:
+        part = {"type": "image_url", "image_url": {"url": image_id}}
+        _image_previews.put(image_id, data)
+    _image_objects.put(file_key, part)
+    return part
+
+
+def upload_image(data: bytes):
+    """Upload an image file to the server's image store unless it has it, returning its id."""
     try:
-        image = Image.open(image_source).convert("RGB")
-
-        # resize to max_size
-        max_size = 720
-        if max(image.size) > max_size:
-            w, h = image.size
-            if w > h:
-                new_w = max_size
-                new_h = int(h * max_size / w)
-            else:
-                new_h = max_size
-                new_w = int(w * max_size / h)
-            image = image.resize((new_w, new_h), resample=Image.BICUBIC)
-
-        buffered = BytesIO()
-        # Use image format or default to "JPEG"
-        image_format = image.format if image.format else "JPEG"
-        image.save(buffered, format=image_format)
-        mime_type = f"image/{image_format.lower()}"
-        encoded_image = base64.b64encode(buffered.getvalue()).decode("utf-8")
-        url = f"data:{mime_type};base64,{encoded_image}"
-
-        image_object = {
-            "type": "image_url",
-            "image_url": {
-                "url": url,
-            },
-        }
-        return image_object
+        response = requests.get(f"{_images_url()}/{content_hash(data)}", timeout=10)
+        if response.status_code == 404:
+            return _post_image(data)
+        response.raise_for_status()
+        return response.json()["id"]
+    except (requests.RequestException, ValueError, KeyError) as e:
+        print(f"Error uploading image: {e}")
+        return None
+
+
+def _post_image(data: bytes):
+    response = requests.post(
+        _images_url(),
+        data=data,
+        headers={"Content-Type": mime_type(data)},
+        timeout=IMAGE_UPLOAD_TIMEOUT,
+    )
+    response.raise_for_status()
+    return response.json()["id"]
+
+
+def _images_url() -> str:
+    return f"{str(client.base_url).rstrip('/')}/images"
+
+
+def restore_images(messages: List[dict]) -> bool:
+    """
+    Upload the images of `messages` again if the server's image store evicted them,
+    returning whether any was.
+    """
+    urls = {
+        item["image_url"]["url"]
+        for message in messages
+        if isinstance(message.get("content"), list)
+        for item in message["content"]
+        if "image_url" in item
+    }
+    restored = False
+    for url in urls:
+        data = _image_previews.peek(url)
+        if data is None:
+            continue
+        try:
+            response = requests.get(f"{_images_url()}/{content_hash(data)}", timeout=10)
+            if response.status_code == 404:
+                restored = _post_image(data) == url or restored
+        except (requests.RequestException, ValueError, KeyError) as e:
+            print(f"Error uploading image: {e}")
+    return restored
+
+
+def create_completion(**kwargs):
+    """
+    Stream a chat completion, `client.chat.completions.create(stream=True, **kwargs)`.
+
+    Images are sent by id, so the server rejects the request if its image store evicted
+    one of them since it was uploaded: they are then uploaded again and the request is
+    resent, instead of checking the store before every request.
+    """
+    stream = _started(kwargs)
+    if stream is None and restore_images(kwargs["messages"]):
+        stream = _started(kwargs)
+    return stream if stream is not None else iter(())
+
+
+def _started(kwargs: dict):
+    """
+    Start streaming a completion, returning None if the server rejected the request. The
+    server reports errors in the stream, which then ends without a chunk.
+    """
+    stream = client.chat.completions.create(stream=True, **kwargs)
+    first = next(stream, None)
+    return None if first is None else itertools.chain([first], stream)
+
+
+def image_preview(url: str):
+    """Something `st.image` can show for an image URL, image store ids included."""
+    return _image_previews.get(url) or url
+
+
+def prepare_image(image_source):
+    """Read an image file and prepare it to send to the model, see `prepare_upload`."""
+    try:
+        return prepare_upload(read_file(image_source))
     except Exception as e:
         print(f"Error encoding image: {e}")
         return None
+
+
+def read_file(image_source) -> bytes:
+    """Bytes of a file given by path, file object or as bytes already."""
+    if isinstance(image_source, bytes):
+        return image_source
+    if isinstance(image_source, str):
+        with open(image_source, "rb") as f:
+            return f.read()
+    if hasattr(image_source, "getvalue"):
+        return image_source.getvalue()
+    return image_source.read()
+
+
+def data_url_object(data: bytes):
+    encoded_image = base64.b64encode(data).decode("utf-8")
+    return {
+        "type": "image_url",
+        "image_url": {
+            "url": f"data:{mime_type(data)};base64,{encoded_image}",
+        },
+    }
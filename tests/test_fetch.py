@@ -0,0 +1,129 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+import pytest
+import requests
+from PIL import Image
+
+from src.api.fetch import ImageFetcher
+from src.api.utils import process_image
+
+
+def png_bytes():
+    buffered = BytesIO()
+    Image.new("RGB", (8, 8), (255, 0, 0)).save(buffered, format="PNG")
+    return buffered.getvalue()
+
+
+class StubImageServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.image = png_bytes()
+        self.hits = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.hits[self.path] = server.hits.get(self.path, 0) + 1
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            if self.path.startswith("/image"):
+                self._send(server.image)
+            elif self.path.startswith("/slow"):
+                time.sleep(0.2)
+                self._send(server.image)
+            elif self.path == "/large":
+                self._send(b"\0" * 4096)
+            elif self.path == "/large-unsized":
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(b"\0" * 4096)
+            elif self.path == "/trickle":
+                self.send_response(200)
+                self.send_header("Content-Length", "100")
+                self.end_headers()
+                for _ in range(100):
+                    self.wfile.write(b"\0")
+                    self.wfile.flush()
+                    time.sleep(0.05)
+            elif self.path == "/hang":
+                time.sleep(2)
+                self._send(server.image)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def _send(self, body):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture(scope="module")
+def server():
+    server = StubImageServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+
+
+def test_fetch(server):
+    assert ImageFetcher().fetch(f"{server.url}/image") == server.image
+
+
+def test_repeated_image_is_fetched_once(server):
+    url = f"{server.url}/image?repeated"
+    first, second = process_image(url), process_image(url)
+    assert first is second
+    assert first.info["cache_key"]
+    assert server.hits["/image?repeated"] == 1
+
+
+def test_concurrent_fetches_are_bounded(server):
+    fetcher = ImageFetcher(max_workers=2)
+    urls = [f"{server.url}/slow?{i}" for i in range(6)]
+    with server.lock:
+        server.max_in_flight = 0
+    assert fetcher.map(fetcher.fetch, urls) == [server.image] * 6
+    assert server.max_in_flight == 2
+
+
+@pytest.mark.parametrize("path", ["/large", "/large-unsized"])
+def test_large_images_are_rejected(server, path):
+    with pytest.raises(ValueError):
+        ImageFetcher(max_bytes=1024).fetch(server.url + path)
+
+
+def test_slow_download_times_out(server):
+    t0 = time.monotonic()
+    with pytest.raises(TimeoutError):
+        ImageFetcher(timeout=0.5).fetch(f"{server.url}/trickle")
+    assert time.monotonic() - t0 < 1.5
+
+
+def test_unresponsive_server_times_out(server):
+    t0 = time.monotonic()
+    with pytest.raises(requests.Timeout):
+        ImageFetcher(timeout=0.5).fetch(f"{server.url}/hang")
+    assert time.monotonic() - t0 < 1.5
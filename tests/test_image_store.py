@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+import time
+from io import BytesIO
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from PIL import Image
+
+from src.api import image_store as image_store_module
+from src.api.image_store import ImageStore, add_image_endpoints
+
+
+def png_bytes(color):
+    buffered = BytesIO()
+    Image.new("RGB", (16, 16), color).save(buffered, format="PNG")
+    return buffered.getvalue()
+
+
+def test_images_are_stored_by_content(tmp_path):
+    store = ImageStore(str(tmp_path))
+    data = png_bytes((255, 0, 0))
+    key = store.put(data)
+    assert key == "image://" + hashlib.sha256(data).hexdigest()
+    assert store.put(data) == key and store.stats()["entries"] == 1
+    with open(store.path(key), "rb") as f:
+        assert f.read() == data
+
+    with pytest.raises(ValueError):
+        store.put(b"not an image")
+    # Ids that aren't a SHA-256 never reach the file system
+    for key in ["image://../secrets", "image://" + "0" * 63, "/etc/passwd"]:
+        assert key not in store
+        with pytest.raises(KeyError):
+            store.path(key)
+
+
+def test_least_recently_used_images_are_evicted(tmp_path):
+    images = [png_bytes(color) for color in [(1, 0, 0), (0, 1, 0), (0, 0, 1)]]
+    # Room for all but one
+    store = ImageStore(str(tmp_path), max_bytes=sum(map(len, images)) - 1)
+    first, second = store.put(images[0]), store.put(images[1])
+    now = time.time()
+    os.utime(store.path(first), (now - 20, now - 20))
+    os.utime(store.path(second), (now - 10, now - 10))
+    # Reading an image marks it as used
+    store.path(first)
+
+    third = store.put(images[2])
+    assert first in store and third in store
+    assert second not in store
+    with pytest.raises(KeyError, match="upload it again"):
+        store.path(second)
+    assert store.stats()["bytes"] <= store.max_bytes
+
+
+class StubSpec:
+    """The parts of the OpenAI spec the endpoints use, recording chat completions."""
+
+    def __init__(self):
+        self.app = FastAPI()
+        self.requests = []
+
+    def add_endpoint(self, path, endpoint, methods):
+        self.app.add_api_route(path, endpoint, methods=methods)
+
+    async def chat_completion(self, request, background_tasks):
+        self.requests.append(request)
+        return {"ok": True}
+
+
+@pytest.fixture
+def spec(tmp_path, monkeypatch):
+    monkeypatch.setattr(image_store_module, "image_store", ImageStore(str(tmp_path)))
+    spec = StubSpec()
+    add_image_endpoints(spec)
+    return spec
+
+
+@pytest.fixture
+def client(spec):
+    return TestClient(spec.app)
+
+
+def test_uploaded_image_is_found_by_hash(client):
+    data = png_bytes((0, 128, 0))
+    sha256 = hashlib.sha256(data).hexdigest()
+    assert client.get(f"/v1/images/{sha256}").status_code == 404
+
+    response = client.post("/v1/images", content=data)
+    assert response.status_code == 200
+    assert response.json() == {"id": f"image://{sha256}", "bytes": len(data)}
+    assert client.get(f"/v1/images/{sha256}").json() == {"id": f"image://{sha256}"}
+
+
+def test_upload_that_is_not_an_image_is_rejected(client):
+    response = client.post("/v1/images", content=b"not an image")
+    assert response.status_code == 400
+
+
+def test_upload_over_the_limit_is_rejected(client, monkeypatch):
+    data = png_bytes((0, 0, 0))
+    monkeypatch.setattr(image_store_module, "IMAGE_FETCH_MAX_BYTES", len(data) - 1)
+    response = client.post("/v1/images", content=data)
+    assert response.status_code == 413
+
+
+def multipart_request(content):
+    return {
+        "model": "stub",
+        "messages": [{"role": "user", "content": content}],
+    }
+
+
+def test_attachments_are_stored_and_referenced_by_id(client, spec):
+    data = png_bytes((0, 0, 128))
+    content = [
+        {"type": "image_url", "image_url": {"url": "attachment://photo"}},
+        {"type": "text", "text": "What is this?"},
+    ]
+    response = client.post(
+        "/v1/chat/completions/multipart",
+        data={"request": json.dumps(multipart_request(content))},
+        files={"photo": ("photo.png", data, "image/png")},
+    )
+    assert response.status_code == 200
+
+    (request,) = spec.requests
+    image_url = request.messages[0].content[0].image_url
+    url = image_url if isinstance(image_url, str) else image_url.url
+    assert url == "image://" + hashlib.sha256(data).hexdigest()
+    assert url in image_store_module.image_store
+
+
+@pytest.mark.parametrize(
+    "data, files, status_code",
+    [
+        # No request field, an invalid request, a missing file part, a file that
+        # isn't an image
+        ({}, {"photo": ("photo.png", png_bytes((0, 0, 0)), "image/png")}, 400),
+        ({"request": json.dumps({"model": "stub", "messages": [{}]})}, {}, 422),
+        (
+            {
+                "request": json.dumps(
+                    multipart_request(
+                        [{"type": "image_url", "image_url": {"url": "attachment://x"}}]
+                    )
+                )
+            },
+            {"photo": ("photo.png", png_bytes((0, 0, 0)), "image/png")},
+            400,
+        ),
+        (
+            {"request": json.dumps(multipart_request("Hi"))},
+            {"photo": ("photo.png", b"not an image", "image/png")},
+            400,
+        ),
+    ],
+)
+def test_malformed_multipart_requests_are_rejected(
+    client, spec, data, files, status_code
+):
+    response = client.post("/v1/chat/completions/multipart", data=data, files=files)
+    assert response.status_code == status_code
+    assert not spec.requests
@@ -0,0 +1,151 @@
+import json
+
+import pytest
+import torch
+
+from src.api.json_grammar import JSONGrammar, TokenVocabulary
+from src.api.stub import stub_processor
+
+SCHEMA = {
+    "type": "object",
+    "properties": {
+        "name": {"type": "string"},
+        "age": {"type": "integer"},
+        "score": {"type": "number"},
+        "tags": {"type": "array", "items": {"type": "string"}},
+        "kind": {"enum": ["cat", "dog"]},
+        "ok": {"type": "boolean"},
+    },
+    "required": ["name", "kind"],
+}
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return stub_processor().tokenizer
+
+
+@pytest.fixture(scope="module")
+def vocabulary(tokenizer):
+    return TokenVocabulary(tokenizer)
+
+
+@pytest.fixture(scope="module")
+def grammar(vocabulary):
+    return JSONGrammar(SCHEMA, vocabulary)
+
+
+def feed(grammar, tokenizer, text):
+    """The state after `text`, None if the grammar rejects it."""
+    state = grammar.initial_state
+    for token_id in tokenizer.encode(text, add_special_tokens=False):
+        state = grammar.advance(state, token_id)
+        if state is None:
+            return None
+    return state
+
+
+def generate(grammar, seed, max_tokens=5000) -> str:
+    """Sample random logits constrained by the grammar until it emits EOS."""
+    vocabulary = grammar.vocabulary
+    generator = torch.Generator().manual_seed(seed)
+    # Strings may hold any bytes, a model writes them as UTF-8 text
+    ascii_tokens = torch.tensor(
+        [data is not None and data.isascii() for data in vocabulary.token_bytes]
+    )
+    ascii_tokens[vocabulary.eos_token_id] = True
+    state, output = grammar.initial_state, b""
+    for _ in range(max_tokens):
+        token_id = grammar.forced_token(state)
+        if token_id is None:
+            logits = torch.randn(vocabulary.size, generator=generator)
+            logits[~ascii_tokens] = float("-inf")
+            token_id = int(grammar.constrain(state, logits).argmax())
+        if token_id == vocabulary.eos_token_id:
+            return output.decode()
+        state = grammar.advance(state, token_id)
+        assert state is not None
+        output += vocabulary.token_bytes[token_id]
+    raise AssertionError(f"No EOS after {max_tokens} tokens: {output[:200]!r}")
+
+
+@pytest.mark.parametrize("seed", range(8))
+def test_sampled_output_is_json_matching_the_schema(grammar, seed):
+    output = generate(grammar, seed)
+    value = json.loads(output)
+    # Properties come in schema order
+    assert list(value) == [name for name in SCHEMA["properties"] if name in value]
+
+    assert isinstance(value["name"], str)
+    assert value["kind"] in ("cat", "dog")
+    assert isinstance(value.get("age", 0), int) and not isinstance(
+        value.get("age"), bool
+    )
+    assert isinstance(value.get("score", 0.0), (int, float))
+    assert all(isinstance(tag, str) for tag in value.get("tags", []))
+    assert isinstance(value.get("ok", True), bool)
+
+
+def test_text_without_choice_is_forced(grammar, tokenizer, vocabulary):
+    def forced_text(state):
+        text = b""
+        while (token_id := grammar.forced_token(state)) is not None:
+            if token_id == vocabulary.eos_token_id:
+                return text + b"<eos>"
+            text += vocabulary.token_bytes[token_id]
+            state = grammar.advance(state, token_id)
+        return text
+
+    # The first property is required
+    assert forced_text(grammar.initial_state) == b'{"name": "'
+    # The rest of a property's name, and the quote of a string enum
+    state = feed(grammar, tokenizer, '{"name": "Rex", "k')
+    assert forced_text(state) == b'ind": "'
+    # Only one enum value starts with "c"
+    state = feed(grammar, tokenizer, '{"name": "Rex", "kind": "c')
+    assert forced_text(state) == b'at"'
+    # Nothing is forced where there is a choice
+    assert forced_text(feed(grammar, tokenizer, '{"name": "')) == b""
+    assert forced_text(feed(grammar, tokenizer, '{"name": "Rex", "kind": "cat"}')) == (
+        b"<eos>"
+    )
+
+
+def test_required_properties_are_enforced(grammar, tokenizer):
+    # A finished document leaves an empty state
+    assert feed(grammar, tokenizer, '{"name": "Rex", "kind": "cat"}') == ()
+    assert feed(grammar, tokenizer, '{"name": "Rex", "age": 3, "kind": "dog"}') == ()
+    # "kind" is missing, or "name" isn't first
+    assert feed(grammar, tokenizer, '{"name": "Rex"}') is None
+    assert feed(grammar, tokenizer, '{"name": "Rex", "ok": true') is None
+    assert feed(grammar, tokenizer, '{"kind": "cat"') is None
+    # Values are typed, enums limited to their values
+    assert feed(grammar, tokenizer, '{"name": 3') is None
+    assert feed(grammar, tokenizer, '{"name": "Rex", "age": 3.5') is None
+    assert feed(grammar, tokenizer, '{"name": "Rex", "kind": "cow"') is None
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "",
+        '{"name": "Rex"',
+        '{"name": "Rex", "kind": "cat"',
+        '{"name": "Rex", "tags": [',
+    ],
+)
+def test_eos_is_blocked_until_the_object_is_closed(grammar, tokenizer, text):
+    eos = grammar.vocabulary.eos_token_id
+    state = feed(grammar, tokenizer, text)
+    assert state is not None
+    assert grammar.advance(state, eos) is None
+    logits = grammar.constrain(state, torch.zeros(grammar.vocabulary.size))
+    assert logits[eos] == float("-inf")
+
+
+def test_eos_is_allowed_once_the_object_is_closed(grammar, tokenizer):
+    eos = grammar.vocabulary.eos_token_id
+    state = feed(grammar, tokenizer, '{"name": "Rex", "kind": "cat"}')
+    assert grammar.advance(state, eos) is not None
+    logits = grammar.constrain(state, torch.zeros(grammar.vocabulary.size))
+    assert logits[eos] == 0 and (logits == float("-inf")).sum() == len(logits) - 1
@@ -0,0 +1,172 @@
+import asyncio
+import json
+
+import pytest
+from litserve.specs.openai import ChatCompletionRequest
+from litserve.utils import LitAPIStatus
+
+from src.api import llama_vision
+from src.api.backends import StubBackend
+from src.api.cancellation import _raise_request_error
+from src.api.llama_vision import AsyncLlamaVisionAPI, LlamaVisionAPI
+from src.tools import get_top_hf_papers_json
+from src.tools.runtime import ToolRuntime
+
+
+def make_api(api_class=LlamaVisionAPI, **kwargs):
+    api = api_class(
+        backend=StubBackend(tokens_per_second=1000, time_to_first_token=0),
+        preprocess_workers=0,
+        **kwargs,
+    )
+    api.setup("cpu")
+    api.log = lambda *args, **kwargs: None
+    return api
+
+
+def chat_request(text, **kwargs):
+    return ChatCompletionRequest(
+        model="stub", messages=[{"role": "user", "content": text}], **kwargs
+    )
+
+
+@pytest.fixture
+def batched_api():
+    api = make_api(max_batch_size=4)
+    yield api
+    api.scheduler.shutdown()
+
+
+def test_batch_is_prefilled_together(batched_api):
+    engine = batched_api.scheduler.engine
+    prefill, prefill_sizes = engine.prefill, []
+
+    def recording_prefill(requests):
+        prefill_sizes.append(len(requests))
+        return prefill(requests)
+
+    engine.prefill = recording_prefill
+
+    requests = [chat_request(f"Question {i}", max_tokens=4) for i in range(4)]
+    contexts = [{} for _ in requests]
+    inputs = batched_api.batch(
+        [batched_api.decode_request(r, ctx) for r, ctx in zip(requests, contexts)],
+        contexts,
+    )
+    steps = list(batched_api.predict(inputs, contexts))
+
+    assert prefill_sizes == [4]
+    assert all("".join(outputs) for outputs in zip(*steps))
+
+
+def test_unreadable_image_fails_only_its_own_request(batched_api):
+    unreadable = [
+        {"type": "image_url", "image_url": {"url": "data:image/png;base64,AAAA"}},
+        {"type": "text", "text": "What is this?"},
+    ]
+    requests = [chat_request("Hello", max_tokens=4), chat_request(unreadable)]
+    contexts = [{} for _ in requests]
+    inputs = batched_api.batch(
+        [batched_api.decode_request(r, ctx) for r, ctx in zip(requests, contexts)],
+        contexts,
+    )
+    steps = batched_api.encode_response(
+        batched_api.unbatch(batched_api.predict(inputs, contexts)), contexts
+    )
+    good, failed = zip(
+        *[[batched_api.format_encoded_response(y) for y in step] for step in steps]
+    )
+
+    async def received(responses):
+        async def pipe():
+            for response in responses:
+                yield response, LitAPIStatus.OK
+
+        return [item async for item in _raise_request_error(pipe())]
+
+    assert "".join(json.loads(response)["content"] for response in good)
+    assert [status for _, status in asyncio.run(received(good))] == [
+        LitAPIStatus.OK
+    ] * len(good)
+    # The spec raises the error for the failed request alone
+    ((error, status),) = asyncio.run(received(failed))
+    assert status == LitAPIStatus.ERROR and error.status_code == 400
+    assert "Image 1 (a base64 data URL)" in error.detail
+
+
+@pytest.fixture
+def papers(monkeypatch):
+    """Arguments of the calls to a stub papers tool run by the server."""
+    calls = []
+    tools = {"get_top_hf_papers": lambda n: calls.append(n) or "[]"}
+    monkeypatch.setattr(llama_vision, "tool_runtime", ToolRuntime(tools))
+    return calls
+
+
+def agent_request():
+    # The stub engine calls the first tool, then ends its next turn at once
+    return ChatCompletionRequest(
+        model="stub",
+        messages=[
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": "What are the top papers today?"},
+        ],
+        tools=[get_top_hf_papers_json],
+        stream=False,
+        temperature=0,
+        max_tokens=64,
+    )
+
+
+def test_empty_final_agent_turn_yields_one_chunk(papers):
+    api = make_api(agent=True)
+    context = {}
+    try:
+        inputs = api.decode_request(agent_request(), context)
+        outputs = list(api.predict(inputs, context))
+    finally:
+        api.scheduler.shutdown()
+
+    assert papers == [5]
+    assert outputs == [""]
+    (message,) = api.encode_response(outputs, context)
+    assert message.content == "" and not message.tool_calls
+
+
+def test_empty_final_agent_turn_yields_one_chunk_async(papers):
+    api = make_api(AsyncLlamaVisionAPI, agent=True)
+    context = {}
+
+    async def generate():
+        inputs = await api.decode_request(agent_request(), context)
+        return [text async for text in api.predict(inputs, context)]
+
+    try:
+        outputs = asyncio.run(generate())
+    finally:
+        api.scheduler.shutdown()
+
+    assert papers == [5]
+    assert outputs == [""]
+
+
+def test_inference_time_covers_the_whole_stream():
+    api = make_api()
+    logged = {}
+    api.log = lambda key, value: logged.setdefault(key, value)
+    request = chat_request("Hello", max_tokens=8, stream=True)
+    context = {}
+    try:
+        outputs = api.predict(api.decode_request(request, context), context)
+        assert "inference_time" not in logged
+        assert "".join(outputs)
+    finally:
+        api.scheduler.shutdown()
+
+    assert logged["inference_time"] >= logged["generation_time"] > 0
+    # The worker's caches are reported with each finished request
+    (caches,) = logged["cache_stats"].values()
+    assert caches["vision"]["misses"] == 0
+    assert "lookup_hits" in caches["prefix"]
+    # Requests were decoded in the worker's process
+    assert caches["image"]["max_bytes"] > 0
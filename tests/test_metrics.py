@@ -0,0 +1,32 @@
+from prometheus_client import REGISTRY
+
+from src.api.metrics import MetricsLogger
+
+
+def cache_total(cache, stat):
+    return REGISTRY.get_sample_value(
+        "llama_vision_cache_total", {"cache": cache, "stat": stat}
+    )
+
+
+def cache_level(cache, stat):
+    return REGISTRY.get_sample_value(
+        "llama_vision_cache_size", {"cache": cache, "stat": stat}
+    )
+
+
+def test_cache_stats_are_counted_by_increase_and_summed_over_processes():
+    logger = MetricsLogger()
+    before = cache_total("test", "hits") or 0
+    stats = {"hits": 3, "saved_seconds": 0.5, "bytes": 100, "max_bytes": 1000}
+    logger.process("cache_stats", {1: {"test": stats}})
+    logger.process("cache_stats", {1: {"test": {**stats, "hits": 5, "bytes": 40}}})
+    logger.process("cache_stats", {2: {"test": {"hits": 1, "bytes": 10}}})
+
+    # Running totals grow by their increase since each process's previous snapshot
+    assert cache_total("test", "hits") - before == 6
+    assert cache_total("test", "saved_seconds") == 0.5
+    # Levels are the sum of the processes' latest values, configuration isn't exported
+    assert cache_level("test", "bytes") == 50
+    assert cache_total("test", "max_bytes") is None
+    assert cache_level("test", "max_bytes") is None
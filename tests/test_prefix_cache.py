@@ -0,0 +1,60 @@
+import torch
+
+from src.api.prefix_cache import PrefixCache, PrefixEntry
+
+# Bytes of the (1, 1, len, 2) float32 key and value states per token
+TOKEN_BYTES = 2 * 2 * 4
+
+
+def entry(token_ids):
+    token_ids = torch.tensor(token_ids)
+    states = torch.zeros(1, 1, len(token_ids), 2)
+    return PrefixEntry(token_ids, keys=[states], values=[states.clone()])
+
+
+def test_longest_common_prefix_is_reused():
+    cache = PrefixCache(max_bytes=1 << 20)
+    cache.insert("text", entry([1, 2, 3]))
+    cache.insert("text", entry([1, 2, 7, 8, 9]))
+
+    found, length = cache.lookup("text", torch.tensor([1, 2, 7, 8, 5, 6]))
+    assert found.token_ids.tolist() == [1, 2, 7, 8, 9] and length == 4
+    # At least one token is left to prefill
+    found, length = cache.lookup("text", torch.tensor([1, 2, 3]))
+    assert found.token_ids.tolist() == [1, 2, 3] and length == 2
+
+    assert cache.lookup("text", torch.tensor([5, 6]))[0] is None
+    stats = cache.stats()
+    assert stats["lookup_hits"] == 2 and stats["lookup_misses"] == 1
+    assert stats["reused_tokens"] == 6
+
+
+def test_entries_are_only_reused_with_the_same_images():
+    cache = PrefixCache(max_bytes=1 << 20)
+    cache.insert("image-a", entry([1, 2, 3, 4]))
+
+    assert cache.lookup("image-b", torch.tensor([1, 2, 3, 4, 5])) == (None, 0)
+    found, length = cache.lookup("image-a", torch.tensor([1, 2, 3, 4, 5]))
+    assert length == 4
+
+
+def test_extended_sequence_replaces_its_prefix():
+    cache = PrefixCache(max_bytes=1 << 20)
+    cache.insert("text", entry([1, 2]))
+    cache.insert("text", entry([1, 2, 3]))
+    assert cache.stats()["entries"] == 1
+
+
+def test_least_recently_used_entries_are_evicted_over_budget():
+    cache = PrefixCache(max_bytes=8 * TOKEN_BYTES)
+    cache.insert("text", entry([1, 1, 1]))
+    cache.insert("text", entry([2, 2, 2]))
+    # Using the first entry keeps it over the second
+    cache.lookup("text", torch.tensor([1, 1, 1, 4]))
+    cache.insert("text", entry([3, 3, 3]))
+
+    stats = cache.stats()
+    assert stats["entries"] == 2 and stats["evictions"] == 1
+    assert stats["bytes"] <= stats["max_bytes"]
+    assert cache.lookup("text", torch.tensor([2, 2, 2, 4]))[0] is None
+    assert cache.lookup("text", torch.tensor([1, 1, 1, 4]))[1] == 3
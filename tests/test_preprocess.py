@@ -0,0 +1,69 @@
+import pytest
+from fastapi import HTTPException
+from litserve.specs.openai import ChatCompletionRequest
+
+from src.api.backends import StubBackend
+from src.api.preprocess import RequestPreprocessor
+
+# A 1x1 red PNG
+RED_PIXEL = (
+    "data:image/png;base64,"
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAIAAACQd1PeAAAADElEQVR4nGP4z8AAAAMBAQDJ/pLvAAAAAElFTkSuQmCC"
+)
+
+
+@pytest.fixture(scope="module")
+def preprocessor():
+    preprocessor = RequestPreprocessor(StubBackend(), num_workers=1, max_pending=2)
+    yield preprocessor
+    preprocessor.shutdown()
+
+
+def chat_request(content):
+    return ChatCompletionRequest(
+        model="stub", messages=[{"role": "user", "content": content}]
+    )
+
+
+def test_requests_are_decoded_in_the_pool(preprocessor):
+    messages, prompt = preprocessor.submit(chat_request("Hello")).result()
+    assert messages == [{"role": "user", "content": "Hello"}]
+    assert prompt["input_ids"] and prompt["images"] is None
+    assert preprocessor.stats()["submitted"] >= 1
+
+
+def test_unreadable_image_is_a_client_error(preprocessor):
+    content = [
+        {"type": "image_url", "image_url": {"url": "data:image/png;base64,AAAA"}},
+        {"type": "text", "text": "What is this?"},
+    ]
+    future = preprocessor.submit(chat_request(content))
+    # Raised in the pool's process, the status and message reach the worker
+    with pytest.raises(HTTPException) as error:
+        future.result()
+    assert error.value.status_code == 400
+    assert "Image 1 (a base64 data URL)" in error.value.detail
+
+
+def test_pool_caches_are_reported_by_process(preprocessor):
+    image_request = chat_request(
+        [
+            {"type": "image_url", "image_url": {"url": RED_PIXEL}},
+            {"type": "text", "text": "What colour is this?"},
+        ]
+    )
+    json_request = ChatCompletionRequest(
+        model="stub",
+        messages=[
+            {"role": "system", "content": "Answer in JSON."},
+            {"role": "user", "content": "What colour is the sky?"},
+        ],
+        response_format={"type": "json_object"},
+    )
+    for request in [image_request, json_request] * 2:
+        preprocessor.submit(request).result()
+    (caches,) = preprocessor.cache_stats().values()
+    # The repeated requests reuse the decoded image and the rendered system prompt
+    assert caches["image"]["hits"] >= 1 and caches["image"]["entries"] >= 1
+    assert caches["prompt"]["prompt_hits"] >= 1
+    assert caches["image_tiles"]["hits"] >= 1
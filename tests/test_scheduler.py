@@ -0,0 +1,91 @@
+import pytest
+import torch
+
+from src.api.scheduler import GenerationScheduler, IncrementalDetokenizer
+from src.api.stub import WORDS, ScriptedEngine, stub_processor
+
+
+class RecordingEngine(ScriptedEngine):
+    """ScriptedEngine recording the requests of each step, EOS right away for "empty"."""
+
+    def __init__(self, tokenizer):
+        super().__init__(tokenizer, tokens_per_second=1000, time_to_first_token=0)
+        self.prefill_sizes = []
+        self.decode_sizes = []
+
+    def prefill(self, requests):
+        self.prefill_sizes.append(len(requests))
+        return super().prefill(requests)
+
+    def decode(self, requests, tokens):
+        self.decode_sizes.append(len(requests))
+        return super().decode(requests, tokens)
+
+    def _script(self, prompt: str):
+        if prompt.endswith("empty"):
+            return [self.tokenizer.eos_token_id]
+        return super()._script(prompt)
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return stub_processor().tokenizer
+
+
+@pytest.fixture
+def engine(tokenizer):
+    return RecordingEngine(tokenizer)
+
+
+@pytest.fixture
+def scheduler(engine):
+    scheduler = GenerationScheduler(engine, max_batch_size=4)
+    yield scheduler
+    scheduler.shutdown()
+
+
+def submit(scheduler, tokenizer, prompt, max_new_tokens):
+    input_ids = torch.tensor([tokenizer.encode(prompt, add_special_tokens=False)])
+    return scheduler.submit(
+        {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)},
+        {"temperature": 0, "max_new_tokens": max_new_tokens},
+        eos_token_ids=[tokenizer.eos_token_id],
+        detokenizer=IncrementalDetokenizer(tokenizer),
+    )
+
+
+def test_requests_share_decode_steps_and_leave_when_done(
+    scheduler, engine, tokenizer
+):
+    short = submit(scheduler, tokenizer, "short", max_new_tokens=3)
+    long = submit(scheduler, tokenizer, "long", max_new_tokens=30)
+
+    short_text, long_text = "".join(short), "".join(long)
+
+    words = " " + " ".join(WORDS)
+    assert words.startswith(short_text) and short_text
+    assert words.startswith(long_text) and len(long_text) > len(short_text)
+    assert short.finished and long.finished
+    # Both decoded in one batch, then the long request alone
+    assert 2 in engine.decode_sizes
+    assert engine.decode_sizes[-1] == 1
+
+
+def test_cancel_ends_the_stream(scheduler, tokenizer):
+    request = submit(scheduler, tokenizer, "endless", max_new_tokens=100_000)
+    chunks = iter(request)
+    assert next(chunks)
+    scheduler.cancel(request)
+    list(chunks)
+    assert request.cancelled and request.finished
+    assert len(request.output_ids) < 100_000
+
+    # The loop keeps serving other requests
+    assert "".join(submit(scheduler, tokenizer, "next", max_new_tokens=3))
+
+
+def test_empty_completion_yields_one_empty_chunk(scheduler, tokenizer):
+    request = submit(scheduler, tokenizer, "empty", max_new_tokens=10)
+    assert list(request) == [""]
+    assert request.finished
+    assert request.output_ids == [tokenizer.eos_token_id]
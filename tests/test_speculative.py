@@ -0,0 +1,174 @@
+import pytest
+import torch
+from transformers import (
+    LlamaConfig,
+    LlamaForCausalLM,
+    MllamaConfig,
+    MllamaForConditionalGeneration,
+)
+
+from src.api.engine import MllamaEngine
+from src.api.scheduler import GenerationScheduler, IncrementalDetokenizer
+from src.api.speculative import DraftModelProposer, PromptLookupProposer
+from src.api.stub import stub_processor
+
+TILE_SIZE = 28
+MAX_TILES = 4
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return stub_processor().tokenizer
+
+
+@pytest.fixture(scope="module")
+def image_token_id(tokenizer):
+    return tokenizer.convert_tokens_to_ids("<|image|>")
+
+
+@pytest.fixture(scope="module")
+def model(tokenizer, image_token_id):
+    torch.manual_seed(0)
+    config = MllamaConfig(
+        vision_config=dict(
+            hidden_size=32,
+            num_hidden_layers=2,
+            num_global_layers=1,
+            attention_heads=2,
+            intermediate_size=64,
+            image_size=TILE_SIZE,
+            patch_size=14,
+            max_num_tiles=MAX_TILES,
+            vision_output_dim=64,
+            intermediate_layers_indices=[0],
+            supported_aspect_ratios=[[1, 1], [1, 2], [2, 1], [2, 2]],
+        ),
+        text_config=dict(
+            hidden_size=32,
+            num_hidden_layers=4,
+            num_attention_heads=4,
+            num_key_value_heads=2,
+            intermediate_size=64,
+            vocab_size=len(tokenizer),
+            cross_attention_layers=[1],
+            max_position_embeddings=512,
+            pad_token_id=tokenizer.pad_token_id,
+            rope_scaling={"rope_type": "default"},
+        ),
+        image_token_index=image_token_id,
+    )
+    model = MllamaForConditionalGeneration(config).eval()
+    # Cross-attention gates start closed, open them and scale the image features up so
+    # that images change the output
+    for layer in model.language_model.model.layers:
+        if hasattr(layer, "cross_attn_attn_gate"):
+            layer.cross_attn_attn_gate.data.fill_(1)
+            layer.cross_attn_mlp_gate.data.fill_(1)
+    model.multi_modal_projector.weight.data.mul_(30)
+    return model
+
+
+@pytest.fixture(scope="module")
+def draft_model(model):
+    """The target's text model without its cross-attention layers, which only read images."""
+    text_model = model.language_model
+    layers = [
+        layer
+        for i, layer in enumerate(text_model.model.layers)
+        if i not in text_model.config.cross_attention_layers
+    ]
+    config = LlamaConfig(
+        hidden_size=32,
+        num_hidden_layers=len(layers),
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        intermediate_size=64,
+        vocab_size=text_model.config.vocab_size,
+        max_position_embeddings=512,
+        rope_theta=text_model.config.rope_theta,
+    )
+    draft_model = LlamaForCausalLM(config).eval()
+    draft_model.model.embed_tokens.weight.data.copy_(
+        text_model.model.embed_tokens.weight[: config.vocab_size]
+    )
+    for draft_layer, layer in zip(draft_model.model.layers, layers):
+        draft_layer.load_state_dict(layer.state_dict())
+    draft_model.model.norm.load_state_dict(text_model.model.norm.state_dict())
+    draft_model.lm_head.load_state_dict(text_model.lm_head.state_dict())
+    return draft_model
+
+
+@pytest.fixture
+def scheduler(model, draft_model, image_token_id):
+    proposers = {
+        "draft": DraftModelProposer(
+            draft_model, "cpu", num_tokens=4, ignore_token_ids=[image_token_id]
+        ),
+        "prompt_lookup": PromptLookupProposer(),
+    }
+    scheduler = GenerationScheduler(MllamaEngine(model, "cpu"), proposers=proposers)
+    yield scheduler
+    scheduler.shutdown()
+
+
+def text_inputs(tokenizer, text):
+    input_ids = torch.tensor([tokenizer.encode(text)])
+    return {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+
+
+def image_inputs(tokenizer, image_token_id, text):
+    inputs = text_inputs(tokenizer, text)
+    input_ids = torch.cat(
+        [
+            inputs["input_ids"][:, :1],
+            torch.tensor([[image_token_id]]),
+            inputs["input_ids"][:, 1:],
+        ],
+        dim=1,
+    )
+    generator = torch.Generator().manual_seed(0)
+    cross_attention_mask = torch.zeros(
+        1, input_ids.shape[1], 1, MAX_TILES, dtype=torch.long
+    )
+    cross_attention_mask[0, 1:, 0, :2] = 1
+    return {
+        "input_ids": input_ids,
+        "attention_mask": torch.ones_like(input_ids),
+        "pixel_values": torch.randn(
+            1, 1, MAX_TILES, 3, TILE_SIZE, TILE_SIZE, generator=generator
+        ),
+        "aspect_ratio_ids": torch.tensor([[2]]),
+        "aspect_ratio_mask": torch.tensor([[[1, 1, 0, 0]]]),
+        "cross_attention_mask": cross_attention_mask,
+    }
+
+
+def generate(scheduler, tokenizer, inputs, speculative=None):
+    request = scheduler.submit(
+        inputs,
+        {"temperature": 0, "max_new_tokens": 32, "speculative": speculative},
+        eos_token_ids=[tokenizer.eos_token_id],
+        detokenizer=IncrementalDetokenizer(tokenizer),
+    )
+    list(request)
+    assert request.finished
+    return request
+
+
+@pytest.mark.parametrize("speculative", ["draft", "prompt_lookup"])
+@pytest.mark.parametrize("with_image", [False, True])
+def test_greedy_speculative_output_matches_greedy_output(
+    scheduler, tokenizer, image_token_id, speculative, with_image
+):
+    text = "the receipt lists the total, the total price and the receipt date"
+    if with_image:
+        inputs = image_inputs(tokenizer, image_token_id, text)
+    else:
+        inputs = text_inputs(tokenizer, text)
+
+    plain = generate(scheduler, tokenizer, inputs)
+    speculated = generate(scheduler, tokenizer, inputs, speculative)
+
+    assert speculated.output_ids == plain.output_ids
+    assert speculated.verify_steps > 0 and speculated.accepted_tokens > 0
+    assert plain.verify_steps == 0
@@ -0,0 +1,157 @@
+import ast
+
+import pytest
+import torch
+
+from src.api.json_grammar import TokenVocabulary
+from src.api.stub import stub_processor
+from src.api.tool_grammar import ToolCallGrammar
+from src.tools.tool_utils import parse_python_function_call
+
+FUNCTIONS = [
+    {
+        "name": "get_top_hf_papers",
+        "parameters": {
+            "type": "object",
+            "properties": {"n": {"type": "integer"}},
+            "required": ["n"],
+        },
+    },
+    {
+        "name": "search",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "query": {"type": "string"},
+                "limit": {"type": "integer"},
+                "exact": {"type": "boolean"},
+                "sort": {"enum": ["date", "score"]},
+            },
+            "required": ["query"],
+        },
+    },
+    {"name": "now", "parameters": {"type": "object", "properties": {}}},
+]
+PARAMETER_TYPES = {
+    "n": int,
+    "query": str,
+    "limit": int,
+    "exact": bool,
+    "sort": str,
+}
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return stub_processor().tokenizer
+
+
+@pytest.fixture(scope="module")
+def vocabulary(tokenizer):
+    return TokenVocabulary(tokenizer)
+
+
+def feed(grammar, tokenizer, text):
+    """The state after `text`, None if the grammar rejects it."""
+    state = grammar.initial_state
+    for token_id in tokenizer.encode(text, add_special_tokens=False):
+        state = grammar.advance(state, token_id)
+        if state is None:
+            return None
+    return state
+
+
+def generate(grammar, seed, max_tokens=5000) -> str:
+    """Sample random ASCII logits constrained by the grammar until it emits EOS."""
+    vocabulary = grammar.vocabulary
+    generator = torch.Generator().manual_seed(seed)
+    ascii_tokens = torch.tensor(
+        [data is not None and data.isascii() for data in vocabulary.token_bytes]
+    )
+    ascii_tokens[vocabulary.eos_token_id] = True
+    state, output = grammar.initial_state, b""
+    for _ in range(max_tokens):
+        token_id = grammar.forced_token(state)
+        if token_id is None:
+            logits = torch.randn(vocabulary.size, generator=generator)
+            logits[~ascii_tokens] = float("-inf")
+            token_id = int(grammar.constrain(state, logits).argmax())
+        if token_id == vocabulary.eos_token_id:
+            return output.decode()
+        state = grammar.advance(state, token_id)
+        assert state is not None
+        output += vocabulary.token_bytes[token_id]
+    raise AssertionError(f"No EOS after {max_tokens} tokens: {output[:200]!r}")
+
+
+@pytest.mark.parametrize("seed", range(8))
+def test_sampled_calls_parse_as_declared(vocabulary, seed):
+    grammar = ToolCallGrammar(FUNCTIONS, vocabulary, allow_text=False)
+    output = generate(grammar, seed)
+
+    calls = ast.parse(output, mode="eval").body
+    assert isinstance(calls, ast.List) and calls.elts
+    declared = {f["name"]: f["parameters"] for f in FUNCTIONS}
+    for node in calls.elts:
+        name, args = parse_python_function_call(ast.get_source_segment(output, node))
+        properties = declared[name]["properties"]
+        # Declared parameters in order, required ones present, values typed
+        assert list(args) == [p for p in properties if p in args]
+        assert set(declared[name].get("required", [])) <= set(args)
+        for parameter, value in args.items():
+            assert type(value) is PARAMETER_TYPES[parameter]
+        if "sort" in args:
+            assert args["sort"] in ("date", "score")
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        '[search(query="papers", limit=3, exact=True)]',
+        '[get_top_hf_papers(n=5), now(), search(query="it\'s \\"quoted\\"")]',
+        '[search(query="a", sort="date")]',
+    ],
+)
+def test_valid_calls_are_accepted(vocabulary, tokenizer, text):
+    grammar = ToolCallGrammar(FUNCTIONS, vocabulary, allow_text=False)
+    state = feed(grammar, tokenizer, text)
+    assert state == ()
+    assert grammar.advance(state, vocabulary.eos_token_id) is not None
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        # Undeclared function and parameter
+        "[delete_everything(",
+        "[search(path=",
+        # Wrong value types, Python literals only
+        '[get_top_hf_papers(n="5"',
+        "[get_top_hf_papers(n=5.5",
+        "[search(query=true",
+        # Required parameter missing, parameters out of order
+        "[get_top_hf_papers()",
+        '[search(limit=3, query="a"',
+        # Not a list of calls
+        "Sure, here are the papers",
+    ],
+)
+def test_invalid_calls_are_rejected(vocabulary, tokenizer, text):
+    grammar = ToolCallGrammar(FUNCTIONS, vocabulary, allow_text=False)
+    assert feed(grammar, tokenizer, text) is None
+
+
+def test_text_is_allowed_unless_calls_are_required(vocabulary, tokenizer):
+    grammar = ToolCallGrammar(FUNCTIONS, vocabulary, allow_text=True)
+    state = feed(grammar, tokenizer, "Sure, here are the papers")
+    assert grammar.advance(state, vocabulary.eos_token_id) is not None
+    # Output starting as a list of calls is still constrained
+    assert feed(grammar, tokenizer, "[delete_everything(") is None
+    assert feed(grammar, tokenizer, "[get_top_hf_papers(n=5)]") == ()
+
+
+def test_eos_is_blocked_until_the_calls_are_closed(vocabulary, tokenizer):
+    grammar = ToolCallGrammar(FUNCTIONS, vocabulary, allow_text=False)
+    eos = vocabulary.eos_token_id
+    for text in ["", "[", "[get_top_hf_papers(n=5", "[get_top_hf_papers(n=5)"]:
+        assert grammar.advance(feed(grammar, tokenizer, text), eos) is None
@@ -0,0 +1,91 @@
+import json
+
+import pytest
+
+from src.tools.tool_utils import ToolCallParser
+
+# Outputs in each format, text between the calls and brackets in the arguments included,
+# and the (name, arguments) of their calls
+OUTPUTS = {
+    "function": (
+        '<function=get_top_hf_papers>{"n": 5}</function>\n'
+        'Then <function=search>{"query": "a } b"}</function>',
+        [("get_top_hf_papers", {"n": 5}), ("search", {"query": "a } b"})],
+    ),
+    "json": (
+        '{"type": "function", "name": "search", "parameters": {"query": "a } ]"}}; '
+        '{"name": "now", "parameters": {}}',
+        [("search", {"query": "a } ]"}), ("now", {})],
+    ),
+    "python": (
+        '[search(query="a ) ] \\" x", limit=3), "not a call", now(), '
+        "get_top_hf_papers(n=5)]",
+        [
+            ("search", {"query": 'a ) ] " x', "limit": 3}),
+            ("now", {}),
+            ("get_top_hf_papers", {"n": 5}),
+        ],
+    ),
+}
+
+
+def calls(tool_calls):
+    return [
+        (call["function"]["name"], json.loads(call["function"]["arguments"]))
+        for call in tool_calls
+    ]
+
+
+def feed(chunks):
+    parser = ToolCallParser()
+    completed = [call for chunk in chunks for call in parser.feed(chunk)]
+    assert completed == parser.calls
+    return parser
+
+
+@pytest.mark.parametrize("output_format", OUTPUTS)
+def test_calls_are_parsed_however_the_output_is_split(output_format):
+    output, expected = OUTPUTS[output_format]
+    assert calls(feed([output]).calls) == expected
+    assert calls(feed(list(output)).calls) == expected
+    for split in range(1, len(output)):
+        parser = feed([output[:split], output[split:]])
+        assert parser.format == output_format
+        assert calls(parser.calls) == expected
+        # Indexes merge the streamed calls' deltas
+        assert [call["index"] for call in parser.calls] == list(range(len(expected)))
+
+
+@pytest.mark.parametrize("output_format", OUTPUTS)
+def test_unfinished_calls_are_not_emitted(output_format):
+    output, expected = OUTPUTS[output_format]
+    parser = ToolCallParser()
+    emitted_at = []
+    for end in range(len(output)):
+        emitted_at.extend([end] * len(parser.feed(output[end])))
+    assert calls(parser.calls) == expected
+    # Each call is emitted once, when its closing bracket arrives
+    ends = [end for end, char in enumerate(output) if char in ")}"]
+    assert all(end in ends for end in emitted_at)
+    assert emitted_at == sorted(emitted_at)
+
+    # A call cut off before its end never is
+    last_call_end = emitted_at[-1]
+    assert calls(feed([output[:last_call_end]]).calls) == expected[:-1]
+
+
+@pytest.mark.parametrize(
+    "output",
+    ["The answer is [1, 2] and {x}", "  Sure! <function=now>{}</function>", "5 > 4"],
+)
+def test_plain_text_has_no_calls(output):
+    for split in range(1, len(output)):
+        parser = feed([output[:split], output[split:]])
+        assert parser.calls == [] and not parser.is_tool_call
+
+
+def test_format_waits_for_enough_output():
+    parser = ToolCallParser()
+    assert parser.feed("  <func") == [] and parser.format is None
+    assert parser.feed('tion=now>{"a": 1}') != []
+    assert parser.format == "function"
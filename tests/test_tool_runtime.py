@@ -0,0 +1,204 @@
+import importlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from src.tools.runtime import ToolRuntime
+
+# The package exports the function under the module's name
+papers_tool = importlib.import_module("src.tools.get_top_hf_papers")
+
+
+class Tools:
+    """Tool functions counting their calls."""
+
+    def __init__(self):
+        self.calls = 0
+        self.timeouts = []
+        self.lock = threading.Lock()
+
+    def count(self):
+        with self.lock:
+            self.calls += 1
+
+    def echo(self, text: str):
+        self.count()
+        return text
+
+    def sleep(self, seconds: float):
+        self.count()
+        time.sleep(seconds)
+        return "slept"
+
+    def wait(self, timeout: float):
+        self.count()
+        self.timeouts.append(timeout)
+        time.sleep(timeout)
+        raise TimeoutError("gave up")
+
+    def fail(self):
+        self.count()
+        raise RuntimeError("boom")
+
+    def functions(self):
+        return {
+            "echo": self.echo,
+            "sleep": self.sleep,
+            "wait": self.wait,
+            "fail": self.fail,
+        }
+
+
+@pytest.fixture
+def tools():
+    return Tools()
+
+
+def test_calls_run_concurrently_in_order(tools):
+    runtime = ToolRuntime(tools.functions(), max_workers=4)
+    t0 = time.monotonic()
+    results = runtime.run(
+        [("sleep", {"seconds": 0.3})] * 3 + [("echo", {"text": "hi"})]
+    )
+    assert time.monotonic() - t0 < 0.6
+    # Identical calls run once
+    assert tools.calls == 2
+    assert [r.content for r in results] == ["slept"] * 3 + ["hi"]
+    assert not any(r.error for r in results)
+
+
+def test_unknown_and_failing_calls_are_errors(tools):
+    runtime = ToolRuntime(tools.functions())
+    unknown, failed = runtime.run([("missing", {}), ("fail", {})])
+    assert unknown.error and "Unknown function" in unknown.content
+    assert failed.error and "RuntimeError: boom" in failed.content
+    # Failures aren't cached
+    runtime.run([("fail", {})])
+    assert tools.calls == 2
+
+
+def test_slow_call_is_abandoned_after_its_timeout(tools):
+    runtime = ToolRuntime(tools.functions(), timeout=5, timeouts={"sleep": 0.2})
+    t0 = time.monotonic()
+    slow, fast = runtime.run([("sleep", {"seconds": 0.6}), ("echo", {"text": "ok"})])
+    assert time.monotonic() - t0 < 0.4
+    assert slow.error and "timed out after 0.2s" in slow.content
+    assert fast.content == "ok" and not fast.error
+    # The abandoned call holds its worker until it returns
+    assert runtime.stats()["abandoned"] == 1
+    time.sleep(0.6)
+    assert runtime.stats()["abandoned"] == 0
+    assert runtime.stats()["entries"] == 1
+
+
+def test_tools_taking_a_timeout_are_passed_the_time_left(tools):
+    runtime = ToolRuntime(tools.functions(), timeout=0.3)
+    t0 = time.monotonic()
+    (result,) = runtime.run([("wait", {"timeout": 60})])
+    # The model's value is overridden, the tool gives up on its own
+    assert tools.timeouts and 0 < tools.timeouts[0] <= 0.3
+    assert result.error
+    assert time.monotonic() - t0 < 0.5
+    time.sleep(0.1)
+    assert runtime.stats()["abandoned"] == 0
+
+
+def test_queued_tools_are_passed_the_time_left_when_they_start(tools):
+    runtime = ToolRuntime(tools.functions(), max_workers=1, timeout=0.5)
+    t0 = time.monotonic()
+    # The second call waits for the only worker
+    runtime.run([("sleep", {"seconds": 0.3}), ("wait", {"timeout": 60})])
+    assert time.monotonic() - t0 < 0.7
+    assert tools.timeouts and 0 < tools.timeouts[0] <= 0.25
+
+
+def test_results_are_reused_until_they_expire(tools):
+    runtime = ToolRuntime(tools.functions(), ttl=0.3)
+    (first,) = runtime.run([("echo", {"text": "a"})])
+    (second,) = runtime.run([("echo", {"text": "a"})])
+    assert not first.cached and second.cached
+    assert second.content == "a"
+    assert tools.calls == 1
+    assert runtime.stats()["hits"] == 1
+
+    time.sleep(0.4)
+    (third,) = runtime.run([("echo", {"text": "a"})])
+    assert not third.cached
+    assert tools.calls == 2
+
+
+def test_oldest_results_are_dropped_first(tools):
+    runtime = ToolRuntime(tools.functions(), max_entries=2)
+    for text in "abc":
+        runtime.run([("echo", {"text": text})])
+    assert runtime.stats()["entries"] == 2
+    assert runtime.run([("echo", {"text": "c"})])[0].cached
+    assert not runtime.run([("echo", {"text": "a"})])[0].cached
+
+
+PAPERS = [
+    {"paper": {"id": str(i), "title": f"Paper {i}", "upvotes": i, "authors": []}}
+    for i in range(5)
+]
+
+
+class StubPapersHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        body = json.dumps(PAPERS).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            if self.path.startswith("/trickle"):
+                for i in range(len(body)):
+                    self.wfile.write(body[i : i + 1])
+                    self.wfile.flush()
+                    time.sleep(0.05)
+            else:
+                self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+@pytest.fixture(scope="module")
+def papers_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubPapersHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+def test_top_papers_are_sorted_by_upvotes(papers_url, monkeypatch):
+    monkeypatch.setattr(papers_tool, "API_URL", papers_url)
+    papers = json.loads(papers_tool.get_top_hf_papers(2))
+    assert [paper["title"] for paper in papers] == ["Paper 4", "Paper 3"]
+
+
+def test_papers_tool_stops_at_the_runtime_timeout(papers_url, monkeypatch):
+    monkeypatch.setattr(papers_tool, "API_URL", f"{papers_url}/trickle")
+    runtime = ToolRuntime(
+        {"get_top_hf_papers": papers_tool.get_top_hf_papers},
+        timeouts={"get_top_hf_papers": 0.3},
+    )
+    t0 = time.monotonic()
+    (result,) = runtime.run([("get_top_hf_papers", {"n": 2})])
+    assert result.error
+    # The tool gave up on its own and freed its worker
+    time.sleep(0.2)
+    assert runtime.stats()["abandoned"] == 0
+    assert time.monotonic() - t0 < 1
+
+
+def test_papers_tool_stops_at_the_response_size_limit(papers_url, monkeypatch):
+    monkeypatch.setattr(papers_tool, "API_URL", papers_url)
+    monkeypatch.setattr(papers_tool, "MAX_RESPONSE_BYTES", 100)
+    runtime = ToolRuntime({"get_top_hf_papers": papers_tool.get_top_hf_papers})
+    (result,) = runtime.run([("get_top_hf_papers", {"n": 2})])
+    assert result.error and "over 100 bytes" in result.content
@@ -0,0 +1,125 @@
+import hashlib
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from types import SimpleNamespace
+
+import pytest
+from PIL import Image
+
+from src.ui import utils
+
+
+class StubImageStore(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubImageStoreHandler)
+        self.images = {}
+        self.uploads = 0
+        self.requests = 0
+
+
+class StubImageStoreHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        key = "image://" + self.path.rsplit("/", 1)[-1]
+        if key in self.server.images:
+            self._send(200, {"id": key})
+        else:
+            self._send(404, {"detail": f"Image {key} isn't stored"})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        key = "image://" + hashlib.sha256(body).hexdigest()
+        self.server.images[key] = body
+        self.server.uploads += 1
+        self._send(200, {"id": key})
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+@pytest.fixture
+def store(monkeypatch):
+    store = StubImageStore()
+    threading.Thread(target=store.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{store.server_address[1]}/v1"
+    completions = SimpleNamespace(create=lambda **kwargs: stub_stream(store, **kwargs))
+    client = SimpleNamespace(
+        base_url=base_url, chat=SimpleNamespace(completions=completions)
+    )
+    monkeypatch.setattr(utils, "client", client)
+    yield store
+    store.shutdown()
+
+
+def stub_stream(store, messages, stream, **kwargs):
+    """A streamed completion, ending at once like the server's if an image isn't stored."""
+    store.requests += 1
+    for message in messages:
+        for item in message["content"] if isinstance(message["content"], list) else []:
+            url = item.get("image_url", {}).get("url", "")
+            if url.startswith("image://") and url not in store.images:
+                return
+    yield "chunk"
+
+
+def png_bytes(color):
+    buffered = BytesIO()
+    Image.new("RGB", (8, 8), color).save(buffered, format="PNG")
+    return buffered.getvalue()
+
+
+def test_image_is_uploaded_once(store):
+    data = png_bytes((255, 0, 0))
+    part = utils.image_object(data)
+    assert part["image_url"]["url"] in store.images
+    assert utils.image_object(data) == part
+    assert store.uploads == 1
+
+
+def test_images_are_reused_without_checking_the_store(store):
+    data = png_bytes((0, 255, 0))
+    part = utils.image_object(data)
+    store.images.clear()
+
+    assert utils.image_object(data) == part
+    assert store.uploads == 1
+
+
+def test_evicted_images_are_uploaded_again_when_rejected(store):
+    part = utils.image_object(png_bytes((0, 0, 255)))
+    messages = [
+        {"role": "user", "content": [part, {"type": "text", "text": "What is it?"}]},
+        {"role": "assistant", "content": "A blue square."},
+        {"role": "user", "content": "Is it a square?"},
+    ]
+    assert list(utils.create_completion(model="stub", messages=messages)) == ["chunk"]
+    assert store.requests == 1
+
+    store.images.clear()
+    assert list(utils.create_completion(model="stub", messages=messages)) == ["chunk"]
+    assert part["image_url"]["url"] in store.images
+    assert store.uploads == 2 and store.requests == 3
+
+
+def test_failed_request_is_not_resent_if_no_image_was_evicted(store):
+    # An image this session never uploaded can't be restored
+    messages = [
+        {
+            "role": "user",
+            "content": [
+                {"type": "image_url", "image_url": {"url": "image://" + "0" * 64}}
+            ],
+        }
+    ]
+    assert list(utils.create_completion(model="stub", messages=messages)) == []
+    assert store.requests == 1
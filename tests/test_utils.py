@@ -0,0 +1,45 @@
+import base64
+from io import BytesIO
+
+import pytest
+from fastapi import HTTPException
+from litserve.specs.openai import ChatCompletionRequest
+from PIL import Image
+
+from src.api.utils import parse_messages
+
+
+def image_request(*urls):
+    content = [{"type": "image_url", "image_url": {"url": url}} for url in urls]
+    content.append({"type": "text", "text": "What is in these images?"})
+    return ChatCompletionRequest(
+        model="test", messages=[{"role": "user", "content": content}]
+    )
+
+
+def data_url():
+    buffered = BytesIO()
+    Image.new("RGB", (8, 8), (0, 0, 255)).save(buffered, format="PNG")
+    return "data:image/png;base64," + base64.b64encode(buffered.getvalue()).decode()
+
+
+def test_images_are_parsed():
+    messages, images = parse_messages(image_request(data_url()))
+    assert [image.size for image in images] == [(8, 8)]
+    assert messages[0]["content"][0] == {"type": "image"}
+
+
+@pytest.mark.parametrize(
+    "url, description",
+    [
+        ("data:image/png;base64,bm90IGFuIGltYWdl", "a base64 data URL"),
+        ("image://" + "0" * 64, "isn't stored, upload it again"),
+        ("/no/such/image.png", "/no/such/image.png"),
+    ],
+)
+def test_unreadable_images_are_rejected(url, description):
+    with pytest.raises(HTTPException) as error:
+        parse_messages(image_request(data_url(), url))
+    assert error.value.status_code == 400
+    assert error.value.detail.startswith("Image 2 (")
+    assert description in error.value.detail